@@ -0,0 +1,7 @@
+"""Contact and communicability analysis of the bound/unbound GR trajectories.
+
+The whole pipeline runs from one config-driven command line, e.g.
+``python -m analysis filter communicability --config run.yaml`` (see
+``analysis.cli``). The individual scripts also still run from the
+repository root as modules, e.g. ``python -m analysis.filter``.
+"""
@@ -0,0 +1,263 @@
+"""Adaptive frame sampling for contact occupancy.
+
+Instead of reading every frame (or every `stride`-th frame chosen by hand),
+the trajectory is split into blocks of `block_frames` frames. The blocks are
+visited in random order or in an interleaved "strided" order (0, 1/2, 1/4,
+3/4, ... of the trajectory), so the frames read so far always span the whole
+run. After every block the occupancy of each residue pair is re-estimated
+and given a batch-means standard error: the spread of the per-block
+occupancies divided by sqrt(blocks read). This accounts for the correlation
+between neighbouring frames inside a block.
+
+Sampling stops once no pair is still undecided. What "undecided" means
+follows the classification the occupancy feeds (`criterion`):
+
+- "occupancy": the pair's occupancy lies within `z` standard errors of
+  `threshold` (contact maps and communicability graphs threshold each
+  system's occupancy);
+- "difference": the pair's change |occ_unbound - occ_bound| lies within
+  `z` standard errors of `threshold`, with se_delta = sqrt(se_bound^2 +
+  se_unbound^2) over the matched residues (filter and interactions
+  threshold the change). Both conditions are then sampled together, one
+  block of each in turn;
+- "both": either of the above, for a pipeline whose stages use both.
+
+In every case a pair is decided once its standard error is at or below
+`tolerance`. Pairs far from the threshold settle after a few blocks, so the
+frames read are set by the few pairs near the decision boundary. The result
+is (counts, n_frames) of the frames read per system, as for a full pass.
+"""
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from itertools import zip_longest
+
+import numpy as np
+
+from analysis.contacts import accumulate_contact_counts
+from analysis.instrument import get_instrumentation
+from analysis.parallel import _block_counts, _load_selection, _mp_context
+from analysis.trajectory import DEFAULT_CHUNK_SIZE, count_frames, frame_blocks, iter_frame_block
+
+BLOCK_ORDERS = ("random", "strided")
+CRITERIA = ("occupancy", "difference", "both")
+
+AdaptiveSampling = namedtuple("AdaptiveSampling", ["threshold", "tolerance", "z", "block_frames", "order",
+                                                   "min_blocks", "seed", "criterion"])
+# Running totals over the blocks read: frame-weighted counts, and sums of the per-block occupancies and squares
+BlockMoments = namedtuple("BlockMoments", ["counts", "n_frames", "n_blocks", "sum_occ", "sum_sq"])
+
+
+def adaptive_sampling(threshold, tolerance=0.02, z=2.0, block_frames=50, order="random", min_blocks=10, seed=0,
+                      criterion="occupancy"):
+    """``AdaptiveSampling`` parameters; `min_blocks` are always read before testing for convergence."""
+    if order not in BLOCK_ORDERS:
+        raise ValueError(f"Unknown block order: {order}")
+    if criterion not in CRITERIA:
+        raise ValueError(f"Unknown adaptive sampling criterion: {criterion}")
+    return AdaptiveSampling(float(threshold), float(tolerance), float(z), int(block_frames), order,
+                            int(min_blocks), int(seed), criterion)
+
+
+def block_order(n_blocks, order="random", seed=0):
+    """Visiting order of `n_blocks` blocks: a seeded permutation, or the bit-reversal ("strided") order."""
+    if order not in BLOCK_ORDERS:
+        raise ValueError(f"Unknown block order: {order}")
+    if order == "random":
+        return np.random.default_rng(seed).permutation(n_blocks)
+    bits = max(1, (n_blocks - 1).bit_length())
+    reversed_indices = [int(format(k, f"0{bits}b")[::-1], 2) for k in range(1 << bits)]
+    return np.array([k for k in reversed_indices if k < n_blocks], dtype=np.int64)
+
+
+# ========== Convergence ==========
+def add_block(moments, counts, n_frames):
+    """``BlockMoments`` (None before the first block) with one more block of contact `counts`."""
+    occ = counts / n_frames
+    if moments is None:
+        return BlockMoments(counts, n_frames, 1, occ, occ ** 2)
+    return BlockMoments(moments.counts + counts, moments.n_frames + n_frames, moments.n_blocks + 1,
+                        moments.sum_occ + occ, moments.sum_sq + occ ** 2)
+
+
+def occupancy_standard_error(moments):
+    """Batch-means standard error of every pair's occupancy (zeros before a second block)."""
+    if moments.n_blocks < 2:
+        return np.zeros_like(moments.sum_occ)
+    n = moments.n_blocks
+    mean = moments.sum_occ / n
+    variance = np.maximum(moments.sum_sq / n - mean ** 2, 0) * n / (n - 1)
+    return np.sqrt(variance / n)
+
+
+def undecided_pairs(moments, sampling):
+    """Mask of pairs within `z` standard errors of the threshold whose standard error exceeds the tolerance."""
+    occ = moments.counts / moments.n_frames
+    se = occupancy_standard_error(moments)
+    return (np.abs(occ - sampling.threshold) < sampling.z * se) & (se > sampling.tolerance)
+
+
+def _matched(matrix, positions):
+    # Upper-triangular `matrix` restricted to the matched residue `positions`, as occupancy.reindex_occupancy
+    sub = matrix[np.ix_(positions, positions)]
+    return np.triu(sub + sub.T, 1)
+
+
+def undecided_differences(moments_bound, moments_unbound, positions_bound, positions_unbound, sampling):
+    """Mask of matched pairs whose |occ_unbound - occ_bound| is undecided against the threshold.
+
+    `positions_bound` and `positions_unbound` are the residue indices of the
+    matched residues in each system. The change is undecided while it lies
+    within `z` standard errors se_delta = sqrt(se_bound^2 + se_unbound^2) of
+    the threshold and se_delta exceeds the tolerance.
+    """
+    delta = (_matched(moments_unbound.counts / moments_unbound.n_frames, positions_unbound)
+             - _matched(moments_bound.counts / moments_bound.n_frames, positions_bound))
+    se = np.sqrt(_matched(occupancy_standard_error(moments_bound), positions_bound) ** 2
+                 + _matched(occupancy_standard_error(moments_unbound), positions_unbound) ** 2)
+    return (np.abs(np.abs(delta) - sampling.threshold) < sampling.z * se) & (se > sampling.tolerance)
+
+
+# ========== Sampling ==========
+def _read_block(system, cutoff_nm, start, n_frames, chunk_size, stride):
+    topology, atom_indices, residues = _load_selection(system.top_path, system.selection)
+    chunks = iter_frame_block(system.xtc_path, topology, atom_indices, start, n_frames, chunk_size, stride)
+    return accumulate_contact_counts(chunks, residues, cutoff_nm)
+
+
+def _group_schedule(systems, sampling, stride):
+    """Blocks of a group of replicas as (replica, start, n_frames), alternating between replicas.
+
+    Each replica's blocks are visited in its own ``block_order``. Also
+    returns the number of blocks and of strided frames of every replica.
+    """
+    visits, n_blocks, n_total = [], [], []
+    for k, system in enumerate(systems):
+        n_raw = count_frames(system.xtc_path)
+        n_total.append(-(-n_raw // stride))
+        blocks = frame_blocks(n_raw, max(1, -(-n_total[-1] // sampling.block_frames)), stride)
+        n_blocks.append(len(blocks))
+        visits.append([(k,) + blocks[b] for b in block_order(len(blocks), sampling.order, sampling.seed + k)])
+    return [block for turn in zip_longest(*visits) for block in turn if block is not None], n_blocks, n_total
+
+
+def _sample_blocks(groups, cutoff_nm, sampling, count_undecided, stride, chunk_size, n_workers, label):
+    """Read blocks of every group of systems until `count_undecided(moments per group)` is 0.
+
+    Groups take turns, one block each. Returns the ``BlockMoments`` of
+    every group, per-system lists [counts, n_frames, blocks read], the
+    schedules' block and frame totals, and the final undecided count.
+    """
+    inst = get_instrumentation()
+    schedules = [_group_schedule(systems, sampling, stride) for systems in groups]
+    visits = [(g,) + block for turn in zip_longest(*[s[0] for s in schedules])
+              for g, block in enumerate(turn) if block is not None]
+    # Every replica is read at least once before testing
+    ready = [min(max(sampling.min_blocks, len(systems)), len(s[0])) for systems, s in zip(groups, schedules)]
+    n_read = [[[0, 0, 0] for _ in systems] for systems in groups]
+    moments, undecided = [None] * len(groups), None
+
+    wave = max(n_workers, len(groups))
+    pool = ProcessPoolExecutor(max_workers=n_workers, mp_context=_mp_context()) if n_workers > 1 else None
+    try:
+        for lo in range(0, len(visits), wave):
+            picked = visits[lo:lo + wave]
+            with inst.stage("occupancy_compute"):
+                if pool is None:
+                    results = [_read_block(groups[g][k], cutoff_nm, start, n, chunk_size, stride) + ({},)
+                               for g, k, start, n in picked]
+                else:
+                    futures = [pool.submit(_block_counts, groups[g][k], cutoff_nm, start, n, chunk_size, stride)
+                               for g, k, start, n in picked]
+                    results = [future.result() for future in futures]
+            for (g, k, _, _), (counts, n_frames, counters) in zip(picked, results):
+                inst.merge_counters(counters)
+                if n_frames:
+                    moments[g] = add_block(moments[g], counts, n_frames)
+                    read = n_read[g][k]
+                    read[0], read[1], read[2] = read[0] + counts, read[1] + n_frames, read[2] + 1
+            if any(m is None or m.n_blocks < r for m, r in zip(moments, ready)):
+                continue
+            with inst.stage("convergence"):
+                undecided = count_undecided(moments)
+            inst.progress(label, f"Blocks read: {sum(m.n_blocks for m in moments)}/{len(visits)} "
+                                 f"({sum(m.n_frames for m in moments)} frames), undecided pairs: {undecided}")
+            if undecided == 0:
+                break
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    for g, systems in enumerate(groups):
+        if moments[g] is None:
+            raise ValueError(f"No frames read from {', '.join(system.xtc_path for system in systems)}")
+    if undecided is None:
+        undecided = count_undecided(moments)
+    return moments, n_read, [s[1] for s in schedules], [s[2] for s in schedules], int(undecided)
+
+
+def _summaries(groups, n_read, n_blocks, n_total, undecided):
+    inst = get_instrumentation()
+    results = []
+    for g, systems in enumerate(groups):
+        for k, system in enumerate(systems):
+            counts, n_frames, blocks_read = n_read[g][k]
+            inst.count("adaptive_frames_skipped", n_total[g][k] - n_frames)
+            print(f"[{system.name}] Read {n_frames} of {n_total[g][k]} frames ({blocks_read}/{n_blocks[g][k]} "
+                  f"blocks), {undecided} pairs undecided")
+            summary = {"blocks_read": blocks_read, "n_blocks": n_blocks[g][k], "frames_total": n_total[g][k],
+                       "undecided_pairs": undecided}
+            results.append((counts, n_frames, summary))
+    return results
+
+
+def adaptive_contact_counts(system, cutoff_nm, sampling, stride=1, chunk_size=DEFAULT_CHUNK_SIZE, n_workers=1):
+    """Contact counts of `system` over blocks read until every pair's occupancy is decided.
+
+    Only the "occupancy" criterion applies to a single system; see
+    ``adaptive_difference_counts`` for the others. With `n_workers` > 1,
+    blocks are read `n_workers` at a time in worker processes and
+    convergence is tested after every such wave. Returns (counts, n_frames,
+    summary), where `summary` records the blocks and frames read and the
+    pairs still undecided.
+    """
+    if sampling.criterion != "occupancy":
+        raise ValueError(f"Adaptive sampling criterion {sampling.criterion!r} needs both conditions; "
+                         f"use adaptive_difference_counts")
+    print(f"\nSampling contact occupancy ({system.name}): blocks of ~{sampling.block_frames} frames, "
+          f"{sampling.order} order")
+    groups = [[system]]
+    moments, n_read, n_blocks, n_total, undecided = _sample_blocks(
+        groups, cutoff_nm, sampling, lambda m: np.count_nonzero(undecided_pairs(m[0], sampling)), stride,
+        chunk_size, n_workers, system.name)
+    return _summaries(groups, n_read, n_blocks, n_total, undecided)[0]
+
+
+def adaptive_difference_counts(bound_systems, unbound_systems, positions_bound, positions_unbound, cutoff_nm,
+                               sampling, stride=1, chunk_size=DEFAULT_CHUNK_SIZE, n_workers=1):
+    """Contact counts of both conditions over blocks read until every matched pair's change is decided.
+
+    Each condition is a list of replicas sharing one topology; their blocks
+    are pooled into one set of ``BlockMoments`` per condition.
+    `positions_bound` and `positions_unbound` are the residue indices of the
+    matched residues (see ``undecided_differences``). With criterion "both",
+    each condition's occupancies must be decided too. Returns one (counts,
+    n_frames, summary) per system, bound replicas first.
+    """
+    if sampling.criterion not in ("difference", "both"):
+        raise ValueError(f"Adaptive sampling criterion {sampling.criterion!r} is tested per system; "
+                         f"use adaptive_contact_counts")
+
+    def count_undecided(moments):
+        undecided = np.count_nonzero(undecided_differences(moments[0], moments[1], positions_bound,
+                                                           positions_unbound, sampling))
+        if sampling.criterion == "both":
+            undecided += sum(np.count_nonzero(undecided_pairs(m, sampling)) for m in moments)
+        return undecided
+
+    groups = [list(bound_systems), list(unbound_systems)]
+    names = ", ".join(system.name for systems in groups for system in systems)
+    print(f"\nSampling contact occupancy ({names}): blocks of ~{sampling.block_frames} frames, "
+          f"{sampling.order} order, {sampling.criterion} criterion")
+    moments, n_read, n_blocks, n_total, undecided = _sample_blocks(
+        groups, cutoff_nm, sampling, count_undecided, stride, chunk_size, n_workers, names)
+    return _summaries(groups, n_read, n_blocks, n_total, undecided)
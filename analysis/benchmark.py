@@ -0,0 +1,197 @@
+"""Benchmarks of the contact, occupancy and communicability hot paths on synthetic data.
+
+Builds a protein-like trajectory (a compact random-walk chain of residues
+with heavy atoms and hydrogens around each CA), then times every pipeline
+stage separately and writes the results to JSON:
+
+    python -m analysis.benchmark --residues 400 --frames 200 --output bench.json
+    python -m analysis.benchmark --compare bench.json --output bench_new.json
+
+No GR trajectories are needed.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import tempfile
+import time
+import tracemalloc
+
+import mdtraj as md
+import numpy as np
+import sklearn
+
+from analysis.communicability import adjacency_matrix, communicability
+from analysis.contacts import contact_counts, match_residues
+from analysis.interactions import cluster_residues, difference_matrix, high_difference_residues
+from analysis.occupancy import MatchedOccupancy
+from analysis.storage import save_matrix
+
+BOND_LENGTH = 0.38  # nm between consecutive CA atoms
+
+
+# ========== Synthetic System ==========
+def synthetic_topology(n_residues, atoms_per_residue):
+    """One protein chain of ALA residues with `atoms_per_residue` atoms each, a third of them hydrogens."""
+    topology = md.Topology()
+    chain = topology.add_chain()
+    heavy = ["N", "C", "O", "C", "S"]
+    n_hydrogens = atoms_per_residue // 3
+    for k in range(n_residues):
+        residue = topology.add_residue("ALA", chain, resSeq=k + 1)
+        topology.add_atom("CA", md.element.carbon, residue)
+        for a in range(1, atoms_per_residue):
+            if a <= atoms_per_residue - 1 - n_hydrogens:
+                symbol = heavy[(a - 1) % len(heavy)]
+                topology.add_atom(f"{symbol}{a}", md.element.get_by_symbol(symbol), residue)
+            else:
+                topology.add_atom(f"H{a}", md.element.hydrogen, residue)
+    return topology
+
+
+def synthetic_trajectory(n_residues, atoms_per_residue, n_frames, noise=0.05, seed=0):
+    """Compact chain fluctuating around a fixed fold, in an orthorhombic box."""
+    rng = np.random.default_rng(seed)
+    topology = synthetic_topology(n_residues, atoms_per_residue)
+
+    # Random walk confined to a sphere of protein-like density
+    radius = 0.3 * n_residues ** (1 / 3) + 1.0
+    ca = np.zeros((n_residues, 3))
+    for k in range(1, n_residues):
+        step = rng.normal(size=3)
+        step *= BOND_LENGTH / np.linalg.norm(step)
+        if np.linalg.norm(ca[k - 1] + step) > radius:
+            step -= 2 * BOND_LENGTH * ca[k - 1] / np.linalg.norm(ca[k - 1])
+        ca[k] = ca[k - 1] + step
+    offsets = rng.normal(scale=0.12, size=(n_residues, atoms_per_residue, 3))
+    offsets[:, 0] = 0.0
+    reference = (ca[:, None, :] + offsets).reshape(-1, 3)
+
+    box = np.full(3, 2 * radius + 3.0)
+    reference += box / 2
+    xyz = reference[None] + rng.normal(scale=noise, size=(n_frames,) + reference.shape)
+    return md.Trajectory(xyz.astype(np.float32), topology,
+                         unitcell_lengths=np.tile(box, (n_frames, 1)),
+                         unitcell_angles=np.full((n_frames, 3), 90.0))
+
+
+# ========== Stage Timing ==========
+class StageTimer:
+    """Wall time and tracemalloc peak of each named stage."""
+
+    def __init__(self, track_memory=True):
+        self.track_memory = track_memory
+        self.stages = {}
+
+    def run(self, name, func, *args, **kwargs):
+        if self.track_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        stats = {"seconds": seconds}
+        if self.track_memory:
+            stats["peak_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+        self.stages[name] = stats
+        print(f"{name:>16}: {seconds:8.3f} s")
+        return result
+
+
+def _cluster(diff_matrix, n_clusters):
+    # The residue selection and clustering of interactions.cluster_contacts, on the sparse difference matrix
+    significant, sub = high_difference_residues(diff_matrix)
+    return cluster_residues(sub, min(n_clusters, len(significant)))
+
+
+def run_benchmark(n_residues=400, atoms_per_residue=12, n_frames=100, cutoff=0.4, threshold=0.5,
+                  comm_method="eigh", n_clusters=4, track_memory=True, workdir=None):
+    """Time every stage on a synthetic system and return the report dict.
+
+    Files are written to `workdir`, or to a temporary directory that is removed afterwards.
+    """
+    if workdir is None:
+        with tempfile.TemporaryDirectory(prefix="contact_bench_") as tmp:
+            return run_benchmark(n_residues, atoms_per_residue, n_frames, cutoff, threshold,
+                                 comm_method, n_clusters, track_memory, tmp)
+    timer = StageTimer(track_memory)
+    pdb_path = os.path.join(workdir, "synthetic.pdb")
+    xtc_path = os.path.join(workdir, "synthetic.xtc")
+
+    print(f"Generating {n_residues} residues x {atoms_per_residue} atoms x {n_frames} frames...")
+    traj = synthetic_trajectory(n_residues, atoms_per_residue, n_frames)
+    traj[0].save_pdb(pdb_path)
+    traj.save_xtc(xtc_path)
+    traj_b = synthetic_trajectory(n_residues, atoms_per_residue, n_frames, seed=1)
+
+    loaded = timer.run("load", md.load, xtc_path, top=pdb_path)
+    protein = timer.run("atom_slice", lambda: loaded.atom_slice(loaded.topology.select("protein")))
+    matched_keys, residues_a, residues_b = timer.run("residue_match", match_residues,
+                                                     protein.topology, traj_b.topology)
+    counts_a = timer.run("occupancy", contact_counts, protein, residues_a, cutoff)
+    occ_a = counts_a / protein.n_frames
+    occ_b = contact_counts(traj_b, residues_b, cutoff) / traj_b.n_frames
+    occupancy = MatchedOccupancy(matched_keys, residues_a, residues_b, occ_a, occ_b)
+    diff = timer.run("difference", difference_matrix, occupancy)
+    timer.run("svd_kmeans", _cluster, diff, n_clusters)
+    adj = adjacency_matrix(occ_a, threshold)
+    comm = timer.run("expm", communicability, adj, comm_method)
+    timer.run("write_npy", save_matrix, os.path.join(workdir, "comm"), comm)
+    timer.run("write_csv", save_matrix, os.path.join(workdir, "comm"), comm, formats=["csv"])
+
+    n_pairs = n_residues * (n_residues - 1) // 2
+    occupancy = timer.stages["occupancy"]
+    occupancy["frames_per_s"] = n_frames / occupancy["seconds"]
+    occupancy["pair_frames_per_s"] = n_pairs * n_frames / occupancy["seconds"]  # residue pairs x frames per second
+    timer.stages["load"]["frames_per_s"] = n_frames / timer.stages["load"]["seconds"]
+
+    return {
+        "params": {"n_residues": n_residues, "atoms_per_residue": atoms_per_residue,
+                   "n_frames": n_frames, "cutoff": cutoff, "threshold": threshold,
+                   "comm_method": comm_method, "n_contacts": int(np.count_nonzero(counts_a)),
+                   "n_edges": int(adj.nnz // 2)},
+        "environment": {"python": platform.python_version(), "numpy": np.__version__,
+                        "mdtraj": md.__version__, "sklearn": sklearn.__version__,
+                        "machine": platform.machine()},
+        "stages": timer.stages,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def compare_reports(previous, current):
+    """Print the per-stage time ratio current/previous."""
+    print(f"\n{'stage':>16}  {'previous':>9}  {'current':>9}  ratio")
+    for name, stats in current["stages"].items():
+        if name not in previous.get("stages", {}):
+            continue
+        before = previous["stages"][name]["seconds"]
+        ratio = stats["seconds"] / before if before > 0 else float("inf")
+        print(f"{name:>16}  {before:9.3f}  {stats['seconds']:9.3f}  {ratio:5.2f}x")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--residues", type=int, default=400)
+    parser.add_argument("--atoms-per-residue", type=int, default=12)
+    parser.add_argument("--frames", type=int, default=100)
+    parser.add_argument("--cutoff", type=float, default=0.4)
+    parser.add_argument("--threshold", type=float, default=0.5)
+    parser.add_argument("--comm-method", default="eigh")
+    parser.add_argument("--no-memory", action="store_true", help="skip tracemalloc peak tracking")
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--compare", help="previous benchmark JSON to compare against")
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(args.residues, args.atoms_per_residue, args.frames, args.cutoff,
+                           args.threshold, args.comm_method, track_memory=not args.no_memory)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Benchmark saved to: {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare_reports(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
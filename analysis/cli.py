@@ -0,0 +1,324 @@
+"""Command-line entry point for the contact pipeline.
+
+    python -m analysis occupancy --config run.yaml
+    python -m analysis filter cluster communicability --config run.toml --set threshold=0.4
+    python -m analysis all --config sweep.yaml
+    python -m analysis cutoff_sweep --set occupancy.histogram=true
+
+Each stage is a function of (pipeline, config). Parameter sets from the
+config's ``sweep`` are run one after another in the same process, and runs
+that share the systems, cutoff and stride reuse one loaded occupancy. Each
+parameter set of a sweep writes to its own subdirectory of ``output_dir``.
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from analysis.adaptive import adaptive_sampling
+from analysis.config import config_systems, load_config, parse_override, sweep_configs
+from analysis.contacts import format_residue_labels
+from analysis.cutoff_sweep import DEFAULT_EDGES, cutoff_sweep_summary, matched_histogram_occupancies
+from analysis.dccm import correlation_network, matched_dccm, residue_dccm
+from analysis.filter import significant_long_range_pairs, write_long_range_pairs
+from analysis.instrument import enable_instrumentation, get_instrumentation
+from analysis.interactions import cluster_contacts
+from analysis.matrix import communicability_outputs
+from analysis.occupancy import matched_system_occupancies
+from analysis.paths import residue_positions, system_paths, write_paths
+from analysis.pymol import draw_contacts, write_contact_cgo, write_longrange_script
+from analysis.rmsf import load_rmsf_data, plot_rmsf, system_rmsf
+from analysis.significance import contact_difference_significance, significance_dict
+from analysis.storage import save_matrix, save_sparse_matrix
+from analysis.windows import save_window_series, system_windows
+
+
+class Pipeline:
+    """Runs stages for many parameter sets, loading every distinct occupancy and significance test once."""
+
+    def __init__(self):
+        self._occupancies = {}
+        self._tests = {}
+
+    def _occupancy_key(self, config):
+        occupancy = {k: v for k, v in config["occupancy"].items() if k != "n_workers"}
+        # Adaptive sampling stops on the threshold, so its occupancy depends on it
+        threshold = config["threshold"] if occupancy["adaptive"] else None
+        return json.dumps([config["src_dir"], config["systems"], config["cutoff"], occupancy, threshold],
+                          sort_keys=True)
+
+    def occupancy(self, config):
+        """Matched occupancy of the config's systems (replica ensembles if several trajectories are listed)."""
+        key = self._occupancy_key(config)
+        if key not in self._occupancies:
+            bound, unbound = config_systems(config)
+            params = config["occupancy"]
+            if params["histogram"]:
+                occupancy = matched_histogram_occupancies(bound, unbound, config["cutoff"],
+                                                          _histogram_edges(config), params["stride"],
+                                                          params["chunk_size"], params["cache_dir"],
+                                                          params["n_workers"])
+            else:
+                occupancy = matched_system_occupancies(bound, unbound, config["cutoff"], params["stride"],
+                                                       params["chunk_size"], params["cache_dir"],
+                                                       params["n_workers"], params["incremental"],
+                                                       _adaptive_sampling(config))
+            self._occupancies[key] = (bound, unbound, occupancy)
+        return self._occupancies[key]
+
+    def pair_tests(self, config):
+        """``significance_dict`` of the configured test, or None if no test is configured."""
+        params = config["significance"]
+        if not params["test"]:
+            return None
+        key = self._occupancy_key(config) + json.dumps(params, sort_keys=True)
+        if key not in self._tests:
+            bound, unbound, occupancy = self.occupancy(config)
+            significance = contact_difference_significance(
+                bound, unbound, occupancy, config["cutoff"], config["occupancy"]["stride"],
+                config["occupancy"]["chunk_size"], config["occupancy"]["cache_dir"], params["test"],
+                params["n_blocks"], params["n_resamples"], params["fdr_alpha"])
+            self._tests[key] = significance_dict(significance)
+        return self._tests[key]
+
+
+def _output(config, name):
+    return os.path.join(config["output_dir"], name)
+
+
+def _adaptive_sampling(config):
+    params = config["occupancy"]
+    if not params["adaptive"]:
+        return None
+    return adaptive_sampling(config["threshold"], params["adaptive_tolerance"], params["adaptive_z"],
+                             params["adaptive_block_frames"], params["adaptive_order"],
+                             params["adaptive_min_blocks"], params["adaptive_seed"], params["adaptive_criterion"])
+
+
+def _histogram_edges(config):
+    edges = config["occupancy"]["histogram_edges"]
+    return DEFAULT_EDGES if edges is None else np.asarray(edges, dtype=float)
+
+
+# ========== Stages ==========
+def run_occupancy(pipeline, config):
+    """Compute (or load) both occupancies and save them as .npy matrices."""
+    _, _, occupancy = pipeline.occupancy(config)
+    labels = format_residue_labels(occupancy.residues_bound)
+    for name in ("bound", "unbound"):
+        path = _output(config, f"occupancy_{name}")
+        save_matrix(path, getattr(occupancy, f"occ_{name}"), labels, cutoff=config["cutoff"])
+        ensemble = getattr(occupancy, f"replicas_{name}", None)
+        if ensemble is not None:
+            save_matrix(f"{path}_replicas", ensemble.replicas, labels, cutoff=config["cutoff"],
+                        n_frames=ensemble.n_frames)
+            save_matrix(f"{path}_spread", ensemble.spread, labels, cutoff=config["cutoff"])
+        print(f"{name} occupancy saved to: {path}.npy")
+
+
+def run_filter(pipeline, config):
+    _, _, occupancy = pipeline.occupancy(config)
+    pair_tests = pipeline.pair_tests(config)
+    pairs = significant_long_range_pairs(occupancy, config["threshold"],
+                                         config["filter"]["min_residue_separation"], pair_tests)
+    path = write_long_range_pairs(pairs, occupancy, _output(config, config["filter"]["output"]), pair_tests)
+    print(f"{len(pairs)} long-range pairs saved to: {path}")
+
+
+def run_cluster(pipeline, config):
+    _, _, occupancy = pipeline.occupancy(config)
+    params = config["cluster"]
+    cluster_contacts(occupancy, config["threshold"], params["num_clusters"], params["max_residue_distance"],
+                     pipeline.pair_tests(config), _output(config, params["heatmap"]),
+                     _output(config, params["close_pairs"]), params["n_components"], params["cluster_counts"],
+                     params["silhouette_sample"], config["heatmap"]["max_cells"], config["heatmap"]["downsample"])
+    print(f"Cluster heatmap and close pairs saved to: {config['output_dir']}")
+
+
+def run_communicability(pipeline, config):
+    _, _, occupancy = pipeline.occupancy(config)
+    params = config["communicability"]
+    communicability_outputs(occupancy, config["cutoff"], config["threshold"], params["method"], params["rows"],
+                            params["formats"], np.dtype(params["dtype"]) if params["dtype"] else None,
+                            config["output_dir"], config["heatmap"]["max_cells"], config["heatmap"]["downsample"],
+                            params["heatmap_tiles"])
+
+
+def run_dccm(pipeline, config):
+    """Cα dynamic cross-correlation of both systems over the matched residues, and optionally their networks."""
+    bound, unbound, occupancy = pipeline.occupancy(config)
+    params, stream = config["dccm"], config["occupancy"]
+    labels = format_residue_labels(occupancy.residues_bound)
+    matrices = {}
+    for name, systems in (("bound", bound), ("unbound", unbound)):
+        result = residue_dccm(systems, stream["stride"], stream["chunk_size"], stream["cache_dir"])
+        matrices[name] = matched_dccm(result, getattr(occupancy, f"residues_{name}"))
+        path = _output(config, f"dccm_{name}")
+        save_matrix(path, matrices[name], labels, n_frames=result.n_frames)
+        print(f"{name} DCCM saved to: {path}.npy")
+        if params["network"]:
+            network = correlation_network(matrices[name], getattr(occupancy, f"occ_{name}"), config["threshold"],
+                                          params["network_weight"])
+            path = save_sparse_matrix(_output(config, f"correlation_network_{name}"), network, labels,
+                                      cutoff=config["cutoff"], threshold=config["threshold"],
+                                      weight=params["network_weight"])
+            print(f"{name} correlation network ({network.nnz // 2} edges) saved to: {path}")
+    path = _output(config, "dccm_difference")
+    save_matrix(path, matrices["unbound"] - matrices["bound"], labels)
+    print(f"DCCM difference (unbound - bound) saved to: {path}.npy")
+
+
+def run_paths(pipeline, config):
+    """Shortest paths and betweenness on both contact graphs, and the k shortest source/target paths."""
+    _, _, occupancy = pipeline.occupancy(config)
+    params = config["paths"]
+    labels = format_residue_labels(occupancy.residues_bound)
+    results = system_paths(occupancy, config["threshold"], params["weight"], config["communicability"]["method"],
+                           params["sources"], config["occupancy"]["cache_dir"])
+    for name, result in results.items():
+        path = _output(config, f"path_distances_{name}")
+        save_matrix(path, result.distances, labels, threshold=config["threshold"], weight=params["weight"],
+                    sources=params["sources"])
+        save_matrix(_output(config, f"path_betweenness_{name}"), result.betweenness, labels,
+                    threshold=config["threshold"], weight=params["weight"], sources=params["sources"])
+        print(f"{name} path lengths and betweenness saved to: {path}.npy, "
+              f"{_output(config, f'path_betweenness_{name}')}.npy")
+    if params["sources"] is not None and params["targets"] is not None:
+        path = _output(config, params["output"])
+        n_written = write_paths(path, results, occupancy.residues_bound,
+                                residue_positions(occupancy.residues_bound, params["sources"]),
+                                residue_positions(occupancy.residues_bound, params["targets"]), params["k"])
+        print(f"{n_written} paths saved to: {path}")
+
+
+def run_windows(pipeline, config):
+    """Sliding-window occupancy and communicability series of every trajectory, over the matched residues."""
+    bound, unbound, occupancy = pipeline.occupancy(config)
+    params, stream = config["windows"], config["occupancy"]
+    labels = format_residue_labels(occupancy.residues_bound)
+    for systems, residues in ((bound, occupancy.residues_bound), (unbound, occupancy.residues_unbound)):
+        results = system_windows(systems, residues, len(residues), config["cutoff"], params["width"],
+                                 params["step"], config["threshold"], params["communicability"],
+                                 params["refresh_tolerance"], stream["stride"], stream["chunk_size"],
+                                 stream["cache_dir"])
+        for name, series in results.items():
+            paths = save_window_series(_output(config, f"windows_{name}"), series, labels, cutoff=config["cutoff"],
+                                       threshold=config["threshold"], step=params["step"], stride=stream["stride"])
+            print(f"{name} window series saved to: {', '.join(paths)}")
+
+
+def run_pymol(pipeline, config):
+    params = config["pymol"]
+    bound, _, occupancy = pipeline.occupancy(config)
+    reference = bound if not isinstance(bound, list) else bound[0]
+    if params["format"] == "cgo":
+        pairs = significant_long_range_pairs(occupancy, config["threshold"],
+                                             config["filter"]["min_residue_separation"], pipeline.pair_tests(config))
+        write_contact_cgo(_output(config, params["cgo_output"]), occupancy, pairs, reference.top_path,
+                          reference.selection)
+    else:
+        # Rewritten every time from the cached occupancy, so the pairs follow the current threshold and cutoff
+        run_filter(pipeline, config)
+        draw_contacts(_output(config, config["filter"]["output"]), _output(config, params["output"]))
+        print(f"PyMOL script written to: {_output(config, params['output'])}")
+    if params["longrange"]:
+        write_longrange_script(_output(config, params["longrange_output"]), params["min_resi_separation"],
+                               occupancy, reference.top_path, config["threshold"], params["format"],
+                               reference.selection)
+
+
+def run_rmsf(pipeline, config):
+    params = config["rmsf"]
+    if params["source"] == "trajectory":
+        occupancy = config["occupancy"]
+        systems = dict(zip(("bound", "unbound"), config_systems(config)))
+    for name in ("bound", "unbound"):
+        if params["source"] == "trajectory":
+            replicas = systems[name] if isinstance(systems[name], list) else [systems[name]]
+            profiles = system_rmsf(replicas, params["atom_selection"], occupancy["stride"],
+                                   occupancy["chunk_size"], occupancy["cache_dir"], occupancy["n_workers"])
+            x_vals, all_rmsf = profiles[0].resids, np.array([profile.rmsf for profile in profiles])
+        elif params.get(name):
+            x_vals, all_rmsf = load_rmsf_data(params[name], base_dir=config["src_dir"])
+        else:
+            continue
+        path = _output(config, f"rmsf_{name}.png")
+        plot_rmsf(x_vals, all_rmsf, path, params["helices"] if name == "bound" else None,
+                  f"Mean RMSF ({name})")
+        print(f"{name} RMSF plot saved to: {path}")
+
+
+def run_cutoff_sweep(pipeline, config):
+    """Contacts per frame and changed pairs at every cutoff of ``cutoff_sweep.cutoffs``, from one histogram pass."""
+    bound, unbound = config_systems(config)
+    params = config["occupancy"]
+    rows = cutoff_sweep_summary(bound, unbound, config["cutoff_sweep"]["cutoffs"], config["threshold"],
+                                _histogram_edges(config), params["stride"], params["chunk_size"],
+                                params["cache_dir"], params["n_workers"])
+    path = _output(config, config["cutoff_sweep"]["output"])
+    with open(path, "w") as f:
+        f.write("Cutoff\tContactsBound\tContactsUnbound\tChangedPairs\n")
+        for row in rows:
+            f.write(f"{row['cutoff']:.3f}\t{row['contacts_bound']:.2f}\t{row['contacts_unbound']:.2f}\t"
+                    f"{row['changed_pairs']}\n")
+    print(f"Cutoff sweep saved to: {path}")
+
+
+STAGES = {
+    "occupancy": run_occupancy,
+    "cutoff_sweep": run_cutoff_sweep,
+    "filter": run_filter,
+    "cluster": run_cluster,
+    "communicability": run_communicability,
+    "dccm": run_dccm,
+    "paths": run_paths,
+    "windows": run_windows,
+    "pymol": run_pymol,
+    "rmsf": run_rmsf,
+}
+
+
+def run(stages, config, pipeline=None):
+    """Run `stages` (names from ``STAGES``) for every parameter set of `config`."""
+    pipeline = pipeline or Pipeline()
+    report = config["report"]
+    inst = enable_instrumentation(report["profile"], report["trace_memory"]) if report["path"] \
+        else get_instrumentation()
+    for label, run_config in sweep_configs(config):
+        if label:
+            run_config["output_dir"] = os.path.join(run_config["output_dir"], label)
+            print(f"\n========== {label} ==========")
+        os.makedirs(run_config["output_dir"], exist_ok=True)
+        for stage in stages:
+            with inst.stage(f"cli_{stage}"):
+                STAGES[stage](pipeline, run_config)
+    if report["path"]:
+        inst.write_report(report["path"])
+    return pipeline
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m analysis", description=__doc__.splitlines()[0])
+    parser.add_argument("stages", nargs="+", choices=list(STAGES) + ["all"],
+                        help="stages to run, in order; 'all' runs every stage")
+    parser.add_argument("--config", help="YAML, TOML or JSON config file")
+    parser.add_argument("--set", dest="overrides", action="append", default=[], metavar="KEY=VALUE",
+                        help="override a config value, e.g. --set occupancy.n_workers=8 (repeatable)")
+    parser.add_argument("--output-dir", help="override output_dir")
+    args = parser.parse_args(argv)
+
+    overrides = [parse_override(text) for text in args.overrides]
+    if args.output_dir:
+        overrides.append(("output_dir", args.output_dir))
+    config = load_config(args.config, overrides)
+    stages = list(STAGES) if "all" in args.stages else args.stages
+
+    start_time = time.time()
+    run(stages, config)
+    print(f"\nTotal execution time: {time.time() - start_time:.2f} seconds")
+
+
+if __name__ == "__main__":
+    main()
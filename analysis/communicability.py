@@ -0,0 +1,84 @@
+"""Communicability G = expm(A) of the thresholded contact graph.
+
+The adjacency is kept sparse (CSR). G is block diagonal over the connected
+components of the graph, so the symmetric eigendecomposition is done per
+component instead of on the full n_res x n_res matrix; isolated residues
+contribute G_ii = 1. When only some rows are needed, ``expm_multiply``
+evaluates them with Krylov-type products against the sparse adjacency and
+never forms G.
+"""
+import numpy as np
+import scipy.linalg
+import scipy.sparse
+from scipy.sparse.csgraph import connected_components
+from scipy.sparse.linalg import expm_multiply
+
+from analysis.instrument import get_instrumentation
+
+COMMUNICABILITY_METHODS = ("dense", "eigh", "expm_multiply")
+
+
+def adjacency_matrix(occ_matrix, threshold):
+    """Symmetric CSR adjacency weighted by occupancy, keeping upper-triangular pairs above `threshold`."""
+    n_res = occ_matrix.shape[0]
+    rows, cols = np.nonzero(np.triu(occ_matrix, 1) > threshold)
+    weights = occ_matrix[rows, cols]
+    return scipy.sparse.coo_matrix((np.concatenate([weights, weights]),
+                                    (np.concatenate([rows, cols]), np.concatenate([cols, rows]))),
+                                   shape=(n_res, n_res)).tocsr()
+
+
+def _communicability_eigh(adj, rows):
+    n_res = adj.shape[0]
+    n_comp, comp = connected_components(adj, directed=False)
+    result = np.zeros((len(rows), n_res))
+    row_pos = np.full(n_res, -1)
+    row_pos[rows] = np.arange(len(rows))
+
+    sizes = np.bincount(comp, minlength=n_comp)
+    # Isolated residues: expm of a 1x1 zero block
+    isolated = np.flatnonzero(sizes[comp] == 1)
+    hit = isolated[row_pos[isolated] >= 0]
+    result[row_pos[hit], hit] = 1.0
+
+    for c in np.flatnonzero(sizes > 1):
+        members = np.flatnonzero(comp == c)
+        wanted = members[row_pos[members] >= 0]
+        if len(wanted) == 0:
+            continue
+        block = adj[members][:, members].toarray()
+        eigvals, eigvecs = scipy.linalg.eigh(block)
+        local = np.searchsorted(members, wanted)
+        # G_block[local, :] = V[local] diag(exp(lambda)) V^T
+        result[np.ix_(row_pos[wanted], members)] = (eigvecs[local] * np.exp(eigvals)) @ eigvecs.T
+    return result
+
+
+def communicability(adj, method="eigh", rows=None):
+    """Communicability expm(adj) of a symmetric (sparse or dense) adjacency.
+
+    Returns the full (n_res, n_res) matrix, or only `rows` (by symmetry, also
+    the matching columns) as a (len(rows), n_res) array.
+    """
+    if method not in COMMUNICABILITY_METHODS:
+        raise ValueError(f"Unknown communicability method: {method}")
+    with get_instrumentation().stage("communicability"):
+        return _communicability(adj, method, rows)
+
+
+def _communicability(adj, method, rows):
+    n_res = adj.shape[0]
+    full = rows is None
+    rows = np.arange(n_res) if full else np.asarray(rows, dtype=int)
+
+    if method == "dense":
+        dense = adj.toarray() if scipy.sparse.issparse(adj) else np.asarray(adj)
+        comm = scipy.linalg.expm(dense)
+        return comm if full else comm[rows]
+    if method == "eigh":
+        return _communicability_eigh(scipy.sparse.csr_matrix(adj), rows)
+
+    # expm_multiply: G e_r for each requested row, i.e. the columns of G
+    unit = np.zeros((n_res, len(rows)))
+    unit[rows, np.arange(len(rows))] = 1.0
+    return expm_multiply(scipy.sparse.csr_matrix(adj), unit).T
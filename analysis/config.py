@@ -0,0 +1,179 @@
+"""Run configuration for the command-line pipeline.
+
+A config file (YAML, TOML or JSON) overrides any part of ``DEFAULT_CONFIG``;
+nested sections are merged key by key. ``sweep`` maps dotted keys to lists
+of values, and every combination of them is run as a separate parameter
+set::
+
+    cutoff: 0.4
+    systems:
+      bound:
+        trajectories: [md_skip_gr_ligand_1.xtc, md_skip_gr_ligand_2.xtc]
+    significance:
+      test: bootstrap
+    occupancy:
+      histogram: true
+    sweep:
+      cutoff: [0.35, 0.4, 0.45]
+      threshold: [0.3, 0.5]
+
+Relative ``src_dir`` and ``output_dir`` paths are resolved against the
+directory of the config file.
+"""
+import copy
+import itertools
+import json
+import os
+
+from analysis.heatmap import DEFAULT_MAX_CELLS
+from analysis.occupancy import DEFAULT_CACHE_DIR, SRC_DIR, System, replica_systems
+from analysis.rmsf import GR_HELICES
+from analysis.trajectory import DEFAULT_CHUNK_SIZE
+
+DEFAULT_CONFIG = {
+    "src_dir": SRC_DIR,  # trajectories, topologies and .xvg files are relative to this
+    "output_dir": ".",
+    "cutoff": 0.4,  # nm
+    "threshold": 0.5,  # occupancy (difference) threshold
+    "systems": {
+        "bound": {"trajectories": ["md_skip_gr_ligand.xtc"], "topology": "gr_ligand.pdb",
+                  "selection": "protein and chainid 1"},
+        "unbound": {"trajectories": ["md_skip_gr_only.xtc"], "topology": "gr_only.pdb",
+                    "selection": "protein and chainid 0"},
+    },
+    "occupancy": {"stride": 1, "chunk_size": DEFAULT_CHUNK_SIZE, "n_workers": os.cpu_count() or 1,
+                  "incremental": False, "cache_dir": DEFAULT_CACHE_DIR,
+                  # Read occupancies from one cached minimum-distance histogram per system, so
+                  # a sweep over cutoffs on the edge grid makes a single trajectory pass
+                  "histogram": False, "histogram_edges": None,
+                  # Read randomized ("random") or interleaved ("strided") frame blocks only until every pair
+                  # within adaptive_z standard errors of threshold has a standard error below the tolerance.
+                  # adaptive_criterion tests each system's occupancy ("occupancy"), the change between the
+                  # systems ("difference", as filter and cluster classify) or "both" (the stages mix the two)
+                  "adaptive": False, "adaptive_tolerance": 0.02, "adaptive_z": 2.0, "adaptive_block_frames": 50,
+                  "adaptive_order": "random", "adaptive_min_blocks": 10, "adaptive_seed": 0,
+                  "adaptive_criterion": "both"},
+    "cutoff_sweep": {"cutoffs": [0.35, 0.40, 0.45, 0.50, 0.55, 0.60], "output": "cutoff_sweep.tsv"},
+    "significance": {"test": None, "n_blocks": 20, "n_resamples": 2000, "fdr_alpha": 0.05},
+    "filter": {"min_residue_separation": 11, "output": "significant_long_range_pairs.txt"},
+    "cluster": {"num_clusters": 4, "max_residue_distance": 10,  # num_clusters null: pick by silhouette
+                "cluster_counts": list(range(2, 11)), "silhouette_sample": 2000, "n_components": 2,
+                "heatmap": "heatmap_diff_clusters_only.png", "close_pairs": "significant_close_pairs.txt"},
+    "communicability": {"method": "eigh", "rows": None, "formats": ["npy"], "dtype": None,
+                        "heatmap_tiles": False},
+    "dccm": {"network": False, "network_weight": "correlation"},  # contact edges weighted by |DCCM|
+    # Path lengths -log(occupancy) or -log(normalized communicability); sources/targets are resSeqs,
+    # sources null computes all-pairs paths, and the k shortest paths are written for sources x targets
+    "paths": {"weight": "occupancy", "sources": None, "targets": None, "k": 3, "output": "allosteric_paths.tsv"},
+    # Heatmaps larger than max_cells rows/columns are block-reduced ("max", "mean"; null draws every cell)
+    "heatmap": {"max_cells": DEFAULT_MAX_CELLS, "downsample": "max"},
+    # Windows of `width` frames every `step` frames; communicability "frechet" (first-order updates between
+    # exact refreshes once the adjacency has changed by refresh_tolerance), "exact" or null (occupancy only)
+    "windows": {"width": 100, "step": 10, "communicability": "frechet", "refresh_tolerance": 0.05},
+    # "cgo" writes one compiled CGO object (run the .py in PyMOL); "distance" one distance per pair
+    "pymol": {"format": "cgo", "cgo_output": "contacts_cgo.py", "output": "draw_contacts.pml",
+              "longrange": False, "longrange_output": "contacts_longrange.py", "min_resi_separation": 20},
+    "rmsf": {"bound": ["rmsf_gr_1.xvg", "rmsf_gr_2.xvg", "rmsf_gr_3.xvg"],
+             "unbound": ["rmsf_gr_only_1.xvg", "rmsf_gr_only_2.xvg", "rmsf_gr_only_3.xvg"],
+             "helices": GR_HELICES,
+             # "trajectory" computes the profiles from the systems' trajectories (cached) instead
+             "source": "xvg", "atom_selection": None},
+    "report": {"path": None, "profile": False, "trace_memory": False},
+    "sweep": {},
+}
+
+
+def _merge(base, overrides):
+    merged = copy.deepcopy(base)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict) and key != "sweep":
+            merged[key] = _merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def read_config_file(path):
+    """Parse a YAML (.yaml/.yml), TOML (.toml) or JSON config file."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".yaml", ".yml"):
+        try:
+            import yaml
+        except ImportError:
+            raise ImportError("YAML configs need PyYAML (pip install pyyaml); TOML and JSON work without it")
+        with open(path) as f:
+            return yaml.safe_load(f) or {}
+    if ext == ".toml":
+        try:
+            import tomllib
+        except ImportError:  # Python < 3.11
+            import tomli as tomllib
+        with open(path, "rb") as f:
+            return tomllib.load(f)
+    if ext == ".json":
+        with open(path) as f:
+            return json.load(f)
+    raise ValueError(f"Unknown config format: {path}")
+
+
+def parse_override(text):
+    """``"key.sub=value"`` to (key path, value); the value is parsed as JSON when possible."""
+    key, sep, value = text.partition("=")
+    if not sep:
+        raise ValueError(f"Overrides must look like key=value, got: {text}")
+    try:
+        value = json.loads(value)
+    except json.JSONDecodeError:
+        pass
+    return key.strip(), value
+
+
+def set_dotted(config, key, value):
+    *parents, last = key.split(".")
+    section = config
+    for name in parents:
+        section = section.setdefault(name, {})
+    section[last] = value
+
+
+def load_config(path=None, overrides=()):
+    """``DEFAULT_CONFIG`` updated from the file at `path` and then from `overrides` (key path, value) pairs."""
+    config = copy.deepcopy(DEFAULT_CONFIG)
+    if path is not None:
+        config = _merge(config, read_config_file(path))
+        base_dir = os.path.dirname(os.path.abspath(path))
+        for key in ("src_dir", "output_dir"):
+            config[key] = os.path.join(base_dir, config[key])
+    for key, value in overrides:
+        set_dotted(config, key, value)
+    return config
+
+
+def sweep_configs(config):
+    """One (label, config) per combination of the ``sweep`` values; a single ("", config) without a sweep."""
+    sweep = config.get("sweep") or {}
+    if not sweep:
+        return [("", config)]
+    keys = list(sweep)
+    runs = []
+    for values in itertools.product(*(sweep[key] for key in keys)):
+        run = copy.deepcopy(config)
+        run["sweep"] = {}
+        for key, value in zip(keys, values):
+            set_dotted(run, key, value)
+        runs.append(("_".join(f"{key}-{value}" for key, value in zip(keys, values)), run))
+    return runs
+
+
+def config_systems(config):
+    """Bound and unbound systems of a config: one ``System`` each, or lists of replicas."""
+    systems = []
+    for name in ("bound", "unbound"):
+        spec = config["systems"][name]
+        top_path = os.path.join(config["src_dir"], spec["topology"])
+        xtc_paths = [os.path.join(config["src_dir"], p) for p in spec["trajectories"]]
+        if len(xtc_paths) == 1:
+            systems.append(System(name, xtc_paths[0], top_path, spec["selection"]))
+        else:
+            systems.append(replica_systems(name, xtc_paths, top_path, spec["selection"]))
+    return systems
@@ -0,0 +1,415 @@
+"""Shared residue contact engine.
+
+Contacts are found per frame with a KD-tree over the heavy atoms of the
+matched residues, so the cost scales with the number of atoms actually
+within the cutoff instead of with the number of residue pairs. Explicit pair
+lists can instead go through a batched distance kernel over a precomputed
+CSR index of heavy atoms. Counts are accumulated chunk by chunk, so
+trajectories can be streamed from disk.
+
+The KD-tree handles periodic boundaries only for orthorhombic cells. Chunks
+with a triclinic cell fall back to the batched distance kernel over all
+heavy-atom pairs, which applies the minimum image convention to any cell as
+``md.compute_distances`` does, at O(atoms^2) cost per frame.
+"""
+import itertools
+
+import mdtraj as md
+import numpy as np
+import scipy.sparse
+from scipy.spatial import cKDTree
+
+from analysis.instrument import get_instrumentation
+from analysis.trajectory import DEFAULT_CHUNK_SIZE, iter_protein_chunks
+
+
+# ========== Residue Matching ==========
+def get_residue_dict(topology):
+    return {(res.chain.index, res.resSeq): res for res in topology.residues}
+
+
+def match_residues(topology_bound, topology_unbound):
+    """Return matched (chain, resSeq) keys and the residues of both topologies in that order."""
+    res_dict_bound = get_residue_dict(topology_bound)
+    res_dict_unbound = get_residue_dict(topology_unbound)
+    matched_keys = sorted(set(res_dict_bound) & set(res_dict_unbound))
+    residues_bound = [res_dict_bound[k] for k in matched_keys]
+    residues_unbound = [res_dict_unbound[k] for k in matched_keys]
+    return matched_keys, residues_bound, residues_unbound
+
+
+def format_residue_labels(residues):
+    return [f"{res.name}{res.resSeq}_chain{res.chain.index}" for res in residues]
+
+
+# ========== Heavy-Atom Residue Index ==========
+def heavy_atom_index(residues):
+    """CSR layout of the heavy atoms of `residues`.
+
+    The heavy atoms of ``residues[k]`` are ``atom_indices[offsets[k]:offsets[k + 1]]``.
+    """
+    heavy = [[a.index for a in res.atoms if a.element.symbol != "H"] for res in residues]
+    offsets = np.zeros(len(heavy) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(atoms) for atoms in heavy])
+    atom_indices = np.fromiter(itertools.chain.from_iterable(heavy), dtype=np.int64, count=offsets[-1])
+    return offsets, atom_indices
+
+
+def heavy_atom_residues(residues):
+    """Return heavy-atom indices and, for each, the position of its residue in `residues`."""
+    offsets, atom_indices = heavy_atom_index(residues)
+    return atom_indices, np.repeat(np.arange(len(residues)), np.diff(offsets))
+
+
+def residue_pair_atom_pairs(offsets, atom_indices, pairs):
+    """All heavy-atom pairs of the residue pairs `pairs`, as one array.
+
+    Returns ``(atom_pairs, seg_starts, kept)``: `kept` indexes the rows of
+    `pairs` where both residues have heavy atoms, and the atom pairs of
+    ``pairs[kept[p]]`` are ``atom_pairs[seg_starts[p]:seg_starts[p + 1]]``.
+    """
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+    sizes = np.diff(offsets)
+    size_i, size_j = sizes[pairs[:, 0]], sizes[pairs[:, 1]]
+    kept = np.flatnonzero((size_i > 0) & (size_j > 0))
+    pairs, size_i, size_j = pairs[kept], size_i[kept], size_j[kept]
+
+    seg_sizes = size_i * size_j
+    seg_starts = np.zeros(len(pairs), dtype=np.int64)
+    seg_starts[1:] = np.cumsum(seg_sizes)[:-1]
+    seg = np.repeat(np.arange(len(pairs)), seg_sizes)
+    local = np.arange(seg_sizes.sum()) - seg_starts[seg]
+    atom1 = atom_indices[offsets[pairs[seg, 0]] + local // size_j[seg]]
+    atom2 = atom_indices[offsets[pairs[seg, 1]] + local % size_j[seg]]
+    return np.column_stack([atom1, atom2]), seg_starts, kept
+
+
+# ========== Batched Pair Kernel ==========
+def _segment_batches(seg_starts, n_atom_pairs, max_atom_pairs):
+    """Split segments into runs of roughly `max_atom_pairs` atom pairs; yields (first, last) segments."""
+    seg_ends = np.append(seg_starts[1:], n_atom_pairs)
+    first = 0
+    while first < len(seg_starts):
+        last = np.searchsorted(seg_ends, seg_starts[first] + max_atom_pairs, side="right")
+        last = max(last, first + 1)
+        yield first, last
+        first = last
+
+
+def accumulate_pair_contact_counts(chunks, residues, pairs, cutoff_nm, max_distances=20_000_000,
+                                   label=None):
+    """Contact counts of the residue pairs `pairs` from one batched distance call per block of pairs.
+
+    Per frame, the minimum heavy-atom distance of each residue pair comes from a
+    ``np.minimum.reduceat`` over its atom-pair segment, so this follows
+    ``md.compute_distances`` exactly. At most `max_distances` (frames x atom
+    pairs) distances are held at once. Suited to explicit pair lists; for all
+    pairs the neighbor-list engine is faster. Returns (counts per pair, n_frames).
+    """
+    inst = get_instrumentation()
+    offsets, atom_indices = heavy_atom_index(residues)
+    atom_pairs, seg_starts, kept = residue_pair_atom_pairs(offsets, atom_indices, pairs)
+    counts = np.zeros(len(pairs), dtype=np.int64)
+    n_frames = 0
+
+    chunks = iter(chunks)
+    while True:
+        with inst.stage("read"):
+            chunk = next(chunks, None)
+        if chunk is None:
+            break
+        max_atom_pairs = max(1, max_distances // max(1, chunk.n_frames))
+        for first, last in _segment_batches(seg_starts, len(atom_pairs), max_atom_pairs):
+            start = seg_starts[first]
+            stop = seg_starts[last] if last < len(seg_starts) else len(atom_pairs)
+            with inst.stage("distances"):
+                distances = md.compute_distances(chunk, atom_pairs[start:stop])
+            with inst.stage("segment_reduce"):
+                min_dist = np.minimum.reduceat(distances, seg_starts[first:last] - start, axis=1)
+                counts[kept[first:last]] += np.count_nonzero(min_dist < cutoff_nm, axis=0)
+        n_frames += chunk.n_frames
+        inst.count("frames", chunk.n_frames)
+        inst.count("atom_pair_distances", chunk.n_frames * len(atom_pairs))
+        if label is not None:
+            inst.progress(label, f"Frames processed: {n_frames}")
+    return counts, n_frames
+
+
+def _all_pair_distances(residues):
+    # Heavy-atom pairs of every residue pair (i < j) and the pair codes i * n_res + j of their segments
+    n_res = len(residues)
+    offsets, atom_indices = heavy_atom_index(residues)
+    pairs = np.column_stack(np.triu_indices(n_res, 1))
+    atom_pairs, seg_starts, kept = residue_pair_atom_pairs(offsets, atom_indices, pairs)
+    return atom_pairs, seg_starts, pairs[kept, 0] * n_res + pairs[kept, 1]
+
+
+def periodic_min_distances(chunk, all_pairs, max_cutoff_nm, max_distances=20_000_000):
+    """Per frame of `chunk`, the codes and minimum distances of residue pairs closer than `max_cutoff_nm`.
+
+    `all_pairs` is ``_all_pair_distances(residues)``. Distances come from
+    ``md.compute_distances``, so the minimum image convention holds for
+    triclinic cells too; this is the neighbor engine's path for them. At
+    most `max_distances` distances are held at once.
+    """
+    atom_pairs, seg_starts, codes = all_pairs
+    step = max(1, max_distances // max(1, len(atom_pairs)))
+    results = []
+    for lo in range(0, chunk.n_frames, step):
+        frames = chunk[lo:lo + step]
+        min_dist = np.empty((frames.n_frames, len(codes)), dtype=np.float32)
+        for first, last in _segment_batches(seg_starts, len(atom_pairs), max_distances // frames.n_frames):
+            start = seg_starts[first]
+            stop = seg_starts[last] if last < len(seg_starts) else len(atom_pairs)
+            distances = md.compute_distances(frames, atom_pairs[start:stop])
+            min_dist[:, first:last] = np.minimum.reduceat(distances, seg_starts[first:last] - start, axis=1)
+        results.extend((codes[row < max_cutoff_nm], row[row < max_cutoff_nm]) for row in min_dist)
+    return results
+
+
+# ========== Neighbor-List Contact Engine ==========
+def _orthorhombic_box(traj):
+    # Per-frame box lengths for the KD-tree, None without a unit cell; triclinic cells need periodic_min_distances
+    if traj.unitcell_lengths is None or traj.unitcell_angles is None:
+        return None
+    if not np.allclose(traj.unitcell_angles, 90.0):
+        raise ValueError("The KD-tree search needs an orthorhombic unit cell; use periodic_min_distances")
+    return traj.unitcell_lengths
+
+
+def _is_triclinic(traj):
+    return traj.unitcell_angles is not None and not np.allclose(traj.unitcell_angles, 90.0)
+
+
+def _neighbor_pairs(xyz, cutoff_nm, box=None):
+    # query_pairs is inclusive, compute_distances(...) < cutoff is not
+    r = np.nextafter(cutoff_nm, 0)
+    xyz = np.asarray(xyz, dtype=np.float64)
+    if box is not None:
+        box = np.asarray(box, dtype=np.float64)
+        xyz = xyz - np.floor(xyz / box) * box
+        xyz = np.where(xyz >= box, 0.0, xyz)
+        tree = cKDTree(xyz, boxsize=box)
+    else:
+        tree = cKDTree(xyz)
+    return xyz, tree.query_pairs(r, output_type="ndarray")
+
+
+def _frame_contacts(xyz, atom_residue, n_res, cutoff_nm, box=None):
+    _, atom_pairs = _neighbor_pairs(xyz, cutoff_nm, box)
+    res_i = atom_residue[atom_pairs[:, 0]]
+    res_j = atom_residue[atom_pairs[:, 1]]
+    inter = res_i != res_j
+    lo = np.minimum(res_i[inter], res_j[inter])
+    hi = np.maximum(res_i[inter], res_j[inter])
+    return np.unique(lo * n_res + hi), len(atom_pairs)
+
+
+def frame_contact_codes(xyz, atom_residue, n_res, cutoff_nm, box=None):
+    """Return the sorted, unique codes i * n_res + j (i < j) of residue pairs in contact in one frame.
+
+    `box` enables the minimum image convention for orthorhombic cells, matching
+    ``md.compute_distances(..., periodic=True)``; it cannot describe a
+    triclinic cell (see ``periodic_min_distances``).
+    """
+    return _frame_contacts(xyz, atom_residue, n_res, cutoff_nm, box)[0]
+
+
+def accumulate_contact_counts(chunks, residues, cutoff_nm, label=None, on_chunk=None):
+    """Running residue-pair contact counts over an iterable of trajectory chunks.
+
+    Only the (n_res, n_res) upper-triangular count matrix is kept between
+    chunks. `on_chunk`, if given, is called with the list of per-frame
+    contact codes of every chunk. Chunks with a triclinic unit cell go
+    through ``periodic_min_distances`` instead of the KD-tree. Returns the
+    counts and the number of frames seen.
+    """
+    inst = get_instrumentation()
+    n_res = len(residues)
+    atom_indices, atom_residue = heavy_atom_residues(residues)
+    counts = np.zeros(n_res * n_res, dtype=np.int64)
+    n_frames = 0
+    all_pairs = None
+
+    chunks = iter(chunks)
+    while True:
+        with inst.stage("read"):
+            chunk = next(chunks, None)
+        if chunk is None:
+            break
+        with inst.stage("neighbor_search"):
+            codes = []
+            n_atom_pairs = 0
+            if _is_triclinic(chunk):
+                all_pairs = all_pairs or _all_pair_distances(residues)
+                codes = [frame_codes for frame_codes, _ in periodic_min_distances(chunk, all_pairs, cutoff_nm)]
+            else:
+                box = _orthorhombic_box(chunk)
+                for f in range(chunk.n_frames):
+                    frame_codes, n_pairs = _frame_contacts(chunk.xyz[f, atom_indices], atom_residue, n_res,
+                                                           cutoff_nm, None if box is None else box[f])
+                    codes.append(frame_codes)
+                    n_atom_pairs += n_pairs
+            if on_chunk is not None:
+                on_chunk(codes)
+            if codes:
+                codes = np.concatenate(codes)
+                counts += np.bincount(codes, minlength=n_res * n_res)
+        n_frames += chunk.n_frames
+        inst.count("frames", chunk.n_frames)
+        inst.count("atom_pairs_within_cutoff", n_atom_pairs)
+        inst.count("residue_contacts", len(codes))
+        if label is not None:
+            inst.progress(label, f"Frames processed: {n_frames}")
+    return counts.reshape(n_res, n_res), n_frames
+
+
+def frame_min_distances(xyz, atom_residue, n_res, max_cutoff_nm, box=None):
+    """Minimum heavy-atom distance of every residue pair closer than `max_cutoff_nm` in one frame.
+
+    `box` gives orthorhombic cell lengths, as in ``frame_contact_codes``.
+    Returns the sorted pair codes i * n_res + j (i < j), their minimum
+    distances and the number of atom pairs within the cutoff.
+    """
+    xyz, atom_pairs = _neighbor_pairs(xyz, max_cutoff_nm, box)
+    res_i = atom_residue[atom_pairs[:, 0]]
+    res_j = atom_residue[atom_pairs[:, 1]]
+    inter = res_i != res_j
+    if not inter.any():
+        return np.zeros(0, dtype=np.int64), np.zeros(0), len(atom_pairs)
+    delta = xyz[atom_pairs[inter, 0]] - xyz[atom_pairs[inter, 1]]
+    if box is not None:
+        delta -= box * np.round(delta / box)
+    distances = np.sqrt(np.einsum("ij,ij->i", delta, delta))
+    codes = np.minimum(res_i[inter], res_j[inter]) * n_res + np.maximum(res_i[inter], res_j[inter])
+    order = np.argsort(codes, kind="stable")
+    codes, distances = codes[order], distances[order]
+    starts = np.flatnonzero(np.concatenate([[True], codes[1:] != codes[:-1]]))
+    return codes[starts], np.minimum.reduceat(distances, starts), len(atom_pairs)
+
+
+def accumulate_distance_histogram(chunks, residues, edges, label=None):
+    """Per-pair histogram of the per-frame minimum heavy-atom distance over an iterable of chunks.
+
+    `edges` are ascending cutoffs in nm. Bin b of pair (i, j) counts the
+    frames with ``edges[b - 1] <= d < edges[b]`` (bin 0: ``d < edges[0]``),
+    so the contact count at cutoff ``edges[m]`` is the sum of bins 0..m.
+    Frames with ``d >= edges[-1]`` are not stored. Triclinic chunks use
+    ``periodic_min_distances``. Returns a sparse
+    (n_res * n_res, len(edges)) CSR matrix indexed by pair code, and the
+    number of frames seen.
+    """
+    inst = get_instrumentation()
+    edges = np.asarray(edges, dtype=np.float64)
+    n_res = len(residues)
+    atom_indices, atom_residue = heavy_atom_residues(residues)
+    shape = (n_res * n_res, len(edges))
+    hist = scipy.sparse.csr_matrix(shape, dtype=np.int64)
+    n_frames = 0
+    all_pairs = None
+
+    chunks = iter(chunks)
+    while True:
+        with inst.stage("read"):
+            chunk = next(chunks, None)
+        if chunk is None:
+            break
+        with inst.stage("neighbor_search"):
+            codes, bins = [], []
+            n_atom_pairs = 0
+            if _is_triclinic(chunk):
+                all_pairs = all_pairs or _all_pair_distances(residues)
+                for frame_codes, min_dist in periodic_min_distances(chunk, all_pairs, edges[-1]):
+                    codes.append(frame_codes)
+                    bins.append(np.searchsorted(edges, min_dist, side="right"))
+            else:
+                box = _orthorhombic_box(chunk)
+                for f in range(chunk.n_frames):
+                    frame_codes, min_dist, n_pairs = frame_min_distances(
+                        chunk.xyz[f, atom_indices], atom_residue, n_res, edges[-1],
+                        None if box is None else box[f])
+                    codes.append(frame_codes)
+                    bins.append(np.searchsorted(edges, min_dist, side="right"))
+                    n_atom_pairs += n_pairs
+        with inst.stage("histogram"):
+            codes, bins = np.concatenate(codes), np.concatenate(bins)
+            kept = bins < len(edges)
+            hist = hist + scipy.sparse.coo_matrix((np.ones(np.count_nonzero(kept), dtype=np.int64),
+                                                   (codes[kept], bins[kept])), shape=shape).tocsr()
+        n_frames += chunk.n_frames
+        inst.count("frames", chunk.n_frames)
+        inst.count("atom_pairs_within_cutoff", n_atom_pairs)
+        if label is not None:
+            inst.progress(label, f"Frames processed: {n_frames}")
+    return hist, n_frames
+
+
+def contact_counts(traj, residues, cutoff_nm, label=None):
+    """Count, for every residue pair, the frames in which any heavy atoms are within `cutoff_nm`.
+
+    Returns an (n_res, n_res) upper-triangular integer matrix.
+    """
+    return accumulate_contact_counts([traj], residues, cutoff_nm, label)[0]
+
+
+def contact_occupancy_matrix(traj, residues, cutoff_nm, label=None):
+    """Return the (n_res, n_res) upper-triangular contact occupancy matrix."""
+    return contact_counts(traj, residues, cutoff_nm, label) / traj.n_frames
+
+
+def stream_contact_counts(xtc_path, top_path, atom_indices, residues, cutoff_nm,
+                          chunk_size=DEFAULT_CHUNK_SIZE, stride=1, label=None, start=0):
+    """Contact counts and frame count of `xtc_path` read in chunks of `chunk_size` frames.
+
+    `residues` must come from the topology sliced to `atom_indices`
+    (see ``load_protein_topology``). Reading begins at raw frame `start`.
+    """
+    if label is not None:
+        print(f"\nComputing contact occupancy ({label})...")
+    chunks = iter_protein_chunks(xtc_path, top_path, atom_indices, chunk_size, stride, start)
+    counts, n_frames = accumulate_contact_counts(chunks, residues, cutoff_nm, label)
+    if n_frames == 0:
+        raise ValueError(f"No frames read from {xtc_path}")
+    if label is not None:
+        print(f"[{label}] Progress: 100% (done)")
+    return counts, n_frames
+
+
+def stream_contact_occupancy(xtc_path, top_path, atom_indices, residues, cutoff_nm,
+                             chunk_size=DEFAULT_CHUNK_SIZE, stride=1, label=None):
+    """Occupancy matrix of `xtc_path` read in chunks of `chunk_size` frames."""
+    counts, n_frames = stream_contact_counts(xtc_path, top_path, atom_indices, residues, cutoff_nm,
+                                             chunk_size, stride, label)
+    return counts / n_frames
+
+
+def occupancy_dict(occ_matrix, pairs=None):
+    """Convert an occupancy matrix into the ``{(i, j): occupancy}`` dict of non-zero pairs."""
+    rows, cols = np.nonzero(np.triu(occ_matrix, 1))
+    occupancies = {(int(i), int(j)): occ_matrix[i, j] for i, j in zip(rows, cols)}
+    if pairs is not None:
+        occupancies = {pair: occupancies[pair] for pair in pairs if pair in occupancies}
+    return occupancies
+
+
+def contact_occupancy_fast(traj, residues, pairs, cutoff_nm, label=None, method="neighbor"):
+    """Contact occupancy of each residue pair in `pairs`; pairs never in contact are omitted.
+
+    `method` is "neighbor" (KD-tree over all heavy atoms, best for all pairs)
+    or "pairs" (batched distances over the atom pairs of `pairs` only). Both
+    apply the minimum image convention to any unit cell, but "neighbor"
+    falls back to all-pairs distances for triclinic cells, so "pairs" is
+    much faster there.
+    """
+    if label is not None:
+        print(f"\nComputing contact occupancy ({label})...")
+    if method == "pairs":
+        counts, n_frames = accumulate_pair_contact_counts([traj], residues, pairs, cutoff_nm, label=label)
+        occ = {tuple(pair): count / n_frames for pair, count in zip(pairs, counts) if count > 0}
+    elif method == "neighbor":
+        occ = occupancy_dict(contact_occupancy_matrix(traj, residues, cutoff_nm, label), pairs)
+    else:
+        raise ValueError(f"Unknown contact method: {method}")
+    if label is not None:
+        print(f"[{label}] Progress: 100% (done)")
+    return occ
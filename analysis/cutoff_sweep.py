@@ -0,0 +1,175 @@
+"""Occupancies for many contact cutoffs from one trajectory pass.
+
+Instead of counting contacts at a single cutoff, one pass records the
+per-frame minimum heavy-atom distance of every residue pair closer than the
+largest cutoff, binned at ``edges``. The contact count of a pair at cutoff
+``edges[m]`` is then the cumulative sum of its first m + 1 bins, so every
+cutoff on the grid (by default 0.300-0.600 nm in 0.005 nm steps) is
+available from the cached histogram without touching the trajectory again.
+
+Histograms are cached next to the occupancy cache as sparse ``.npz`` files
+keyed by the trajectory fingerprint, topology hash, selection, stride and
+bin edges.
+"""
+import hashlib
+import json
+import os
+from collections import namedtuple
+
+import numpy as np
+
+from analysis.contacts import accumulate_distance_histogram
+from analysis.instrument import get_instrumentation
+from analysis.occupancy import (DEFAULT_CACHE_DIR, System, match_counts, match_replica_counts,
+                                occupancy_cache_key)
+from analysis.parallel import parallel_contact_counts
+from analysis.topology_index import n_residues, topology_index
+from analysis.trajectory import DEFAULT_CHUNK_SIZE, iter_protein_chunks, load_protein_topology
+
+DEFAULT_EDGES = np.round(np.arange(0.300, 0.6001, 0.005), 3)  # nm
+
+DistanceHistogram = namedtuple("DistanceHistogram", ["codes", "counts", "edges", "n_res", "n_frames"])
+
+
+# ========== Cache ==========
+def histogram_cache_path(system, edges, stride=1, cache_dir=DEFAULT_CACHE_DIR):
+    params = [occupancy_cache_key(system, float(edges[-1]), stride), [float(e) for e in edges]]
+    key = hashlib.sha256(json.dumps(params).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f"distance_histogram_{system.name}_{key}.npz")
+
+
+def save_histogram(path, hist, **metadata):
+    """Write the non-empty rows of a ``DistanceHistogram`` to `path` atomically."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez_compressed(f, codes=hist.codes, counts=hist.counts, edges=hist.edges, n_res=hist.n_res,
+                            n_frames=hist.n_frames, metadata=json.dumps(metadata))
+    os.replace(tmp_path, path)
+
+
+def load_histogram(path):
+    with np.load(path) as data:
+        return DistanceHistogram(data["codes"], data["counts"], data["edges"], int(data["n_res"]),
+                                 int(data["n_frames"]))
+
+
+def _to_histogram(sparse_hist, edges, n_res, n_frames):
+    # Keep only the pairs that came within the largest cutoff at least once
+    sparse_hist = sparse_hist.tocsr()
+    codes = np.flatnonzero(np.diff(sparse_hist.indptr))
+    counts = sparse_hist[codes].toarray()
+    dtype = np.int32 if n_frames < 2**31 else np.int64
+    return DistanceHistogram(codes.astype(np.int64), counts.astype(dtype), np.asarray(edges), n_res, n_frames)
+
+
+# ========== Computation ==========
+def system_histograms(systems, edges=DEFAULT_EDGES, stride=1, chunk_size=DEFAULT_CHUNK_SIZE,
+                      cache_dir=DEFAULT_CACHE_DIR, n_workers=1):
+    """Minimum-distance histograms of every system, from the cache when possible.
+
+    Returns a list of (``TopologyIndex``, ``DistanceHistogram``), one per system.
+    """
+    edges = np.sort(np.asarray(edges, dtype=np.float64))
+    inst = get_instrumentation()
+    paths = [histogram_cache_path(system, edges, stride, cache_dir) for system in systems]
+    missing = [system for system, path in zip(systems, paths) if not os.path.exists(path)]
+
+    computed = {}
+    with inst.stage("histogram_compute"):
+        if missing and n_workers > 1:
+            computed = parallel_contact_counts(missing, edges, n_workers, stride, chunk_size,
+                                               accumulate=accumulate_distance_histogram)
+        else:
+            for system in missing:
+                atom_indices, topology = load_protein_topology(system.top_path, system.selection)
+                print(f"\nComputing minimum-distance histogram ({system.name})...")
+                chunks = iter_protein_chunks(system.xtc_path, system.top_path, atom_indices, chunk_size, stride)
+                computed[system.name] = accumulate_distance_histogram(chunks, list(topology.residues), edges,
+                                                                      system.name)
+
+    results = []
+    for system, path in zip(systems, paths):
+        index = topology_index(system.top_path, system.selection)
+        if system.name in computed:
+            sparse_hist, n_frames = computed[system.name]
+            if n_frames == 0:
+                raise ValueError(f"No frames read from {system.xtc_path}")
+            hist = _to_histogram(sparse_hist, edges, n_residues(index), n_frames)
+            save_histogram(path, hist, xtc_path=system.xtc_path, top_path=system.top_path,
+                           selection=system.selection, stride=stride)
+            print(f"[{system.name}] Distance histogram cached to: {path}")
+        else:
+            hist = load_histogram(path)
+            print(f"[{system.name}] Loaded cached distance histogram: {path}")
+        results.append((index, hist))
+    return results
+
+
+# ========== Occupancies from Histograms ==========
+def _edge_index(hist, cutoff_nm):
+    matches = np.flatnonzero(np.isclose(hist.edges, cutoff_nm, rtol=0, atol=1e-9))
+    if len(matches) == 0:
+        raise ValueError(f"Cutoff {cutoff_nm} nm is not one of the histogram edges "
+                         f"({hist.edges[0]}-{hist.edges[-1]} nm)")
+    return matches[0]
+
+
+def histogram_counts(hist, cutoff_nm):
+    """(n_res, n_res) upper-triangular contact counts at `cutoff_nm`, which must be one of the edges."""
+    m = _edge_index(hist, cutoff_nm)
+    counts = np.zeros(hist.n_res * hist.n_res, dtype=np.int64)
+    counts[hist.codes] = hist.counts[:, :m + 1].sum(axis=1)
+    return counts.reshape(hist.n_res, hist.n_res)
+
+
+def histogram_occupancy(hist, cutoff_nm):
+    return histogram_counts(hist, cutoff_nm) / hist.n_frames
+
+
+def contacts_per_frame(hist):
+    """Mean number of residue pairs in contact per frame at every edge."""
+    return np.cumsum(hist.counts.sum(axis=0)) / hist.n_frames
+
+
+def _as_replica_lists(bound, unbound):
+    single = isinstance(bound, System) and isinstance(unbound, System)
+    bound = [bound] if isinstance(bound, System) else list(bound)
+    unbound = [unbound] if isinstance(unbound, System) else list(unbound)
+    return bound, unbound, single
+
+
+def _match_histograms(histograms, n_bound, single, cutoff_nm):
+    results = [(index, histogram_counts(hist, cutoff_nm), hist.n_frames) for index, hist in histograms]
+    if single:
+        return match_counts(*results)
+    return match_replica_counts(results[:n_bound], results[n_bound:])
+
+
+def matched_histogram_occupancies(bound, unbound, cutoff_nm, edges=DEFAULT_EDGES, stride=1,
+                                  chunk_size=DEFAULT_CHUNK_SIZE, cache_dir=DEFAULT_CACHE_DIR, n_workers=1):
+    """Like ``matched_system_occupancies``, but read from the (cached) distance histograms.
+
+    Any `cutoff_nm` on the `edges` grid reuses the same histograms.
+    """
+    bound, unbound, single = _as_replica_lists(bound, unbound)
+    histograms = system_histograms(bound + unbound, edges, stride, chunk_size, cache_dir, n_workers)
+    return _match_histograms(histograms, len(bound), single, cutoff_nm)
+
+
+def cutoff_sweep_summary(bound, unbound, cutoffs, threshold, edges=DEFAULT_EDGES, stride=1,
+                         chunk_size=DEFAULT_CHUNK_SIZE, cache_dir=DEFAULT_CACHE_DIR, n_workers=1):
+    """Per cutoff: mean contacts per frame of both systems and the number of matched pairs changing by more than `threshold`."""
+    bound, unbound, single = _as_replica_lists(bound, unbound)
+    histograms = system_histograms(bound + unbound, edges, stride, chunk_size, cache_dir, n_workers)
+    rows = []
+    for cutoff_nm in cutoffs:
+        occupancy = _match_histograms(histograms, len(bound), single, cutoff_nm)
+        rows.append({
+            "cutoff": float(cutoff_nm),
+            "contacts_bound": float(occupancy.occ_bound.sum()),
+            "contacts_unbound": float(occupancy.occ_unbound.sum()),
+            "changed_pairs": int(np.count_nonzero(np.abs(occupancy.occ_unbound - occupancy.occ_bound)
+                                                  > threshold)),
+        })
+    return rows
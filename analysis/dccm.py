@@ -0,0 +1,182 @@
+"""Dynamic cross-correlation of residue Cα fluctuations.
+
+The covariance C_ij = <Δr_i · Δr_j> of the Cα positions (after
+superposing every frame on the topology structure) is accumulated in one
+streaming pass: each chunk contributes its mean and centered co-moment
+sum_c Y_c^T Y_c over the three coordinates, merged into the running totals
+with the pairwise update of Chan et al. Only an (n_res, n_res) co-moment
+and an (n_res, 3) mean are kept, so memory does not grow with the number
+of frames and the frames x 3N coordinate matrix is never formed. Replicas
+merge the same way, and the per-trajectory moments are cached.
+
+The normalized DCCM_ij = C_ij / sqrt(C_ii C_jj) can be combined with the
+contact graph into a correlation-weighted network.
+"""
+import hashlib
+import json
+import os
+from collections import namedtuple
+
+import mdtraj as md
+import numpy as np
+import scipy.sparse
+
+from analysis.instrument import get_instrumentation
+from analysis.occupancy import CACHE_VERSION, DEFAULT_CACHE_DIR, System, file_hash, trajectory_fingerprint
+from analysis.trajectory import DEFAULT_CHUNK_SIZE, calpha_atoms, iter_protein_chunks
+
+NETWORK_WEIGHTS = ("correlation", "occupancy_correlation")
+
+# Running moments of the Cα coordinates: frames seen, (n, 3) mean and (n, n) co-moment
+CovarianceMoments = namedtuple("CovarianceMoments", ["n_frames", "mean", "comoment"])
+ResidueDccm = namedtuple("ResidueDccm", ["residues", "covariance", "dccm", "n_frames"])
+
+
+# ========== Streaming Covariance ==========
+def merge_covariance(moments, other):
+    """Combine two ``CovarianceMoments`` (either may be None) as if their frames were pooled."""
+    if moments is None:
+        return other
+    if other is None:
+        return moments
+    n, k = moments.n_frames, other.n_frames
+    n_new = n + k
+    delta = other.mean - moments.mean
+    comoment = moments.comoment + other.comoment + (delta @ delta.T) * (n * k / n_new)
+    return CovarianceMoments(n_new, moments.mean + delta * (k / n_new), comoment)
+
+
+def chunk_covariance(xyz):
+    """``CovarianceMoments`` of one (n_frames, n_atoms, 3) block of coordinates."""
+    mean = xyz.mean(axis=0)
+    centered = xyz - mean
+    comoment = sum(centered[:, :, c].T @ centered[:, :, c] for c in range(3))
+    return CovarianceMoments(len(xyz), mean, comoment)
+
+
+def accumulate_covariance(chunks, reference, label=None):
+    """Streaming ``CovarianceMoments`` of superposed `chunks`; frames are fitted onto `reference`."""
+    inst = get_instrumentation()
+    moments = None
+    chunks = iter(chunks)
+    while True:
+        with inst.stage("read"):
+            chunk = next(chunks, None)
+        if chunk is None:
+            break
+        with inst.stage("superpose"):
+            chunk.superpose(reference)
+        with inst.stage("covariance"):
+            moments = merge_covariance(moments, chunk_covariance(chunk.xyz.astype(np.float64)))
+        inst.count("frames", chunk.n_frames)
+        if label is not None:
+            inst.progress(label, f"Frames processed: {moments.n_frames}")
+    return moments
+
+
+def compute_covariance(system, stride=1, chunk_size=DEFAULT_CHUNK_SIZE, label=None):
+    """Streaming ``CovarianceMoments`` of one system's Cα atoms."""
+    atom_indices, _ = calpha_atoms(system.top_path, system.selection)
+    reference = md.load(system.top_path, atom_indices=atom_indices)
+    chunks = iter_protein_chunks(system.xtc_path, system.top_path, atom_indices, chunk_size, stride)
+    moments = accumulate_covariance(chunks, reference, label)
+    if moments is None:
+        raise ValueError(f"No frames read from {system.xtc_path}")
+    return moments
+
+
+# ========== Cache ==========
+def covariance_cache_path(system, stride=1, cache_dir=DEFAULT_CACHE_DIR):
+    params = {
+        "version": CACHE_VERSION,
+        "trajectory": trajectory_fingerprint(system.xtc_path),
+        "topology": file_hash(system.top_path),
+        "selection": system.selection,
+        "stride": int(stride),
+    }
+    key = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f"calpha_covariance_{system.name}_{key}.npz")
+
+
+def save_covariance(path, moments, **metadata):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, n_frames=moments.n_frames, mean=moments.mean, comoment=moments.comoment,
+                 metadata=json.dumps(metadata))
+    os.replace(tmp_path, path)
+
+
+def load_covariance(path):
+    with np.load(path) as data:
+        return CovarianceMoments(int(data["n_frames"]), data["mean"], data["comoment"])
+
+
+def system_covariance(systems, stride=1, chunk_size=DEFAULT_CHUNK_SIZE, cache_dir=DEFAULT_CACHE_DIR):
+    """Cα ``CovarianceMoments`` pooled over `systems` (one ``System`` or its replicas), cached per trajectory."""
+    systems = [systems] if isinstance(systems, System) else list(systems)
+    pooled = None
+    with get_instrumentation().stage("dccm_compute"):
+        for system in systems:
+            path = covariance_cache_path(system, stride, cache_dir)
+            if os.path.exists(path):
+                moments = load_covariance(path)
+                print(f"[{system.name}] Loaded cached Cα covariance: {path}")
+            else:
+                print(f"\nComputing Cα covariance ({system.name})...")
+                moments = compute_covariance(system, stride, chunk_size, system.name)
+                save_covariance(path, moments, xtc_path=system.xtc_path, top_path=system.top_path,
+                                selection=system.selection, stride=stride)
+                print(f"[{system.name}] Cα covariance over {moments.n_frames} frames cached to: {path}")
+            if pooled is not None and pooled.mean.shape != moments.mean.shape:
+                raise ValueError("All replicas of a condition must have the same Cα atoms")
+            pooled = merge_covariance(pooled, moments)
+    return pooled
+
+
+# ========== DCCM ==========
+def normalized_dccm(moments):
+    """(covariance, DCCM) of ``CovarianceMoments``; atoms that never move get zero correlation."""
+    covariance = moments.comoment / moments.n_frames
+    scale = np.sqrt(np.diag(covariance))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dccm = covariance / np.outer(scale, scale)
+    return covariance, np.nan_to_num(dccm, nan=0.0, posinf=0.0, neginf=0.0)
+
+
+def residue_dccm(systems, stride=1, chunk_size=DEFAULT_CHUNK_SIZE, cache_dir=DEFAULT_CACHE_DIR):
+    """``ResidueDccm`` of a system or replica ensemble; `residues` are positions in the selection's residues."""
+    reference = systems if isinstance(systems, System) else systems[0]
+    moments = system_covariance(systems, stride, chunk_size, cache_dir)
+    covariance, dccm = normalized_dccm(moments)
+    return ResidueDccm(calpha_atoms(reference.top_path, reference.selection)[1], covariance, dccm, moments.n_frames)
+
+
+def matched_dccm(result, residues):
+    """DCCM restricted to matched `residues` (e.g. ``occupancy.residues_bound``); residues without a Cα get 0."""
+    position = np.full(max(result.residues.max(), max(res.index for res in residues)) + 1, -1)
+    position[result.residues] = np.arange(len(result.residues))
+    rows = position[[res.index for res in residues]]
+    matrix = np.zeros((len(residues), len(residues)))
+    present = np.flatnonzero(rows >= 0)
+    matrix[np.ix_(present, present)] = result.dccm[np.ix_(rows[present], rows[present])]
+    return matrix
+
+
+def correlation_network(dccm, occ_matrix, threshold, weight="correlation"):
+    """Symmetric CSR network on the contact edges (occupancy above `threshold`) weighted by |DCCM|.
+
+    With `weight` "occupancy_correlation" each edge is occupancy x |DCCM|.
+    """
+    if weight not in NETWORK_WEIGHTS:
+        raise ValueError(f"Unknown network weight: {weight}")
+    rows, cols = np.nonzero(np.triu(occ_matrix, 1) > threshold)
+    weights = np.abs(dccm[rows, cols])
+    if weight == "occupancy_correlation":
+        weights = weights * occ_matrix[rows, cols]
+    kept = weights > 0
+    rows, cols, weights = rows[kept], cols[kept], weights[kept]
+    n_res = occ_matrix.shape[0]
+    return scipy.sparse.coo_matrix((np.concatenate([weights, weights]),
+                                    (np.concatenate([rows, cols]), np.concatenate([cols, rows]))),
+                                   shape=(n_res, n_res)).tocsr()
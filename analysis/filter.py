@@ -1,87 +1,119 @@
 from sklearn.decomposition import PCA
-import mdtraj as md
-import os
 import itertools
-import numpy as np
+import os
 import time
 
-# ========== Start Timer ==========
-start_time = time.time()
+from analysis.adaptive import adaptive_sampling
+from analysis.contacts import format_residue_labels, occupancy_dict
+from analysis.fingerprints import system_fingerprints
+from analysis.instrument import enable_instrumentation, get_instrumentation
+from analysis.occupancy import gr_replica_systems, gr_systems, matched_system_occupancies
+from analysis.significance import contact_difference_significance, significance_dict
 
 # ========== Parameters ==========
 cutoff = 0.4  # nm
 threshold = 0.5  # contact difference threshold
 min_residue_separation = 11  # must be more than 10 residues apart
+chunk_size = 500  # frames held in memory at once
+n_workers = os.cpu_count() or 1  # processes for uncached occupancy
+incremental = False  # only read frames appended to the trajectories since the last run
+adaptive = False  # sample both systems' frame blocks until changes near `threshold` converge (analysis.adaptive)
+replicas = None  # e.g. {"bound": ["md_skip_gr_ligand_1.xtc", ...], "unbound": [...]} in src/
+report_path = None  # e.g. "run_report.json" for per-stage timings and counters
+profile_run = False  # add cProfile output to the report
+trace_memory = False  # add tracemalloc peaks to the report
+write_fingerprints = False  # also cache per-frame bit-packed contact fingerprints of both systems
+significance_test = None  # "bootstrap" or "permutation": also require an FDR-significant change
+n_blocks = 20  # trajectory blocks resampled by the significance test
+n_resamples = 2000  # bootstrap resamples or permutations
+fdr_alpha = 0.05  # Benjamini-Hochberg false discovery rate
+output_path = "significant_long_range_pairs.txt"
 
-# ========== Paths ==========
-script_dir = os.path.dirname(os.path.abspath(__file__))
-src_dir = os.path.join(script_dir, "..", "src")
-
-# ========== Load Trajectories ==========
-traj_bound = md.load(os.path.join(src_dir, "md_skip_gr_ligand.xtc"),
-                     top=os.path.join(src_dir, "gr_ligand.pdb"))
-traj_unbound = md.load(os.path.join(src_dir, "md_skip_gr_only.xtc"),
-                       top=os.path.join(src_dir, "gr_only.pdb"))
-
-# ========== Chain Selection ==========
-protein_bound = traj_bound.atom_slice(traj_bound.topology.select("protein and chainid 1"))
-protein_unbound = traj_unbound.atom_slice(traj_unbound.topology.select("protein and chainid 0"))
-
-# ========== Residue Matching ==========
-def get_residue_dict(topology):
-    return {(res.chain.index, res.resSeq): res for res in topology.residues}
-
-res_dict_bound = get_residue_dict(protein_bound.topology)
-res_dict_unbound = get_residue_dict(protein_unbound.topology)
-matched_keys = sorted(set(res_dict_bound.keys()) & set(res_dict_unbound.keys()))
-residues_bound = [res_dict_bound[k] for k in matched_keys]
-residues_unbound = [res_dict_unbound[k] for k in matched_keys]
-residue_labels = [f"{res.name}{res.resSeq}_chain{res.chain.index}" for res in residues_bound]
-residue_pairs = list(itertools.combinations(range(len(matched_keys)), 2))
-
-# ========== Contact Occupancy ==========
-def contact_occupancy_fast(traj, residues, pairs, cutoff_nm):
-    n_frames = traj.n_frames
-    occupancies = {}
-    total = len(pairs)
-    progress_interval = max(1, total // 100)  # Every 1%
-
-    for idx, (i, j) in enumerate(pairs):
-        if idx % progress_interval == 0:
-            print(f"Progress: {idx * 100 // total}%")
-
-        atoms1 = [a.index for a in residues[i].atoms if a.element.symbol != "H"]
-        atoms2 = [a.index for a in residues[j].atoms if a.element.symbol != "H"]
-        if not atoms1 or not atoms2:
-            continue
-        atom_pairs = np.array(list(itertools.product(atoms1, atoms2)))
-        distances = md.compute_distances(traj, atom_pairs)
-        contact_frames = np.any(distances < cutoff_nm, axis=1)
-        occupancy = np.sum(contact_frames) / n_frames
-        if occupancy > 0:
-            occupancies[(i, j)] = occupancy
-    return occupancies
-
-occ_bound = contact_occupancy_fast(protein_bound, residues_bound, residue_pairs, cutoff)
-occ_unbound = contact_occupancy_fast(protein_unbound, residues_unbound, residue_pairs, cutoff)
 
 # ========== Identify Significant Long-Range Contact Changes ==========
-significant_long_range = []
-for (i, j) in residue_pairs:
-    if abs(i - j) >= min_residue_separation:
-        occ_b = occ_bound.get((i, j), 0.0)
-        occ_u = occ_unbound.get((i, j), 0.0)
-        delta = abs(occ_u - occ_b)
-        if delta > threshold:
-            significant_long_range.append((i, j, delta))
+def significant_long_range_pairs(occupancy, threshold=threshold,
+                                 min_residue_separation=min_residue_separation, pair_tests=None):
+    """(i, j, |delta|) of matched pairs at least `min_residue_separation` apart whose occupancy changes by more than `threshold`.
+
+    With `pair_tests` (from ``significance_dict``) a pair must also be FDR significant.
+    """
+    residue_pairs = list(itertools.combinations(range(len(occupancy.matched_keys)), 2))
+    occ_bound = occupancy_dict(occupancy.occ_bound, residue_pairs)
+    occ_unbound = occupancy_dict(occupancy.occ_unbound, residue_pairs)
+    with get_instrumentation().stage("filter"):
+        significant_long_range = []
+        for (i, j) in residue_pairs:
+            if abs(i - j) >= min_residue_separation:
+                occ_b = occ_bound.get((i, j), 0.0)
+                occ_u = occ_unbound.get((i, j), 0.0)
+                delta = abs(occ_u - occ_b)
+                if delta > threshold and (pair_tests is None or pair_tests[(i, j)][2]):
+                    significant_long_range.append((i, j, delta))
+    return significant_long_range
+
 
 # ========== Output ==========
-output_path = "significant_long_range_pairs.txt"
-with open(output_path, "w") as f:
-    f.write("Index1\tIndex2\tDelta\tLabel1\tLabel2\n")
-    for i, j, delta in sorted(significant_long_range, key=lambda x: -x[2]):
-        f.write(f"{i}\t{j}\t{delta:.3f}\t{residue_labels[i]}\t{residue_labels[j]}\n")
-
-# ========== End Timer ==========
-end_time = time.time()
-print(f"Finished in {end_time - start_time:.2f} seconds. Output saved to {output_path}")
+def write_long_range_pairs(significant_long_range, occupancy, output_path=output_path, pair_tests=None):
+    """Tab-separated pair list, strongest change first; p/q-values and replica spread are added when available."""
+    residue_labels = format_residue_labels(occupancy.residues_bound)
+    has_replicas = hasattr(occupancy, "replicas_bound")
+    with open(output_path, "w") as f:
+        header = ["Index1", "Index2", "Delta", "Label1", "Label2"]
+        if pair_tests is not None:
+            header += ["PValue", "QValue"]
+        if has_replicas:
+            header += ["SpreadBound", "SpreadUnbound"]
+        f.write("\t".join(header) + "\n")
+        for i, j, delta in sorted(significant_long_range, key=lambda x: -x[2]):
+            line = f"{i}\t{j}\t{delta:.3f}\t{residue_labels[i]}\t{residue_labels[j]}"
+            if pair_tests is not None:
+                pvalue, qvalue, _ = pair_tests[(i, j)]
+                line += f"\t{pvalue:.4g}\t{qvalue:.4g}"
+            if has_replicas:
+                line += (f"\t{occupancy.replicas_bound.spread[i, j]:.3f}"
+                         f"\t{occupancy.replicas_unbound.spread[i, j]:.3f}")
+            f.write(line + "\n")
+    return output_path
+
+
+def main():
+    # ========== Start Timer ==========
+    start_time = time.time()
+
+    # ========== Instrumentation ==========
+    inst = enable_instrumentation(profile_run, trace_memory) if report_path else get_instrumentation()
+
+    # ========== Contact Occupancy (cached) ==========
+    bound, unbound = gr_replica_systems(replicas["bound"], replicas["unbound"]) if replicas else gr_systems()
+    sampling = adaptive_sampling(threshold, criterion="difference") if adaptive else None
+    occupancy = matched_system_occupancies(bound, unbound, cutoff, chunk_size=chunk_size,
+                                           n_workers=n_workers, incremental=incremental, adaptive=sampling)
+
+    # ========== Contact Fingerprints (optional) ==========
+    if write_fingerprints:
+        for system in (bound + unbound if replicas else [bound, unbound]):
+            system_fingerprints(system, cutoff, chunk_size=chunk_size)
+
+    # ========== Block-Resampling Significance (optional) ==========
+    pair_tests = None
+    if significance_test:
+        significance = contact_difference_significance(bound, unbound, occupancy, cutoff,
+                                                       chunk_size=chunk_size, method=significance_test,
+                                                       n_blocks=n_blocks, n_resamples=n_resamples,
+                                                       alpha=fdr_alpha)
+        pair_tests = significance_dict(significance)
+
+    significant_long_range = significant_long_range_pairs(occupancy, threshold, min_residue_separation,
+                                                          pair_tests)
+    write_long_range_pairs(significant_long_range, occupancy, output_path, pair_tests)
+
+    # ========== End Timer ==========
+    end_time = time.time()
+    print(f"Finished in {end_time - start_time:.2f} seconds. Output saved to {output_path}")
+
+    if report_path:
+        inst.write_report(report_path)
+
+
+if __name__ == "__main__":
+    main()
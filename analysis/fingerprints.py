@@ -0,0 +1,239 @@
+"""Frame-resolved residue contacts stored as bit-packed fingerprints.
+
+Occupancy matrices average the contacts over the trajectory. A fingerprint
+keeps one bit per frame for every residue pair that is in contact at least
+once: row k of the ``(n_pairs, ceil(n_frames / 8))`` uint8 array is
+``np.packbits`` of pair k's contact time series (first frame in the most
+significant bit). A 100k-frame trajectory with a few thousand contacting
+pairs takes tens of MB, and occupancies, block averages, contact lifetimes
+and pair co-occurrence are derived from it with bitwise operations and
+popcounts instead of another trajectory pass.
+
+The bits are written to ``{base}.bits.npy`` (memory-mappable), the residue
+pairs of the rows to ``{base}.pairs.npy`` and the run parameters to a
+``{base}.json`` sidecar.
+"""
+import json
+import os
+from collections import namedtuple
+
+import numpy as np
+
+from analysis.contacts import accumulate_contact_counts
+from analysis.instrument import get_instrumentation
+from analysis.occupancy import DEFAULT_CACHE_DIR, occupancy_cache_key, system_occupancy
+from analysis.trajectory import DEFAULT_CHUNK_SIZE, count_frames, iter_protein_chunks, load_protein_topology
+
+Fingerprints = namedtuple("Fingerprints", ["bits", "pairs", "n_frames", "metadata"])
+
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def popcount(bits, axis=-1):
+    """Number of set bits of a uint8 array, summed along `axis`."""
+    if hasattr(np, "bitwise_count"):
+        ones = np.bitwise_count(bits)
+    else:
+        ones = _POPCOUNT[bits]
+    return ones.sum(axis=axis, dtype=np.int64)
+
+
+# ========== Writing ==========
+class FingerprintWriter:
+    """Fill a fingerprint file chunk by chunk from per-frame contact codes.
+
+    `pair_codes` are the sorted ``i * n_res + j`` codes of the pairs to
+    record; contacts of any other pair are ignored. Frames that do not fill
+    a whole byte are held back until the next chunk.
+    """
+
+    def __init__(self, base, pair_codes, n_res, n_frames, **params):
+        self.base = base
+        self.pair_codes = np.asarray(pair_codes, dtype=np.int64)
+        self.n_res = n_res
+        self.n_frames = n_frames
+        self.params = params
+        self.frames_written = 0
+        os.makedirs(os.path.dirname(base) or ".", exist_ok=True)
+        self._tmp_path = base + ".bits.tmp.npy"
+        self.bits = np.lib.format.open_memmap(self._tmp_path, mode="w+", dtype=np.uint8,
+                                              shape=(len(self.pair_codes), -(-n_frames // 8)))
+        self._pending = np.zeros((len(self.pair_codes), 0), dtype=bool)
+        self._byte = 0
+
+    def add_frames(self, frame_codes):
+        """Record one chunk, given as a list of per-frame contact code arrays."""
+        n_chunk = len(frame_codes)
+        if self.frames_written + n_chunk > self.n_frames:
+            raise ValueError(f"More than the expected {self.n_frames} frames were written")
+        block = np.zeros((len(self.pair_codes), n_chunk), dtype=bool)
+        if n_chunk and len(self.pair_codes):
+            codes = np.concatenate(frame_codes)
+            frames = np.repeat(np.arange(n_chunk), [len(c) for c in frame_codes])
+            rows = np.minimum(np.searchsorted(self.pair_codes, codes), len(self.pair_codes) - 1)
+            kept = self.pair_codes[rows] == codes
+            block[rows[kept], frames[kept]] = True
+        self.frames_written += n_chunk
+
+        block = np.concatenate([self._pending, block], axis=1)
+        n_full = block.shape[1] // 8 * 8
+        self._write(block[:, :n_full])
+        self._pending = block[:, n_full:]
+
+    def _write(self, block):
+        packed = np.packbits(block, axis=1)
+        self.bits[:, self._byte:self._byte + packed.shape[1]] = packed
+        self._byte += packed.shape[1]
+
+    def close(self):
+        """Flush the remaining frames and move the finished files into place."""
+        if self.frames_written != self.n_frames:
+            raise ValueError(f"Expected {self.n_frames} frames, got {self.frames_written}")
+        if self._pending.shape[1]:
+            self._write(self._pending)
+        self.bits.flush()
+        del self.bits
+        pairs = np.column_stack(np.divmod(self.pair_codes, self.n_res)).astype(np.int32)
+        np.save(self.base + ".pairs.npy", pairs)
+        with open(self.base + ".json", "w") as f:
+            json.dump({"n_frames": self.n_frames, "n_res": self.n_res, "n_pairs": len(pairs),
+                       "params": self.params}, f)
+        # The bits go last so that an existing .bits.npy always has its sidecars
+        os.replace(self._tmp_path, self.base + ".bits.npy")
+
+
+def write_fingerprints(base, system, pair_codes, cutoff_nm, stride=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Stream `system`'s trajectory once and write the fingerprints of `pair_codes` to `base`."""
+    atom_indices, topology = load_protein_topology(system.top_path, system.selection)
+    residues = list(topology.residues)
+    n_frames = -(-count_frames(system.xtc_path) // stride)
+    writer = FingerprintWriter(base, pair_codes, len(residues), n_frames, xtc_path=system.xtc_path,
+                               top_path=system.top_path, selection=system.selection,
+                               cutoff=cutoff_nm, stride=stride)
+    with get_instrumentation().stage("fingerprints"):
+        chunks = iter_protein_chunks(system.xtc_path, system.top_path, atom_indices, chunk_size, stride)
+        print(f"\nWriting contact fingerprints ({system.name})...")
+        accumulate_contact_counts(chunks, residues, cutoff_nm, system.name, on_chunk=writer.add_frames)
+        writer.close()
+    print(f"[{system.name}] Fingerprints saved to: {base}.bits.npy")
+
+
+def fingerprint_cache_base(system, cutoff_nm, stride=1, cache_dir=DEFAULT_CACHE_DIR):
+    key = occupancy_cache_key(system, cutoff_nm, stride)
+    return os.path.join(cache_dir, f"fingerprint_{system.name}_{key}")
+
+
+def system_fingerprints(system, cutoff_nm, stride=1, chunk_size=DEFAULT_CHUNK_SIZE,
+                        cache_dir=DEFAULT_CACHE_DIR):
+    """Fingerprints of every pair of `system` that is ever in contact, from the cache when possible.
+
+    The pairs are taken from the cached occupancy, so at most one extra
+    trajectory pass is made.
+    """
+    base = fingerprint_cache_base(system, cutoff_nm, stride, cache_dir)
+    if not os.path.exists(base + ".bits.npy"):
+        _, occ = system_occupancy(system, cutoff_nm, stride, chunk_size, cache_dir)
+        pair_codes = np.flatnonzero(np.triu(occ, 1) > 0)
+        write_fingerprints(base, system, pair_codes, cutoff_nm, stride, chunk_size)
+    return load_fingerprints(base)
+
+
+def load_fingerprints(base, mmap_mode="r"):
+    """Read fingerprints written by ``FingerprintWriter``; the bits are memory-mapped by default."""
+    bits = np.load(base + ".bits.npy", mmap_mode=mmap_mode)
+    pairs = np.load(base + ".pairs.npy")
+    with open(base + ".json") as f:
+        metadata = json.load(f)
+    return Fingerprints(bits, pairs, metadata["n_frames"], metadata)
+
+
+# ========== Derived Quantities ==========
+def _row_blocks(n_rows, block_rows):
+    for start in range(0, n_rows, block_rows):
+        yield slice(start, min(start + block_rows, n_rows))
+
+
+def contact_frames(fp, block_rows=4096):
+    """Number of frames each pair is in contact."""
+    counts = np.zeros(len(fp.pairs), dtype=np.int64)
+    for rows in _row_blocks(len(fp.pairs), block_rows):
+        counts[rows] = popcount(np.asarray(fp.bits[rows]))
+    return counts
+
+
+def fingerprint_occupancy(fp, n_res=None):
+    """Per-pair occupancy, or the (n_res, n_res) upper-triangular matrix if `n_res` is given."""
+    occ = contact_frames(fp) / fp.n_frames
+    if n_res is None:
+        return occ
+    matrix = np.zeros((n_res, n_res))
+    matrix[fp.pairs[:, 0], fp.pairs[:, 1]] = occ
+    return matrix
+
+
+def block_occupancy(fp, block_frames):
+    """Occupancy of each pair in consecutive blocks of `block_frames` frames (a multiple of 8).
+
+    Returns an (n_pairs, n_blocks) array; the last block may be shorter.
+    """
+    if block_frames % 8:
+        raise ValueError("block_frames must be a multiple of 8")
+    block_bytes = block_frames // 8
+    n_blocks = -(-fp.bits.shape[1] // block_bytes)
+    result = np.zeros((len(fp.pairs), n_blocks))
+    sizes = np.minimum(block_frames, fp.n_frames - np.arange(n_blocks) * block_frames)
+    for b in range(n_blocks):
+        block = np.asarray(fp.bits[:, b * block_bytes:(b + 1) * block_bytes])
+        result[:, b] = popcount(block) / sizes[b]
+    return result
+
+
+def _episode_starts(bits):
+    # A frame starts an episode if it is in contact and the previous frame is not;
+    # the previous frame's bit is one to the left, across byte boundaries
+    carry = np.zeros_like(bits)
+    carry[:, 1:] = (bits[:, :-1] & 1) << 7
+    return bits & ~((bits >> 1) | carry)
+
+
+def contact_episodes(fp, block_rows=4096):
+    """Number of separate contact episodes (runs of consecutive contact frames) of each pair."""
+    episodes = np.zeros(len(fp.pairs), dtype=np.int64)
+    for rows in _row_blocks(len(fp.pairs), block_rows):
+        episodes[rows] = popcount(_episode_starts(np.asarray(fp.bits[rows])))
+    return episodes
+
+
+def mean_lifetimes(fp):
+    """Mean contact lifetime of each pair, in (strided) frames; 0 for pairs never in contact."""
+    frames = contact_frames(fp)
+    episodes = contact_episodes(fp)
+    return np.divide(frames, episodes, out=np.zeros(len(frames)), where=episodes > 0)
+
+
+def contact_lifetimes(fp, row):
+    """Lengths, in frames, of all contact episodes of the pair in fingerprint row `row`."""
+    series = np.unpackbits(np.asarray(fp.bits[row]), count=fp.n_frames).astype(np.int8)
+    edges = np.diff(np.concatenate([[0], series, [0]]))
+    return np.flatnonzero(edges == -1) - np.flatnonzero(edges == 1)
+
+
+def co_occurrence(fp, rows):
+    """Fraction of frames in which both pairs of every combination of `rows` are in contact.
+
+    Returns a symmetric (len(rows), len(rows)) matrix whose diagonal is the
+    occupancy of each pair.
+    """
+    bits = np.asarray(fp.bits[np.asarray(rows)])
+    both = np.zeros((len(bits), len(bits)), dtype=np.int64)
+    for a in range(len(bits)):
+        both[a, a:] = popcount(bits[a] & bits[a:])
+        both[a:, a] = both[a, a:]
+    return both / fp.n_frames
+
+
+def row_index(fp, i, j):
+    """Fingerprint row of residue pair (i, j), or -1 if it is never in contact."""
+    i, j = min(i, j), max(i, j)
+    hit = np.flatnonzero((fp.pairs[:, 0] == i) & (fp.pairs[:, 1] == j))
+    return int(hit[0]) if len(hit) else -1
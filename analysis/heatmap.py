@@ -0,0 +1,159 @@
+"""Heatmaps of large residue matrices.
+
+Matrices are drawn as one rasterized ``imshow`` image instead of a patch per
+cell. Matrices with more rows or columns than the figure has pixels are first
+reduced block by block ("max" keeps the value of largest magnitude in each
+block, so isolated strong contacts stay visible; "mean" averages). For
+zooming into very large matrices, ``write_heatmap_tiles`` writes a pyramid
+of fixed-size PNG tiles, halving the resolution at every level, with a
+``tiles.json`` index.
+"""
+import json
+import os
+
+import matplotlib.pyplot as plt
+import numpy as np
+import scipy.sparse
+
+from analysis.instrument import get_instrumentation
+
+DOWNSAMPLE_METHODS = ("max", "mean")
+DEFAULT_MAX_CELLS = 2048  # rows/columns drawn per heatmap, about the pixel width of a 10 in figure at 300 dpi
+DEFAULT_TILE_SIZE = 512  # pixels per tile side
+
+
+# ========== Downsampling ==========
+def _signed_max(block_max, block_min):
+    return np.where(np.abs(block_min) > np.abs(block_max), block_min, block_max)
+
+
+def block_reduce(matrix, block, method="max"):
+    """Reduce `matrix` (dense or scipy sparse) over `block` x `block` cells.
+
+    Edge blocks cover fewer cells. "max" keeps each block's value of
+    largest magnitude, "mean" its mean over the cells it covers.
+    """
+    if method not in DOWNSAMPLE_METHODS:
+        raise ValueError(f"Unknown downsample method: {method}")
+    n_rows, n_cols = matrix.shape
+    shape = (-(-n_rows // block), -(-n_cols // block))
+    if scipy.sparse.issparse(matrix):
+        coo = matrix.tocoo()
+        rows, cols = coo.row // block, coo.col // block
+        if method == "mean":
+            sums = np.zeros(shape)
+            np.add.at(sums, (rows, cols), coo.data)
+            sizes = np.outer(np.minimum(block, n_rows - np.arange(shape[0]) * block),
+                             np.minimum(block, n_cols - np.arange(shape[1]) * block))
+            return sums / sizes
+        block_max, block_min = np.zeros(shape), np.zeros(shape)
+        np.maximum.at(block_max, (rows, cols), coo.data)
+        np.minimum.at(block_min, (rows, cols), coo.data)
+        return _signed_max(block_max, block_min)
+
+    padded = np.full((shape[0] * block, shape[1] * block), np.nan)
+    padded[:n_rows, :n_cols] = matrix
+    blocks = padded.reshape(shape[0], block, shape[1], block)
+    if method == "mean":
+        return np.nanmean(blocks, axis=(1, 3))
+    return _signed_max(np.nanmax(blocks, axis=(1, 3)), np.nanmin(blocks, axis=(1, 3)))
+
+
+def downsample(matrix, max_cells=DEFAULT_MAX_CELLS, method="max"):
+    """`matrix` reduced to at most `max_cells` rows and columns; returns (dense matrix, block size)."""
+    block = max(1, -(-max(matrix.shape) // max_cells)) if max_cells and method else 1
+    if block == 1:
+        return (matrix.toarray() if scipy.sparse.issparse(matrix) else np.asarray(matrix)), 1
+    return block_reduce(matrix, block, method), block
+
+
+def _color_limits(matrix, center, vmin, vmax):
+    data = matrix.data if scipy.sparse.issparse(matrix) else np.asarray(matrix)
+    lo = np.nanmin(data) if vmin is None and data.size else vmin
+    hi = np.nanmax(data) if vmax is None and data.size else vmax
+    if scipy.sparse.issparse(matrix) and matrix.nnz < np.prod(matrix.shape):
+        lo, hi = min(lo, 0), max(hi, 0)
+    if center is not None:
+        span = max(abs(hi - center), abs(lo - center))
+        lo, hi = center - span, center + span
+    return lo, hi
+
+
+# ========== Rendering ==========
+def plot_heatmap(matrix, path, cmap="viridis", center=None, vmin=None, vmax=None, title=None, xlabel=None,
+                 ylabel=None, cbar_label=None, max_cells=DEFAULT_MAX_CELLS, method="max", boundaries=None,
+                 ticks=True, figsize=(10, 8), dpi=300):
+    """Save a heatmap of `matrix` (dense or scipy sparse) to `path` as a single rasterized image.
+
+    `center` makes the color scale symmetric around it (for difference
+    matrices). Matrices larger than `max_cells` are block-reduced with
+    `method`; set `method` to None to draw every cell. `boundaries` are
+    row/column positions in `matrix` where separator lines are drawn.
+    Axis ticks (if `ticks`) count cells of `matrix`. Returns the block size used.
+    """
+    with get_instrumentation().stage("heatmap"):
+        vmin, vmax = _color_limits(matrix, center, vmin, vmax)
+        image, block = downsample(matrix, max_cells, method)
+        n_rows, n_cols = matrix.shape
+        fig, ax = plt.subplots(figsize=figsize)
+        im = ax.imshow(image, cmap=cmap, vmin=vmin, vmax=vmax, interpolation="nearest", aspect="equal",
+                       extent=(0, n_cols, n_rows, 0), rasterized=True)
+        for b in boundaries if boundaries is not None else ():
+            ax.axhline(b, color="black", linewidth=0.5)
+            ax.axvline(b, color="black", linewidth=0.5)
+        if not ticks:
+            ax.set_xticks([])
+            ax.set_yticks([])
+        if cbar_label is not None:
+            fig.colorbar(im, ax=ax, label=cbar_label)
+        if title:
+            ax.set_title(title)
+        if xlabel:
+            ax.set_xlabel(xlabel)
+        if ylabel:
+            ax.set_ylabel(ylabel)
+        fig.tight_layout()
+        fig.savefig(path, dpi=dpi)
+        plt.close(fig)
+    return block
+
+
+def write_heatmap_tiles(matrix, out_dir, cmap="viridis", center=None, vmin=None, vmax=None, method="max",
+                        tile_size=DEFAULT_TILE_SIZE):
+    """Write a zoomable tile pyramid of `matrix` to `out_dir`; returns the path of its ``tiles.json`` index.
+
+    Level 0 has one pixel per cell and level L reduces 2**L x 2**L cells
+    per pixel, up to the first level that fits a single tile. Tile (r, c) of
+    level L is ``{L}/{r}_{c}.png`` and covers pixel rows
+    ``r * tile_size:(r + 1) * tile_size`` of that level. All tiles share one
+    color scale.
+    """
+    with get_instrumentation().stage("heatmap_tiles"):
+        if scipy.sparse.issparse(matrix):
+            matrix = matrix.tocsr()
+        vmin, vmax = _color_limits(matrix, center, vmin, vmax)
+        levels = []
+        level = 0
+        while True:
+            block = 2 ** level
+            # Full-resolution tiles are sliced from `matrix` one at a time
+            image = block_reduce(matrix, block, method) if block > 1 else matrix
+            level_dir = os.path.join(out_dir, str(level))
+            os.makedirs(level_dir, exist_ok=True)
+            n_tile_rows, n_tile_cols = -(-image.shape[0] // tile_size), -(-image.shape[1] // tile_size)
+            for r in range(n_tile_rows):
+                for c in range(n_tile_cols):
+                    tile = image[r * tile_size:(r + 1) * tile_size, c * tile_size:(c + 1) * tile_size]
+                    tile = tile.toarray() if scipy.sparse.issparse(tile) else np.asarray(tile)
+                    plt.imsave(os.path.join(level_dir, f"{r}_{c}.png"), tile, cmap=cmap, vmin=vmin, vmax=vmax)
+            levels.append({"level": level, "block": block, "shape": list(image.shape),
+                           "tiles": [n_tile_rows, n_tile_cols]})
+            if max(image.shape) <= tile_size:
+                break
+            level += 1
+
+        index_path = os.path.join(out_dir, "tiles.json")
+        with open(index_path, "w") as f:
+            json.dump({"shape": list(matrix.shape), "tile_size": tile_size, "cmap": cmap, "vmin": float(vmin),
+                       "vmax": float(vmax), "method": method, "levels": levels}, f, indent=2)
+    return index_path
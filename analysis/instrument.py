@@ -0,0 +1,159 @@
+"""Lightweight per-stage instrumentation.
+
+Library code asks for the active instrumentation with
+``get_instrumentation()`` and wraps its work in ``stage(name)`` blocks and
+``count(name, n)`` calls. By default the active object is a no-op whose
+methods do nothing, so instrumented hot loops cost a method call per chunk.
+Scripts turn it on with ``enable_instrumentation()`` (or the
+``instrumented()`` context manager) and write the collected stage timings,
+counters and optional cProfile/tracemalloc data as a JSON report.
+"""
+import contextlib
+import cProfile
+import io
+import json
+import pstats
+import time
+import tracemalloc
+from collections import defaultdict
+
+
+class Instrumentation:
+    """Named stage timers and counters for one run, with optional cProfile and tracemalloc capture."""
+
+    enabled = True
+
+    def __init__(self, profile=False, trace_memory=False, progress=True):
+        self.stages = defaultdict(lambda: {"seconds": 0.0, "calls": 0})
+        self.counters = defaultdict(int)
+        self.show_progress = progress
+        self.trace_memory = trace_memory
+        self._peak_stack = []
+        self._start = time.perf_counter()
+        self._profiler = cProfile.Profile() if profile else None
+        if self._profiler is not None:
+            self._profiler.enable()
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Time the enclosed block under `name`; repeated stages accumulate."""
+        if self.trace_memory:
+            current_peak = tracemalloc.get_traced_memory()[1]
+            for entry in self._peak_stack:
+                entry[0] = max(entry[0], current_peak)
+            tracemalloc.reset_peak()
+            self._peak_stack.append([0])
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stats = self.stages[name]
+            stats["seconds"] += time.perf_counter() - start
+            stats["calls"] += 1
+            if self.trace_memory:
+                entry = self._peak_stack.pop()
+                peak = max(entry[0], tracemalloc.get_traced_memory()[1])
+                stats["peak_mb"] = max(stats.get("peak_mb", 0.0), peak / 2**20)
+                if self._peak_stack:
+                    self._peak_stack[-1][0] = max(self._peak_stack[-1][0], peak)
+
+    def count(self, name, value=1):
+        self.counters[name] += int(value)
+
+    def merge_counters(self, counters):
+        """Add counters collected elsewhere, e.g. in a worker process."""
+        for name, value in counters.items():
+            self.counters[name] += value
+
+    def progress(self, label, message):
+        if self.show_progress:
+            print(f"[{label}] {message}")
+
+    def report(self, top_functions=25):
+        """Structured run report: total time, stages, counters and derived rates."""
+        total = time.perf_counter() - self._start
+        report = {"total_seconds": total, "stages": dict(self.stages), "counters": dict(self.counters)}
+        occupancy = self.stages.get("occupancy_compute")
+        if occupancy and occupancy["seconds"] > 0 and "frames" in self.counters:
+            report["frames_per_s"] = self.counters["frames"] / occupancy["seconds"]
+        if self.trace_memory:
+            report["peak_traced_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+        if self._profiler is not None:
+            self._profiler.disable()
+            stream = io.StringIO()
+            stats = pstats.Stats(self._profiler, stream=stream).sort_stats("cumulative")
+            stats.print_stats(top_functions)
+            report["profile"] = stream.getvalue().splitlines()
+            self._profiler.enable()
+        return report
+
+    def write_report(self, path, top_functions=25):
+        report = self.report(top_functions)
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+        if self._profiler is not None:
+            self._profiler.dump_stats(path + ".prof")
+        print(f"Run report saved to: {path}")
+        return report
+
+    def close(self):
+        if self._profiler is not None:
+            self._profiler.disable()
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+
+class _NullInstrumentation:
+    """Default instrumentation: every call is a no-op."""
+
+    enabled = False
+    _null_stage = contextlib.nullcontext()
+
+    def stage(self, name):
+        return self._null_stage
+
+    def count(self, name, value=1):
+        pass
+
+    def merge_counters(self, counters):
+        pass
+
+    def progress(self, label, message):
+        pass
+
+
+_NULL = _NullInstrumentation()
+_current = _NULL
+
+
+def get_instrumentation():
+    """The active instrumentation (a no-op object unless one was enabled)."""
+    return _current
+
+
+def enable_instrumentation(profile=False, trace_memory=False, progress=True):
+    """Install and return a new active ``Instrumentation``."""
+    global _current
+    _current = Instrumentation(profile, trace_memory, progress)
+    return _current
+
+
+def disable_instrumentation():
+    global _current
+    if _current is not _NULL:
+        _current.close()
+    _current = _NULL
+
+
+@contextlib.contextmanager
+def instrumented(report_path=None, profile=False, trace_memory=False, progress=True):
+    """Instrument the enclosed block and write its report to `report_path` if given."""
+    inst = enable_instrumentation(profile, trace_memory, progress)
+    try:
+        yield inst
+    finally:
+        if report_path is not None:
+            inst.write_report(report_path)
+        disable_instrumentation()
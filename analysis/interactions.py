@@ -1,116 +1,179 @@
-from sklearn.cluster import KMeans
-from sklearn.decomposition import PCA
-import mdtraj as md
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.decomposition import TruncatedSVD
+from sklearn.metrics import silhouette_score
 import os
-import itertools
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
+import scipy.sparse
 import time
 
-# ========== Start Timer ==========
-start_time = time.time()
+from analysis.adaptive import adaptive_sampling
+from analysis.contacts import format_residue_labels
+from analysis.heatmap import DEFAULT_MAX_CELLS, plot_heatmap
+from analysis.instrument import enable_instrumentation, get_instrumentation
+from analysis.occupancy import gr_replica_systems, gr_systems, matched_system_occupancies
+from analysis.significance import contact_difference_significance, significance_dict
 
 # ========== Parameters ==========
 cutoff = 0.4
 threshold = 0.5
-progress_steps = 100
-num_clusters = 4
+num_clusters = 4  # or None to pick the count in cluster_counts with the best silhouette score
+cluster_counts = range(2, 11)
+silhouette_sample = 2000  # residues scored per silhouette evaluation
+n_components = 2  # truncated SVD components used for clustering
 max_residue_distance = 10
-
-# ========== Paths ==========
-script_dir = os.path.dirname(os.path.abspath(__file__))
-src_dir = os.path.join(script_dir, "..", "src")
-
-# ========== Load Trajectories ==========
-traj_bound = md.load(os.path.join(src_dir, "md_skip_gr_ligand.xtc"),
-                     top=os.path.join(src_dir, "gr_ligand.pdb"))
-traj_unbound = md.load(os.path.join(src_dir, "md_skip_gr_only.xtc"),
-                       top=os.path.join(src_dir, "gr_only.pdb"))
-
-# ========== Chain Selection ==========
-protein_bound = traj_bound.atom_slice(traj_bound.topology.select("protein and chainid 1"))
-protein_unbound = traj_unbound.atom_slice(traj_unbound.topology.select("protein and chainid 0"))
-
-# ========== Residue Matching ==========
-def get_residue_dict(topology):
-    return {(res.chain.index, res.resSeq): res for res in topology.residues}
-
-res_dict_bound = get_residue_dict(protein_bound.topology)
-res_dict_unbound = get_residue_dict(protein_unbound.topology)
-matched_keys = sorted(set(res_dict_bound.keys()) & set(res_dict_unbound.keys()))
-residues_bound = [res_dict_bound[k] for k in matched_keys]
-residues_unbound = [res_dict_unbound[k] for k in matched_keys]
-residue_labels = [f"{res.name}{res.resSeq}_chain{res.chain.index}" for res in residues_bound]
-residue_pairs = list(itertools.combinations(range(len(matched_keys)), 2))
-
-# ========== Contact Occupancy ==========
-def contact_occupancy_fast(traj, residues, pairs, cutoff_nm, label):
-    n_frames = traj.n_frames
-    occupancies = {}
-    progress_intervals = max(1, len(pairs) // progress_steps)
-    for idx, (i, j) in enumerate(pairs):
-        if idx % progress_intervals == 0:
-            print(f"[{label}] Progress: {idx * 100 // len(pairs)}%")
-        atoms1 = [a.index for a in residues[i].atoms if a.element.symbol != "H"]
-        atoms2 = [a.index for a in residues[j].atoms if a.element.symbol != "H"]
-        if not atoms1 or not atoms2:
+chunk_size = 500  # frames held in memory at once
+n_workers = os.cpu_count() or 1  # processes for uncached occupancy
+incremental = False  # only read frames appended to the trajectories since the last run
+adaptive = False  # sample both systems' frame blocks until changes near `threshold` converge (analysis.adaptive)
+replicas = None  # e.g. {"bound": ["md_skip_gr_ligand_1.xtc", ...], "unbound": [...]} in src/
+report_path = None  # e.g. "run_report.json" for per-stage timings and counters
+profile_run = False  # add cProfile output to the report
+trace_memory = False  # add tracemalloc peaks to the report
+significance_test = None  # "bootstrap" or "permutation": also require an FDR-significant change
+n_blocks = 20  # trajectory blocks resampled by the significance test
+n_resamples = 2000  # bootstrap resamples or permutations
+fdr_alpha = 0.05  # Benjamini-Hochberg false discovery rate
+heatmap_path = "heatmap_diff_clusters_only.png"
+heatmap_max_cells = DEFAULT_MAX_CELLS  # larger heatmaps are block-reduced to this many rows/columns
+heatmap_downsample = "max"  # "max" (largest |delta| per block), "mean", or None to draw every cell
+close_pairs_path = "significant_close_pairs.txt"
+
+
+def difference_matrix(occupancy):
+    """Symmetric sparse (n_res, n_res) CSR matrix of occ_unbound - occ_bound over the matched residues."""
+    upper = scipy.sparse.triu(scipy.sparse.csr_matrix(occupancy.occ_unbound)
+                              - scipy.sparse.csr_matrix(occupancy.occ_bound), k=1)
+    upper.eliminate_zeros()
+    return (upper + upper.T).tocsr()
+
+
+def high_difference_residues(diff_matrix):
+    """Indices of the residues whose summed |difference| is above the 75th percentile, and their submatrix."""
+    # Rounded so that residues tied with the percentile do not depend on summation order
+    residue_scores = np.round(np.asarray(abs(diff_matrix).sum(axis=1)).ravel(), 10)
+    significant_indices = np.where(residue_scores > np.percentile(residue_scores, 75))[0]
+    return significant_indices, diff_matrix[significant_indices][:, significant_indices]
+
+
+def select_cluster_count(X, cluster_counts=cluster_counts, sample_size=silhouette_sample, random_state=42):
+    """Number of clusters in `cluster_counts` with the best silhouette score on a subsample of `X`."""
+    best_k, best_score = None, -np.inf
+    for k in cluster_counts:
+        if not 2 <= k < len(X):
+            continue
+        labels = MiniBatchKMeans(n_clusters=k, random_state=random_state, n_init="auto").fit_predict(X)
+        if len(np.unique(labels)) < 2:
             continue
-        atom_pairs = np.array(list(itertools.product(atoms1, atoms2)))
-        distances = md.compute_distances(traj, atom_pairs)
-        contact_frames = np.any(distances < cutoff_nm, axis=1)
-        occupancy = np.sum(contact_frames) / n_frames
-        if occupancy > 0:
-            occupancies[(i, j)] = occupancy
-    return occupancies
-
-occ_bound = contact_occupancy_fast(protein_bound, residues_bound, residue_pairs, cutoff, "bound")
-occ_unbound = contact_occupancy_fast(protein_unbound, residues_unbound, residue_pairs, cutoff, "unbound")
-
-# ========== Filter and Build Difference Matrix ==========
-n_res = len(matched_keys)
-diff_matrix = np.zeros((n_res, n_res))
-for (i, j) in residue_pairs:
-    delta = occ_unbound.get((i, j), 0) - occ_bound.get((i, j), 0)
-    diff_matrix[i, j] = delta
-    diff_matrix[j, i] = delta
-
-# ========== Select High-Difference Residues ==========
-residue_scores = np.sum(np.abs(diff_matrix), axis=1)
-significant_indices = np.where(residue_scores > np.percentile(residue_scores, 75))[0]
-diff_submatrix = diff_matrix[significant_indices][:, significant_indices]
-labels_sub = [residue_labels[i] for i in significant_indices]
-
-# ========== Dimensionality Reduction & Clustering ==========
-pca = PCA(n_components=2)
-X_pca = pca.fit_transform(diff_submatrix)
-kmeans = KMeans(n_clusters=num_clusters, random_state=42, n_init="auto")
-cluster_labels = kmeans.fit_predict(X_pca)
-
-# ========== Heatmap ==========
-plt.figure(figsize=(10, 8))
-sns.heatmap(diff_submatrix, cmap="bwr", center=0, square=True,
-            xticklabels=False, yticklabels=False, cbar=False)
-plt.title("Residue Contact Difference Clusters (PCA + KMeans)")
-plt.tight_layout()
-plt.savefig("heatmap_diff_clusters_only.png", dpi=300)
-plt.close()
-
-# ========== Filter Close High-Difference Pairs ==========
-close_pairs = []
-for i in range(len(significant_indices)):
-    for j in range(i + 1, len(significant_indices)):
-        idx1 = significant_indices[i]
-        idx2 = significant_indices[j]
-        delta = abs(diff_matrix[idx1, idx2])
-        if delta > threshold and abs(idx1 - idx2) <= max_residue_distance:
-            close_pairs.append((idx1, idx2, delta))
-
-with open("significant_close_pairs.txt", "w") as f:
-    f.write("Index1\tIndex2\tDelta\tLabel1\tLabel2\n")
-    for i, j, delta in sorted(close_pairs, key=lambda x: -x[2]):
-        f.write(f"{i}\t{j}\t{delta:.3f}\t{residue_labels[i]}\t{residue_labels[j]}\n")
-
-# ========== End Timer ==========
-end_time = time.time()
-print(f"Total execution time: {end_time - start_time:.2f} seconds")
+        score = silhouette_score(X, labels, sample_size=min(sample_size, len(X)), random_state=random_state)
+        print(f"  {k} clusters: silhouette {score:.3f}")
+        if score > best_score:
+            best_k, best_score = k, score
+    if best_k is None:
+        raise ValueError(f"Too few residues ({len(X)}) for any of the cluster counts {list(cluster_counts)}")
+    return best_k
+
+
+def cluster_residues(diff_submatrix, num_clusters=num_clusters, n_components=n_components,
+                     cluster_counts=cluster_counts, silhouette_sample=silhouette_sample, random_state=42):
+    """MiniBatchKMeans labels of the rows of a sparse difference submatrix after a truncated SVD.
+
+    With `num_clusters` None the count is picked from `cluster_counts` by silhouette score.
+    """
+    n_components = max(1, min(n_components, diff_submatrix.shape[1] - 1))
+    svd = TruncatedSVD(n_components=n_components, algorithm="randomized", random_state=random_state)
+    X = svd.fit_transform(diff_submatrix)
+    if num_clusters is None:
+        num_clusters = select_cluster_count(X, cluster_counts, silhouette_sample, random_state)
+        print(f"Selected {num_clusters} clusters")
+    kmeans = MiniBatchKMeans(n_clusters=num_clusters, random_state=random_state, n_init="auto")
+    return kmeans.fit_predict(X)
+
+
+def cluster_contacts(occupancy, threshold=threshold, num_clusters=num_clusters,
+                     max_residue_distance=max_residue_distance, pair_tests=None,
+                     heatmap_path=heatmap_path, close_pairs_path=close_pairs_path, n_components=n_components,
+                     cluster_counts=cluster_counts, silhouette_sample=silhouette_sample,
+                     heatmap_max_cells=heatmap_max_cells, heatmap_downsample=heatmap_downsample):
+    """Cluster the high-difference residues, draw their difference heatmap and write the close changed pairs.
+
+    The heatmap rows and columns are grouped by cluster. Returns the
+    selected residue indices, their cluster labels and the (i, j, |delta|)
+    close pairs.
+    """
+    inst = get_instrumentation()
+    residue_labels = format_residue_labels(occupancy.residues_bound)
+
+    # ========== Filter and Build Difference Matrix ==========
+    with inst.stage("difference"):
+        diff_matrix = difference_matrix(occupancy)
+
+    # ========== Select High-Difference Residues ==========
+    with inst.stage("select"):
+        significant_indices, diff_submatrix = high_difference_residues(diff_matrix)
+
+    # ========== Dimensionality Reduction & Clustering ==========
+    with inst.stage("clustering"):
+        cluster_labels = cluster_residues(diff_submatrix, num_clusters, n_components, cluster_counts,
+                                          silhouette_sample)
+
+    # ========== Heatmap ==========
+    order = np.lexsort((significant_indices, cluster_labels))
+    plot_heatmap(diff_submatrix[order][:, order], heatmap_path, cmap="bwr", center=0,
+                 title="Residue Contact Difference Clusters (SVD + MiniBatchKMeans)", max_cells=heatmap_max_cells,
+                 method=heatmap_downsample, boundaries=np.flatnonzero(np.diff(cluster_labels[order])) + 1,
+                 ticks=False)
+
+    # ========== Filter Close High-Difference Pairs ==========
+    with inst.stage("close_pairs"):
+        upper = scipy.sparse.triu(diff_submatrix, k=1).tocoo()
+        idx1, idx2 = significant_indices[upper.row], significant_indices[upper.col]
+        delta = np.abs(upper.data)
+        keep = (delta > threshold) & (np.abs(idx1 - idx2) <= max_residue_distance)
+        if pair_tests is not None:
+            keep &= np.array([pair_tests[(i, j)][2] for i, j in zip(idx1, idx2)], dtype=bool)
+        # Largest change first, ties in residue order
+        order = np.lexsort((idx2[keep], idx1[keep], -delta[keep]))
+        close_pairs = list(zip(idx1[keep][order].tolist(), idx2[keep][order].tolist(),
+                               delta[keep][order].tolist()))
+
+        with open(close_pairs_path, "w") as f:
+            f.write("Index1\tIndex2\tDelta\tLabel1\tLabel2\n")
+            for i, j, delta in close_pairs:
+                f.write(f"{i}\t{j}\t{delta:.3f}\t{residue_labels[i]}\t{residue_labels[j]}\n")
+    return significant_indices, cluster_labels, close_pairs
+
+
+def main():
+    # ========== Start Timer ==========
+    start_time = time.time()
+
+    # ========== Instrumentation ==========
+    inst = enable_instrumentation(profile_run, trace_memory) if report_path else get_instrumentation()
+
+    # ========== Contact Occupancy (cached) ==========
+    bound, unbound = gr_replica_systems(replicas["bound"], replicas["unbound"]) if replicas else gr_systems()
+    sampling = adaptive_sampling(threshold, criterion="difference") if adaptive else None
+    occupancy = matched_system_occupancies(bound, unbound, cutoff, chunk_size=chunk_size,
+                                           n_workers=n_workers, incremental=incremental, adaptive=sampling)
+
+    # ========== Block-Resampling Significance (optional) ==========
+    pair_tests = None
+    if significance_test:
+        significance = contact_difference_significance(bound, unbound, occupancy, cutoff,
+                                                       chunk_size=chunk_size, method=significance_test,
+                                                       n_blocks=n_blocks, n_resamples=n_resamples,
+                                                       alpha=fdr_alpha)
+        pair_tests = significance_dict(significance)
+
+    cluster_contacts(occupancy, threshold, num_clusters, max_residue_distance, pair_tests)
+
+    # ========== End Timer ==========
+    end_time = time.time()
+    print(f"Total execution time: {end_time - start_time:.2f} seconds")
+
+    if report_path:
+        inst.write_report(report_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""Atom-level contact changes within loop regions.
+
+Loop atoms are the heavy atoms of residues whose resSeq falls in one of the
+loop ranges, picked with boolean masks over per-atom residue numbers. Atoms
+are matched between the bound and unbound systems by (chain, resSeq, atom
+name), and every unordered pair of matched atoms comes from one
+``np.triu_indices`` call. Per-pair contact frequencies are accumulated over
+trajectory chunks with batched distance calls, and the results are sparse
+(n_atoms, n_atoms) upper-triangular matrices.
+"""
+from collections import namedtuple
+
+import mdtraj as md
+import numpy as np
+import scipy.sparse
+
+from analysis.instrument import get_instrumentation
+from analysis.occupancy import System
+from analysis.trajectory import DEFAULT_CHUNK_SIZE, iter_protein_chunks, load_protein_topology
+
+LoopAtoms = namedtuple("LoopAtoms", ["keys", "labels", "atoms_bound", "atoms_unbound"])
+LoopContacts = namedtuple("LoopContacts", ["labels", "freq_bound", "freq_unbound", "formed", "broken",
+                                           "n_frames_bound", "n_frames_unbound"])
+
+
+# ========== Loop Atoms ==========
+def loop_atom_mask(topology, loop_ranges):
+    """Boolean mask of the heavy atoms of `topology` in residues with resSeq in any inclusive (start, end) range."""
+    resseq = np.array([atom.residue.resSeq for atom in topology.atoms])
+    heavy = np.array([atom.element is None or atom.element.symbol != "H" for atom in topology.atoms])
+    in_loop = np.zeros(topology.n_atoms, dtype=bool)
+    for start, end in loop_ranges:
+        in_loop |= (resseq >= start) & (resseq <= end)
+    return heavy & in_loop
+
+
+def _loop_atom_keys(system, loop_ranges):
+    atom_indices, topology = load_protein_topology(system.top_path, system.selection)
+    local = np.flatnonzero(loop_atom_mask(topology, loop_ranges))
+    atoms = [topology.atom(k) for k in local]
+    keys = [(a.residue.chain.index, a.residue.resSeq, a.name) for a in atoms]
+    return dict(zip(keys, zip(atom_indices[local], map(str, atoms))))
+
+
+def match_loop_atoms(bound, unbound, loop_ranges):
+    """Loop heavy atoms present in both systems, as ``LoopAtoms`` with full-topology atom indices."""
+    atoms_bound = _loop_atom_keys(bound, loop_ranges)
+    atoms_unbound = _loop_atom_keys(unbound, loop_ranges)
+    keys = sorted(set(atoms_bound) & set(atoms_unbound))
+    return LoopAtoms(keys, [atoms_bound[k][1] for k in keys],
+                     np.array([atoms_bound[k][0] for k in keys], dtype=np.int64),
+                     np.array([atoms_unbound[k][0] for k in keys], dtype=np.int64))
+
+
+def half_pairs(n_atoms):
+    """All (i, j) with i < j over `n_atoms` atoms, as two index arrays."""
+    return np.triu_indices(n_atoms, k=1)
+
+
+# ========== Contact Frequencies ==========
+def accumulate_atom_contact_counts(chunks, atom_pairs, cutoff_nm, max_distances=20_000_000, label=None):
+    """Frames in which each atom pair of `atom_pairs` is closer than `cutoff_nm`; returns (counts, n_frames).
+
+    `atom_pairs` index the atoms of the chunks. At most `max_distances`
+    (frames x atom pairs) distances are held at once.
+    """
+    inst = get_instrumentation()
+    counts = np.zeros(len(atom_pairs), dtype=np.int64)
+    n_frames = 0
+
+    chunks = iter(chunks)
+    while True:
+        with inst.stage("read"):
+            chunk = next(chunks, None)
+        if chunk is None:
+            break
+        with inst.stage("distances"):
+            batch = max(1, max_distances // chunk.n_frames)
+            for lo in range(0, len(atom_pairs), batch):
+                distances = md.compute_distances(chunk, atom_pairs[lo:lo + batch])
+                counts[lo:lo + batch] += np.count_nonzero(distances < cutoff_nm, axis=0)
+        n_frames += chunk.n_frames
+        inst.count("frames", chunk.n_frames)
+        inst.count("atom_pair_distances", chunk.n_frames * len(atom_pairs))
+        if label is not None:
+            inst.progress(label, f"Frames processed: {n_frames}")
+    return counts, n_frames
+
+
+def _reader_atoms(atom_indices, pair_i, pair_j):
+    # Trajectories are read with sorted atom indices; map the pairs onto that order
+    sorted_atoms = np.sort(atom_indices)
+    position = np.searchsorted(sorted_atoms, atom_indices)
+    return sorted_atoms, np.column_stack([position[pair_i], position[pair_j]])
+
+
+def loop_contact_counts(systems, atom_indices, cutoff_nm, stride=1, chunk_size=DEFAULT_CHUNK_SIZE,
+                        from_trajectories=True):
+    """Contact counts of every pair of `atom_indices`, pooled over `systems` (one ``System`` or replicas).
+
+    Counts are ordered like ``half_pairs(len(atom_indices))``. Without
+    `from_trajectories` only the topology structure of each system is used.
+    Returns (counts, n_frames).
+    """
+    systems = [systems] if isinstance(systems, System) else list(systems)
+    pair_i, pair_j = half_pairs(len(atom_indices))
+    reader_atoms, atom_pairs = _reader_atoms(atom_indices, pair_i, pair_j)
+    counts, n_frames = np.zeros(len(atom_pairs), dtype=np.int64), 0
+    for system in systems:
+        if from_trajectories:
+            print(f"\nComputing loop contacts ({system.name})...")
+            chunks = iter_protein_chunks(system.xtc_path, system.top_path, reader_atoms, chunk_size, stride)
+        else:
+            chunks = [md.load(system.top_path, atom_indices=reader_atoms)]
+        system_counts, system_frames = accumulate_atom_contact_counts(
+            chunks, atom_pairs, cutoff_nm, label=system.name if from_trajectories else None)
+        if system_frames == 0:
+            raise ValueError(f"No frames read from {system.xtc_path}")
+        counts += system_counts
+        n_frames += system_frames
+    return counts, n_frames
+
+
+def _pair_matrix(values, pair_i, pair_j, n_atoms):
+    kept = np.flatnonzero(values)
+    return scipy.sparse.csr_matrix((values[kept], (pair_i[kept], pair_j[kept])), shape=(n_atoms, n_atoms))
+
+
+def loop_contact_changes(bound, unbound, loop_ranges, cutoff_nm, threshold=0.5, stride=1,
+                         chunk_size=DEFAULT_CHUNK_SIZE, from_trajectories=True):
+    """Loop contact frequencies of both systems and the contacts formed or broken on unbinding.
+
+    A pair is formed when its frequency in `unbound` exceeds that in
+    `bound` by more than `threshold`, and broken in the opposite case; the
+    ``formed`` and ``broken`` matrices hold that frequency change. For single
+    structures (frequencies of 0 or 1) any threshold below 1 gives the plain
+    "in contact in one state only" comparison.
+    """
+    inst = get_instrumentation()
+    reference = bound if isinstance(bound, System) else bound[0]
+    loop_atoms = match_loop_atoms(reference, unbound if isinstance(unbound, System) else unbound[0],
+                                  loop_ranges)
+    n_atoms = len(loop_atoms.keys)
+    pair_i, pair_j = half_pairs(n_atoms)
+    print(f"Selected {n_atoms} matched heavy atoms in loop regions ({len(pair_i)} atom pairs).")
+
+    with inst.stage("loop_contacts"):
+        counts_bound, frames_bound = loop_contact_counts(bound, loop_atoms.atoms_bound, cutoff_nm, stride,
+                                                         chunk_size, from_trajectories)
+        counts_unbound, frames_unbound = loop_contact_counts(unbound, loop_atoms.atoms_unbound, cutoff_nm,
+                                                             stride, chunk_size, from_trajectories)
+    freq_bound = counts_bound / frames_bound
+    freq_unbound = counts_unbound / frames_unbound
+    delta = freq_unbound - freq_bound
+    return LoopContacts(
+        loop_atoms.labels,
+        _pair_matrix(freq_bound, pair_i, pair_j, n_atoms),
+        _pair_matrix(freq_unbound, pair_i, pair_j, n_atoms),
+        _pair_matrix(np.where(delta > threshold, delta, 0), pair_i, pair_j, n_atoms),
+        _pair_matrix(np.where(-delta > threshold, -delta, 0), pair_i, pair_j, n_atoms),
+        frames_bound, frames_unbound)
@@ -1,127 +1,126 @@
-import mdtraj as md
 import os
-import itertools
 import numpy as np
-import scipy.linalg
-import seaborn as sns
-import matplotlib.pyplot as plt
 import time
 
-# ========== Start Timer ==========
-start_time = time.time()
+from analysis.adaptive import adaptive_sampling
+from analysis.communicability import adjacency_matrix, communicability
+from analysis.contacts import format_residue_labels
+from analysis.heatmap import DEFAULT_MAX_CELLS, plot_heatmap, write_heatmap_tiles
+from analysis.instrument import enable_instrumentation, get_instrumentation
+from analysis.occupancy import gr_replica_systems, gr_systems, matched_system_occupancies
+from analysis.storage import save_matrix
 
 # ========== Parameters ==========
 cutoff = 0.4    # nm for contact
 threshold = 0.5 # occupancy threshold
-progress_steps = 100  # 1% resolution
-
-# ========== Paths ==========
-script_dir = os.path.dirname(os.path.abspath(__file__))
-src_dir = os.path.join(script_dir, "..", "src")
-
-# ========== Load Trajectories ==========
-print("Loading trajectories...")
-traj_bound = md.load(os.path.join(src_dir, "md_skip_gr_ligand.xtc"),
-                     top=os.path.join(src_dir, "gr_ligand.pdb"))
-traj_unbound = md.load(os.path.join(src_dir, "md_skip_gr_only.xtc"),
-                       top=os.path.join(src_dir, "gr_only.pdb"))
-
-# ========== Chain Selection ==========
-protein_bound = traj_bound.atom_slice(
-    traj_bound.topology.select("protein and chainid 1"))  # Chain B
-protein_unbound = traj_unbound.atom_slice(
-    traj_unbound.topology.select("protein and chainid 0"))  # Chain A
-
-# ========== Residue Matching ==========
-def get_residue_dict(topology):
-    return { (res.chain.index, res.resSeq): res for res in topology.residues }
-
-res_dict_bound = get_residue_dict(protein_bound.topology)
-res_dict_unbound = get_residue_dict(protein_unbound.topology)
-matched_keys = sorted(set(res_dict_bound) & set(res_dict_unbound))
-
-residues_bound = [res_dict_bound[k] for k in matched_keys]
-residues_unbound = [res_dict_unbound[k] for k in matched_keys]
-residue_pairs = list(itertools.combinations(range(len(matched_keys)), 2))
-n_res = len(matched_keys)
-
-print(f"Matched residues: {n_res}")
-print(f"Total residue pairs: {len(residue_pairs)}")
-
-# ========== Contact Occupancy Function ==========
-def contact_occupancy_fast(traj, residues, pairs, cutoff_nm, label):
-    print(f"\nComputing contact occupancy ({label})...")
-    n_frames = traj.n_frames
-    occupancies = {}
-    step = max(1, len(pairs) // progress_steps)
-
-    for idx, (i, j) in enumerate(pairs):
-        if idx % step == 0:
-            print(f"Progress: {idx * 100 // len(pairs)}%")
-
-        atoms1 = [a.index for a in residues[i].atoms if a.element.symbol != "H"]
-        atoms2 = [a.index for a in residues[j].atoms if a.element.symbol != "H"]
-        if not atoms1 or not atoms2:
-            continue
-
-        atom_pairs = np.array(list(itertools.product(atoms1, atoms2)))
-        distances = md.compute_distances(traj, atom_pairs)
-        contact_frames = np.any(distances < cutoff_nm, axis=1)
-        occupancy = np.sum(contact_frames) / n_frames
-
-        if occupancy > 0:
-            occupancies[(i, j)] = occupancy
-
-    print("Progress: 100% (done)")
-    return occupancies
+comm_method = "eigh"  # "eigh" (per connected component), "expm_multiply" or "dense"
+comm_rows = None  # residue indices to evaluate, or None for the full matrix
+output_formats = ("npy",)  # any of "npy" (memory-mappable, with .json metadata) and "csv"
+output_dtype = None  # e.g. np.float32 to halve the .npy size
+heatmap_max_cells = DEFAULT_MAX_CELLS  # larger heatmaps are block-reduced to this many rows/columns
+heatmap_downsample = "max"  # "max" or "mean" per block, or None to draw every cell
+heatmap_tiles = False  # also write a zoomable multi-resolution tile pyramid of each heatmap
+chunk_size = 500  # frames held in memory at once
+n_workers = os.cpu_count() or 1  # processes for uncached occupancy
+incremental = False  # only read frames appended to the trajectories since the last run
+adaptive = False  # read frame blocks only until pairs near `threshold` have converged (analysis.adaptive)
+replicas = None  # e.g. {"bound": ["md_skip_gr_ligand_1.xtc", ...], "unbound": [...]} in src/
+report_path = None  # e.g. "run_report.json" for per-stage timings and counters
+profile_run = False  # add cProfile output to the report
+trace_memory = False  # add tracemalloc peaks to the report
 
-# ========== Compute & Process Communicability ==========
-def process_system(name, residues, traj, residue_pairs):
-    occ = contact_occupancy_fast(traj, residues, residue_pairs, cutoff, name)
-
-    # Filter by threshold
-    filtered = [pair for pair in residue_pairs if occ.get(pair, 0) > threshold]
-    print(f"{name}: {len(filtered)} pairs above threshold {threshold}")
 
-    # Build adjacency matrix
+# ========== Compute & Process Communicability ==========
+def process_system(name, occ_matrix, residue_labels, cutoff=cutoff, threshold=threshold,
+                   comm_method=comm_method, comm_rows=comm_rows, output_formats=output_formats,
+                   output_dtype=output_dtype, ensemble=None, output_dir=".", heatmap_max_cells=heatmap_max_cells,
+                   heatmap_downsample=heatmap_downsample, heatmap_tiles=heatmap_tiles):
+    """Save the occupancy, communicability matrix and heatmap of one system to `output_dir`."""
+    inst = get_instrumentation()
+
+    # Occupancy matrix used for the graph
+    occ_path = os.path.join(output_dir, f"occupancy_{name}")
+    save_matrix(occ_path, occ_matrix, residue_labels, output_dtype, ["npy"], cutoff=cutoff)
+    print(f"{name} occupancy saved to: {occ_path}.npy")
+    if ensemble is not None:
+        save_matrix(f"{occ_path}_replicas", ensemble.replicas, residue_labels, output_dtype, ["npy"],
+                    cutoff=cutoff, n_frames=ensemble.n_frames)
+        save_matrix(f"{occ_path}_spread", ensemble.spread, residue_labels, output_dtype, ["npy"],
+                    cutoff=cutoff)
+        print(f"{name} per-replica occupancies and spread saved to: {occ_path}_replicas.npy, "
+              f"{occ_path}_spread.npy")
+
+    # Filter by threshold into a sparse adjacency matrix
     print(f"\nBuilding adjacency matrix ({name})...")
-    adj_matrix = np.zeros((n_res, n_res))
-    step = max(1, len(filtered) // progress_steps)
-
-    for idx, (i, j) in enumerate(filtered):
-        if idx % step == 0:
-            print(f"Progress: {idx * 100 // len(filtered)}%")
-        w = occ.get((i, j), 0)
-        adj_matrix[i, j] = w
-        adj_matrix[j, i] = w
-
-    print("Progress: 100% (done)")
+    with inst.stage("adjacency"):
+        adj_matrix = adjacency_matrix(occ_matrix, threshold)
+    print(f"{name}: {adj_matrix.nnz // 2} pairs above threshold {threshold}")
 
     # Communicability matrix
-    print(f"\nComputing communicability matrix ({name})...")
-    comm_matrix = scipy.linalg.expm(adj_matrix)
+    print(f"\nComputing communicability matrix ({name}, {comm_method})...")
+    comm_matrix = communicability(adj_matrix, comm_method, comm_rows)
 
     # Save results
-    csv_path = f"communicability_{name}.csv"
-    png_path = f"communicability_{name}.png"
-    np.savetxt(csv_path, comm_matrix, delimiter=",", fmt="%.6f")
-    print(f"{name} matrix saved to: {csv_path}")
+    out_paths = save_matrix(os.path.join(output_dir, f"communicability_{name}"), comm_matrix,
+                            residue_labels, output_dtype, output_formats, cutoff=cutoff,
+                            threshold=threshold, method=comm_method, rows=comm_rows)
+    png_path = os.path.join(output_dir, f"communicability_{name}.png")
+    print(f"{name} matrix saved to: {', '.join(out_paths)}")
 
     # Plot
-    plt.figure(figsize=(10, 8))
-    sns.heatmap(comm_matrix, cmap="viridis", square=True, cbar_kws={"label": "Communicability"})
-    plt.title(f"{name.capitalize()} Residue Communicability Matrix")
-    plt.xlabel("Residue Index")
-    plt.ylabel("Residue Index")
-    plt.tight_layout()
-    plt.savefig(png_path, dpi=300)
-    plt.close()
+    plot_heatmap(comm_matrix, png_path, cmap="viridis", title=f"{name.capitalize()} Residue Communicability Matrix",
+                 xlabel="Residue Index", ylabel="Residue Index", cbar_label="Communicability",
+                 max_cells=heatmap_max_cells, method=heatmap_downsample)
     print(f"{name} heatmap saved to: {png_path}")
-
-# Run for both systems
-process_system("bound", residues_bound, protein_bound, residue_pairs)
-process_system("unbound", residues_unbound, protein_unbound, residue_pairs)
-
-# ========== End Timer ==========
-end_time = time.time()
-print(f"\nTotal execution time: {end_time - start_time:.2f} seconds")
+    if heatmap_tiles:
+        tiles_path = write_heatmap_tiles(comm_matrix, os.path.join(output_dir, f"communicability_{name}_tiles"),
+                                         cmap="viridis", method=heatmap_downsample or "max")
+        print(f"{name} heatmap tiles saved to: {tiles_path}")
+    return comm_matrix
+
+
+def communicability_outputs(occupancy, cutoff=cutoff, threshold=threshold, comm_method=comm_method,
+                            comm_rows=comm_rows, output_formats=output_formats, output_dtype=output_dtype,
+                            output_dir=".", heatmap_max_cells=heatmap_max_cells,
+                            heatmap_downsample=heatmap_downsample, heatmap_tiles=heatmap_tiles):
+    """Run ``process_system`` for both systems of a matched occupancy; returns their communicability matrices."""
+    n_res = len(occupancy.matched_keys)
+    residue_labels = format_residue_labels(occupancy.residues_bound)
+    print(f"Matched residues: {n_res}")
+    print(f"Total residue pairs: {n_res * (n_res - 1) // 2}")
+
+    results = {}
+    for name in ("bound", "unbound"):
+        results[name] = process_system(name, getattr(occupancy, f"occ_{name}"), residue_labels, cutoff,
+                                       threshold, comm_method, comm_rows, output_formats, output_dtype,
+                                       getattr(occupancy, f"replicas_{name}", None), output_dir,
+                                       heatmap_max_cells, heatmap_downsample, heatmap_tiles)
+    return results
+
+
+def main():
+    # ========== Start Timer ==========
+    start_time = time.time()
+
+    # ========== Instrumentation ==========
+    inst = enable_instrumentation(profile_run, trace_memory) if report_path else get_instrumentation()
+
+    # ========== Contact Occupancy (cached) ==========
+    bound, unbound = gr_replica_systems(replicas["bound"], replicas["unbound"]) if replicas else gr_systems()
+    occupancy = matched_system_occupancies(bound, unbound, cutoff, chunk_size=chunk_size,
+                                           n_workers=n_workers, incremental=incremental,
+                                           adaptive=adaptive_sampling(threshold) if adaptive else None)
+
+    # Run for both systems
+    communicability_outputs(occupancy)
+
+    # ========== End Timer ==========
+    end_time = time.time()
+    print(f"\nTotal execution time: {end_time - start_time:.2f} seconds")
+
+    if report_path:
+        inst.write_report(report_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,446 @@
+"""Contact occupancies of the bound and unbound systems, computed once and cached on disk.
+
+Each system's residue-pair contact counts are stored as a sparse ``.npz`` in
+`cache_dir`, keyed by a fingerprint of the trajectory, a hash of the
+topology, the atom selection, the cutoff and the stride. Downstream steps
+(filter, interactions, matrix, pymol) only re-read that file, so changing
+`threshold` or `min_residue_separation` does not touch the trajectories.
+Residues come from the precomputed ``TopologyIndex`` of each structure, so
+cached runs do not parse the PDBs either.
+
+In incremental mode the cache is keyed by the trajectory's path instead and
+also records how far the file has been read, so a trajectory that grows
+between runs only has its new frames processed. In adaptive mode only as
+many frame blocks are read as the pairs near the threshold need to converge
+(see ``analysis.adaptive``); the sampling parameters are part of the key.
+When convergence is judged on the change between the conditions, both are
+sampled together and each system's key also covers the other systems.
+"""
+import hashlib
+import json
+import os
+from collections import namedtuple
+
+import numpy as np
+
+from analysis.adaptive import adaptive_contact_counts, adaptive_difference_counts
+from analysis.contacts import stream_contact_counts
+from analysis.instrument import get_instrumentation
+from analysis.parallel import parallel_contact_counts
+from analysis.topology_index import file_hash, match_residue_index, n_residues, topology_index
+from analysis.trajectory import DEFAULT_CHUNK_SIZE, count_frames, load_protein_topology
+
+CACHE_VERSION = 1
+DEFAULT_CACHE_DIR = ".occupancy_cache"
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+System = namedtuple("System", ["name", "xtc_path", "top_path", "selection"])
+MatchedOccupancy = namedtuple("MatchedOccupancy", ["matched_keys", "residues_bound", "residues_unbound",
+                                                   "occ_bound", "occ_unbound"])
+ReplicaOccupancy = namedtuple("ReplicaOccupancy", ["replicas", "n_frames", "pooled", "spread"])
+MatchedReplicaOccupancy = namedtuple("MatchedReplicaOccupancy",
+                                     MatchedOccupancy._fields + ("replicas_bound", "replicas_unbound"))
+
+
+def gr_systems(src_dir=SRC_DIR):
+    """The ligand-bound (chain B) and ligand-free (chain A) GR systems."""
+    bound = System("bound", os.path.join(src_dir, "md_skip_gr_ligand.xtc"),
+                   os.path.join(src_dir, "gr_ligand.pdb"), "protein and chainid 1")
+    unbound = System("unbound", os.path.join(src_dir, "md_skip_gr_only.xtc"),
+                     os.path.join(src_dir, "gr_only.pdb"), "protein and chainid 0")
+    return bound, unbound
+
+
+def replica_systems(name, xtc_paths, top_path, selection):
+    """One ``System`` per replica trajectory, named ``{name}_1``, ``{name}_2``, ..."""
+    return [System(f"{name}_{k}", xtc_path, top_path, selection)
+            for k, xtc_path in enumerate(xtc_paths, start=1)]
+
+
+def gr_replica_systems(bound_xtcs, unbound_xtcs, src_dir=SRC_DIR):
+    """Replicas of the bound and unbound GR systems; trajectory paths are relative to `src_dir`."""
+    bound, unbound = gr_systems(src_dir)
+    return (replica_systems(bound.name, [os.path.join(src_dir, p) for p in bound_xtcs],
+                            bound.top_path, bound.selection),
+            replica_systems(unbound.name, [os.path.join(src_dir, p) for p in unbound_xtcs],
+                            unbound.top_path, unbound.selection))
+
+
+# ========== Cache Keys ==========
+def trajectory_fingerprint(path, sample_size=1 << 20):
+    """Cheap content fingerprint of a trajectory: its size plus its first and last `sample_size` bytes.
+
+    Hashing multi-GB XTCs in full would cost more than reading the cache saves.
+    """
+    size = os.path.getsize(path)
+    digest = hashlib.sha256(str(size).encode())
+    with open(path, "rb") as f:
+        digest.update(f.read(sample_size))
+        if size > sample_size:
+            f.seek(max(sample_size, size - sample_size))
+            digest.update(f.read(sample_size))
+    return digest.hexdigest()
+
+
+def occupancy_cache_key(system, cutoff_nm, stride=1):
+    params = {
+        "version": CACHE_VERSION,
+        "trajectory": trajectory_fingerprint(system.xtc_path),
+        "topology": file_hash(system.top_path),
+        "selection": system.selection,
+        "cutoff": float(cutoff_nm),
+        "stride": int(stride),
+    }
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def occupancy_cache_path(system, cutoff_nm, stride=1, cache_dir=DEFAULT_CACHE_DIR):
+    key = occupancy_cache_key(system, cutoff_nm, stride)
+    return os.path.join(cache_dir, f"occupancy_{system.name}_{key}.npz")
+
+
+def incremental_cache_path(system, cutoff_nm, stride=1, cache_dir=DEFAULT_CACHE_DIR):
+    """Cache path of a growing trajectory, keyed by its location rather than its content."""
+    params = {
+        "version": CACHE_VERSION,
+        "trajectory": os.path.abspath(system.xtc_path),
+        "topology": file_hash(system.top_path),
+        "selection": system.selection,
+        "cutoff": float(cutoff_nm),
+        "stride": int(stride),
+    }
+    key = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f"occupancy_{system.name}_{key}_incremental.npz")
+
+
+def adaptive_cache_path(system, cutoff_nm, sampling, stride=1, cache_dir=DEFAULT_CACHE_DIR, sampled_with=()):
+    """Cache path of an adaptively sampled occupancy, keyed by the ``AdaptiveSampling`` parameters too.
+
+    `sampled_with` lists the systems sampled jointly with `system`, whose
+    frames decide when sampling stops.
+    """
+    params = {
+        "version": CACHE_VERSION,
+        "trajectory": trajectory_fingerprint(system.xtc_path),
+        "topology": file_hash(system.top_path),
+        "selection": system.selection,
+        "cutoff": float(cutoff_nm),
+        "stride": int(stride),
+        "adaptive": sampling._asdict(),
+    }
+    if sampled_with:
+        params["sampled_with"] = [[trajectory_fingerprint(other.xtc_path), file_hash(other.top_path),
+                                   other.selection] for other in sampled_with]
+    key = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f"occupancy_{system.name}_{key}_adaptive.npz")
+
+
+# ========== Cache I/O ==========
+def save_counts(path, counts, n_frames, **metadata):
+    """Write the non-zero upper-triangular entries of `counts` to `path` atomically."""
+    rows, cols = np.nonzero(np.triu(counts, 1))
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez_compressed(f, n_res=counts.shape[0], n_frames=n_frames, rows=rows.astype(np.int32),
+                            cols=cols.astype(np.int32), counts=counts[rows, cols],
+                            metadata=json.dumps(metadata))
+    os.replace(tmp_path, path)
+
+
+def load_counts(path):
+    """Read a count matrix written by ``save_counts``; returns (counts, n_frames, metadata)."""
+    with np.load(path) as data:
+        n_res = int(data["n_res"])
+        counts = np.zeros((n_res, n_res), dtype=np.int64)
+        counts[data["rows"], data["cols"]] = data["counts"]
+        return counts, int(data["n_frames"]), json.loads(str(data["metadata"]))
+
+
+# ========== Occupancy ==========
+def _compute_counts(systems, cutoff_nm, stride, chunk_size, n_workers, start_frames=None):
+    start_frames = start_frames or {}
+    with get_instrumentation().stage("occupancy_compute"):
+        if n_workers > 1:
+            return parallel_contact_counts(systems, cutoff_nm, n_workers, stride, chunk_size,
+                                           start_frames)
+        results = {}
+        for system in systems:
+            atom_indices, topology = load_protein_topology(system.top_path, system.selection)
+            results[system.name] = stream_contact_counts(system.xtc_path, system.top_path, atom_indices,
+                                                         list(topology.residues), cutoff_nm, chunk_size,
+                                                         stride, system.name,
+                                                         start_frames.get(system.name, 0))
+        return results
+
+
+def _load_incremental_state(system, path):
+    """Counts, frames and next raw frame of a previous run, or None if the trajectory was rewritten."""
+    if not os.path.exists(path):
+        return None
+    counts, n_frames, metadata = load_counts(path)
+    size = os.path.getsize(system.xtc_path)
+    head = _head_fingerprint(system.xtc_path, metadata["processed_size"])
+    # Appending frames leaves the processed prefix untouched
+    if size < metadata["processed_size"] or head != metadata["head_fingerprint"]:
+        print(f"[{system.name}] Trajectory changed since last run, recomputing from frame 0")
+        return None
+    return counts, n_frames, metadata["next_frame"]
+
+
+def _head_fingerprint(path, size):
+    digest = hashlib.sha256(str(size).encode())
+    with open(path, "rb") as f:
+        digest.update(f.read(min(size, 1 << 20)))
+    return digest.hexdigest()
+
+
+def _incremental_counts(systems, cutoff_nm, stride, chunk_size, cache_dir, n_workers):
+    paths = [incremental_cache_path(system, cutoff_nm, stride, cache_dir) for system in systems]
+    states = {}
+    for system, path in zip(systems, paths):
+        state = _load_incremental_state(system, path)
+        size = os.path.getsize(system.xtc_path)
+        if state is None:
+            state = (None, 0, 0)
+        states[system.name] = state + (size,)
+
+    pending = [system for system in systems
+               if count_frames(system.xtc_path) > states[system.name][2]]
+    start_frames = {name: state[2] for name, state in states.items()}
+    computed = _compute_counts(pending, cutoff_nm, stride, chunk_size, n_workers, start_frames) \
+        if pending else {}
+
+    results = []
+    for system, path in zip(systems, paths):
+        counts, n_frames, next_frame, size = states[system.name]
+        if system.name in computed:
+            new_counts, new_frames = computed[system.name]
+            counts = new_counts if counts is None else counts + new_counts
+            n_frames += new_frames
+            next_frame += new_frames * stride
+            save_counts(path, counts, n_frames, xtc_path=system.xtc_path, top_path=system.top_path,
+                        selection=system.selection, cutoff=cutoff_nm, stride=stride,
+                        next_frame=next_frame, processed_size=size,
+                        head_fingerprint=_head_fingerprint(system.xtc_path, size))
+            print(f"[{system.name}] Added {new_frames} new frames ({n_frames} total): {path}")
+        elif counts is None:
+            raise ValueError(f"No frames read from {system.xtc_path}")
+        else:
+            print(f"[{system.name}] No new frames since last run ({n_frames} total)")
+        results.append((topology_index(system.top_path, system.selection), counts, n_frames))
+    return results
+
+
+def _adaptive_counts(systems, cutoff_nm, stride, chunk_size, cache_dir, n_workers, sampling):
+    results = []
+    for system in systems:
+        path = adaptive_cache_path(system, cutoff_nm, sampling, stride, cache_dir)
+        if os.path.exists(path):
+            counts, n_frames, metadata = load_counts(path)
+            print(f"[{system.name}] Loaded cached adaptive occupancy ({n_frames} of "
+                  f"{metadata['frames_total']} frames): {path}")
+        else:
+            with get_instrumentation().stage("occupancy_adaptive"):
+                counts, n_frames, summary = adaptive_contact_counts(system, cutoff_nm, sampling, stride,
+                                                                    chunk_size, n_workers)
+            save_counts(path, counts, n_frames, xtc_path=system.xtc_path, top_path=system.top_path,
+                        selection=system.selection, cutoff=cutoff_nm, stride=stride,
+                        adaptive=sampling._asdict(), **summary)
+            print(f"[{system.name}] Adaptive occupancy cached to: {path}")
+        results.append((topology_index(system.top_path, system.selection), counts, n_frames))
+    return results
+
+
+def _adaptive_difference_counts(bound_systems, unbound_systems, cutoff_nm, stride, chunk_size, cache_dir,
+                                n_workers, sampling):
+    systems = list(bound_systems) + list(unbound_systems)
+    indices = [topology_index(system.top_path, system.selection) for system in systems]
+    paths = [adaptive_cache_path(system, cutoff_nm, sampling, stride, cache_dir, systems) for system in systems]
+    if all(os.path.exists(path) for path in paths):
+        results = []
+        for system, index, path in zip(systems, indices, paths):
+            counts, n_frames, metadata = load_counts(path)
+            print(f"[{system.name}] Loaded cached adaptive occupancy ({n_frames} of "
+                  f"{metadata['frames_total']} frames): {path}")
+            results.append((index, counts, n_frames))
+        return results
+
+    _, residues_bound, residues_unbound = match_residue_index(indices[0], indices[len(bound_systems)])
+    with get_instrumentation().stage("occupancy_adaptive"):
+        sampled = adaptive_difference_counts(bound_systems, unbound_systems, [res.index for res in residues_bound],
+                                             [res.index for res in residues_unbound], cutoff_nm, sampling,
+                                             stride, chunk_size, n_workers)
+    results = []
+    for system, index, path, (counts, n_frames, summary) in zip(systems, indices, paths, sampled):
+        save_counts(path, counts, n_frames, xtc_path=system.xtc_path, top_path=system.top_path,
+                    selection=system.selection, cutoff=cutoff_nm, stride=stride,
+                    adaptive=sampling._asdict(), **summary)
+        print(f"[{system.name}] Adaptive occupancy cached to: {path}")
+        results.append((index, counts, n_frames))
+    return results
+
+
+def system_counts(systems, cutoff_nm, stride=1, chunk_size=DEFAULT_CHUNK_SIZE,
+                  cache_dir=DEFAULT_CACHE_DIR, n_workers=1, incremental=False, adaptive=None):
+    """Contact counts over all residues of each system's selection, from the cache when possible.
+
+    Uncached systems are computed together, in `n_workers` processes when
+    `n_workers` > 1. With `incremental`, the cache follows each trajectory
+    file as it grows and only frames appended since the last run are read.
+    With `adaptive` (``adaptive.AdaptiveSampling``), each system is read in
+    blocks only until its pairs near the threshold have converged; criteria
+    on the change between conditions need ``matched_system_counts``. Returns
+    a list of (``TopologyIndex``, upper-triangular count matrix, number of
+    frames), one per system.
+    """
+    if incremental and adaptive is not None:
+        raise ValueError("Incremental and adaptive occupancy cannot be combined")
+    if adaptive is not None and adaptive.criterion != "occupancy":
+        raise ValueError(f"Adaptive sampling criterion {adaptive.criterion!r} compares the bound and unbound "
+                         f"systems; use matched_system_counts")
+    if adaptive is not None:
+        return _adaptive_counts(systems, cutoff_nm, stride, chunk_size, cache_dir, n_workers, adaptive)
+    if incremental:
+        return _incremental_counts(systems, cutoff_nm, stride, chunk_size, cache_dir, n_workers)
+    inst = get_instrumentation()
+    with inst.stage("cache_key"):
+        paths = [occupancy_cache_path(system, cutoff_nm, stride, cache_dir) for system in systems]
+    missing = [system for system, path in zip(systems, paths) if not os.path.exists(path)]
+    computed = _compute_counts(missing, cutoff_nm, stride, chunk_size, n_workers) if missing else {}
+
+    results = []
+    for system, path in zip(systems, paths):
+        if system.name in computed:
+            counts, n_frames = computed[system.name]
+            save_counts(path, counts, n_frames, xtc_path=system.xtc_path, top_path=system.top_path,
+                        selection=system.selection, cutoff=cutoff_nm, stride=stride)
+            print(f"[{system.name}] Occupancy cached to: {path}")
+        else:
+            with inst.stage("cache_load"):
+                counts, n_frames, _ = load_counts(path)
+            print(f"[{system.name}] Loaded cached occupancy: {path}")
+        with inst.stage("topology"):
+            results.append((topology_index(system.top_path, system.selection), counts, n_frames))
+    return results
+
+
+def system_occupancies(systems, cutoff_nm, stride=1, chunk_size=DEFAULT_CHUNK_SIZE,
+                       cache_dir=DEFAULT_CACHE_DIR, n_workers=1, incremental=False, adaptive=None):
+    """Like ``system_counts``, but returns (``TopologyIndex``, upper-triangular occupancy matrix) per system."""
+    return [(index, counts / n_frames) for index, counts, n_frames in
+            system_counts(systems, cutoff_nm, stride, chunk_size, cache_dir, n_workers, incremental, adaptive)]
+
+
+def system_occupancy(system, cutoff_nm, stride=1, chunk_size=DEFAULT_CHUNK_SIZE,
+                     cache_dir=DEFAULT_CACHE_DIR, n_workers=1, incremental=False, adaptive=None):
+    """Single-system ``system_occupancies``."""
+    return system_occupancies([system], cutoff_nm, stride, chunk_size, cache_dir, n_workers,
+                              incremental, adaptive)[0]
+
+
+def reindex_occupancy(occ_matrix, indices):
+    """Restrict an upper-triangular occupancy matrix to `indices`, keeping it upper-triangular."""
+    sub = occ_matrix[np.ix_(indices, indices)]
+    return np.triu(sub + sub.T, 1)
+
+
+def matched_system_counts(bound_systems, unbound_systems, cutoff_nm, stride=1, chunk_size=DEFAULT_CHUNK_SIZE,
+                          cache_dir=DEFAULT_CACHE_DIR, n_workers=1, incremental=False, adaptive=None):
+    """``system_counts`` of the bound then the unbound systems.
+
+    An `adaptive` criterion on the change between conditions ("difference"
+    or "both") samples both conditions together; any other setting computes
+    each system on its own.
+    """
+    if adaptive is not None and adaptive.criterion != "occupancy":
+        if incremental:
+            raise ValueError("Incremental and adaptive occupancy cannot be combined")
+        return _adaptive_difference_counts(bound_systems, unbound_systems, cutoff_nm, stride, chunk_size,
+                                           cache_dir, n_workers, adaptive)
+    return system_counts(list(bound_systems) + list(unbound_systems), cutoff_nm, stride, chunk_size, cache_dir,
+                         n_workers, incremental, adaptive)
+
+
+def matched_occupancies(bound, unbound, cutoff_nm, stride=1, chunk_size=DEFAULT_CHUNK_SIZE,
+                        cache_dir=DEFAULT_CACHE_DIR, n_workers=1, incremental=False, adaptive=None):
+    """Occupancy matrices of both systems over their matched residues."""
+    return match_counts(*matched_system_counts([bound], [unbound], cutoff_nm, stride, chunk_size, cache_dir,
+                                               n_workers, incremental, adaptive))
+
+
+def match_counts(bound_result, unbound_result):
+    """``MatchedOccupancy`` from the (``TopologyIndex``, counts, n_frames) results of the two systems."""
+    (index_bound, counts_bound, frames_bound), (index_unbound, counts_unbound, frames_unbound) = \
+        bound_result, unbound_result
+    matched_keys, residues_bound, residues_unbound = match_residue_index(index_bound, index_unbound)
+    return MatchedOccupancy(matched_keys, residues_bound, residues_unbound,
+                            reindex_occupancy(counts_bound / frames_bound, [res.index for res in residues_bound]),
+                            reindex_occupancy(counts_unbound / frames_unbound,
+                                              [res.index for res in residues_unbound]))
+
+
+# ========== Replica Ensembles ==========
+def replica_occupancy(counts, n_frames, indices=None):
+    """Per-replica, pooled and between-replica spread of the occupancy, restricted to `indices` if given.
+
+    The pooled occupancy weights every frame equally; the spread is the
+    standard deviation of the replica occupancies (0 for a single replica).
+    """
+    if indices is not None:
+        counts = [reindex_occupancy(c, indices) for c in counts]
+    n_frames = np.asarray(n_frames)
+    replicas = np.stack([c / n for c, n in zip(counts, n_frames)])
+    pooled = sum(counts) / n_frames.sum()
+    spread = replicas.std(axis=0, ddof=1) if len(replicas) > 1 else np.zeros_like(pooled)
+    return ReplicaOccupancy(replicas, n_frames, pooled, spread)
+
+
+def matched_replica_occupancies(bound_replicas, unbound_replicas, cutoff_nm, stride=1,
+                                chunk_size=DEFAULT_CHUNK_SIZE, cache_dir=DEFAULT_CACHE_DIR, n_workers=1,
+                                incremental=False, adaptive=None):
+    """Replica ensembles of both systems over their matched residues.
+
+    All replicas share their condition's topology and are computed in one
+    batch, so uncached replicas of both conditions run concurrently when
+    `n_workers` > 1; each replica is streamed on its own. ``occ_bound`` and
+    ``occ_unbound`` are the pooled occupancies, so the result can be used
+    wherever a ``MatchedOccupancy`` is expected.
+    """
+    results = matched_system_counts(bound_replicas, unbound_replicas, cutoff_nm, stride, chunk_size, cache_dir,
+                                    n_workers, incremental, adaptive)
+    return match_replica_counts(results[:len(bound_replicas)], results[len(bound_replicas):])
+
+
+def match_replica_counts(bound_results, unbound_results):
+    """``MatchedReplicaOccupancy`` from the (``TopologyIndex``, counts, n_frames) results of every replica."""
+    for replicas in (bound_results, unbound_results):
+        if any(n_residues(r[0]) != n_residues(replicas[0][0]) for r in replicas):
+            raise ValueError("All replicas of a condition must have the same residues")
+
+    matched_keys, residues_bound, residues_unbound = match_residue_index(bound_results[0][0],
+                                                                         unbound_results[0][0])
+    ensembles = []
+    for label, replicas, residues in (("bound", bound_results, residues_bound),
+                                      ("unbound", unbound_results, residues_unbound)):
+        ensemble = replica_occupancy([r[1] for r in replicas], [r[2] for r in replicas],
+                                     [res.index for res in residues])
+        contacting = ensemble.pooled > 0
+        spread = ensemble.spread[contacting].mean() if contacting.any() else 0.0
+        print(f"[{label}] {len(replicas)} replicas, {ensemble.n_frames.sum()} frames pooled, "
+              f"mean between-replica spread {spread:.3f}")
+        ensembles.append(ensemble)
+    return MatchedReplicaOccupancy(matched_keys, residues_bound, residues_unbound,
+                                   ensembles[0].pooled, ensembles[1].pooled, ensembles[0], ensembles[1])
+
+
+def matched_system_occupancies(bound, unbound, cutoff_nm, stride=1, chunk_size=DEFAULT_CHUNK_SIZE,
+                               cache_dir=DEFAULT_CACHE_DIR, n_workers=1, incremental=False, adaptive=None):
+    """``matched_occupancies`` for two systems, ``matched_replica_occupancies`` if either is a list of replicas."""
+    if isinstance(bound, System) and isinstance(unbound, System):
+        return matched_occupancies(bound, unbound, cutoff_nm, stride, chunk_size, cache_dir, n_workers,
+                                   incremental, adaptive)
+    bound = [bound] if isinstance(bound, System) else bound
+    unbound = [unbound] if isinstance(unbound, System) else unbound
+    return matched_replica_occupancies(bound, unbound, cutoff_nm, stride, chunk_size, cache_dir, n_workers,
+                                       incremental, adaptive)
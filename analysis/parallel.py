@@ -0,0 +1,77 @@
+"""Process-pool contact counting over frame blocks.
+
+Each system's trajectory is split into contiguous frame blocks that are
+counted in worker processes. Per-frame contact counts are additive, so
+summing the block results is exact. Blocks of all systems are submitted to
+the same pool and run concurrently.
+"""
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import mdtraj as md
+
+from analysis.contacts import accumulate_contact_counts
+from analysis.instrument import get_instrumentation, instrumented
+from analysis.trajectory import DEFAULT_CHUNK_SIZE, count_frames, frame_blocks, iter_frame_block
+
+
+def _mp_context():
+    # The analysis scripts run at import time, so workers must not re-import __main__
+    if "fork" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("fork")
+    return None
+
+
+@lru_cache(maxsize=None)
+def _load_selection(top_path, selection):
+    topology = md.load_topology(top_path)
+    atom_indices = topology.select(selection)
+    return topology, atom_indices, list(topology.subset(atom_indices).residues)
+
+
+def _block_counts(system, cutoff_nm, start, n_frames, chunk_size, stride, accumulate=accumulate_contact_counts):
+    # Counters are collected per worker and merged into the parent's instrumentation
+    with instrumented(progress=False) as inst:
+        topology, atom_indices, residues = _load_selection(system.top_path, system.selection)
+        chunks = iter_frame_block(system.xtc_path, topology, atom_indices, start, n_frames,
+                                  chunk_size, stride)
+        counts, block_frames = accumulate(chunks, residues, cutoff_nm)
+        return counts, block_frames, dict(inst.counters)
+
+
+def parallel_contact_counts(systems, cutoff_nm, n_workers, stride=1, chunk_size=DEFAULT_CHUNK_SIZE,
+                            start_frames=None, accumulate=accumulate_contact_counts):
+    """Contact counts of every system in `systems`, computed in `n_workers` processes.
+
+    `start_frames` optionally maps system names to the raw frame to start
+    from. `accumulate` is called as ``accumulate(chunks, residues, cutoff_nm)``
+    on every block and must return additive results, e.g.
+    ``accumulate_distance_histogram`` with `cutoff_nm` holding the bin edges.
+    Returns ``{system.name: (counts, n_frames)}``.
+    """
+    start_frames = start_frames or {}
+    inst = get_instrumentation()
+    futures = {}
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=_mp_context()) as pool:
+        for system in systems:
+            blocks = frame_blocks(count_frames(system.xtc_path), n_workers, stride,
+                                  start_frames.get(system.name, 0))
+            print(f"[{system.name}] Computing contact occupancy in {len(blocks)} blocks...")
+            futures[system.name] = [pool.submit(_block_counts, system, cutoff_nm, start, n,
+                                                chunk_size, stride, accumulate)
+                                    for start, n in blocks]
+
+        results = {}
+        for name, block_futures in futures.items():
+            counts, n_frames = None, 0
+            for future in block_futures:
+                block_counts, block_frames, counters = future.result()
+                inst.merge_counters(counters)
+                counts = block_counts if counts is None else counts + block_counts
+                n_frames += block_frames
+            if n_frames == 0:
+                raise ValueError(f"No frames read for system {name}")
+            print(f"[{name}] Progress: 100% (done)")
+            results[name] = (counts, n_frames)
+    return results
@@ -0,0 +1,328 @@
+"""Allosteric paths through the residue contact graph.
+
+Edges are the contacts occupied above the threshold, as in ``adjacency_matrix``,
+and are given path lengths so that strongly coupled residues are close:
+
+- "occupancy": -log(occupancy), so a path's length is minus the log of the
+  product of its contact occupancies;
+- "communicability": -log(G_ij / sqrt(G_ii G_jj)) of the communicability G,
+  which also credits the many longer walks between the two residues.
+
+All-pairs (or source-set) shortest paths come from one
+``scipy.sparse.csgraph.dijkstra`` call on the sparse graph. Node betweenness
+is counted by walking the predecessor matrix back from every target in
+vectorized steps. The k shortest loopless paths between two residues use
+Yen's algorithm on top of Dijkstra. The graph, distances, predecessors and
+betweenness are cached per occupancy matrix and parameters, and the k
+shortest paths found for each source/target pair are kept in a JSON file
+next to that cache, so later queries against the same graph only read it.
+"""
+import hashlib
+import heapq
+import json
+import os
+import time
+from collections import namedtuple
+
+import numpy as np
+import scipy.sparse
+from scipy.sparse.csgraph import dijkstra
+
+from analysis.communicability import adjacency_matrix, communicability
+from analysis.contacts import format_residue_labels
+from analysis.instrument import enable_instrumentation, get_instrumentation
+from analysis.occupancy import CACHE_VERSION, DEFAULT_CACHE_DIR, gr_replica_systems, gr_systems, \
+    matched_system_occupancies
+
+# ========== Parameters ==========
+cutoff = 0.4  # nm
+threshold = 0.5  # occupancy threshold for an edge
+path_weight = "occupancy"  # "occupancy" or "communicability" path lengths
+comm_method = "eigh"  # communicability method for "communicability" path lengths
+sources = None  # source residues (resSeq), e.g. ligand-binding residues; None for all-pairs paths
+targets = None  # target residues (resSeq) whose paths from every source are written
+k_paths = 3  # shortest loopless paths written per source/target pair
+output_path = "allosteric_paths.tsv"
+chunk_size = 500  # frames held in memory at once
+n_workers = os.cpu_count() or 1  # processes for uncached occupancy
+replicas = None  # e.g. {"bound": ["md_skip_gr_ligand_1.xtc", ...], "unbound": [...]} in src/
+report_path = None  # e.g. "run_report.json" for per-stage timings and counters
+
+PATH_WEIGHTS = ("occupancy", "communicability")
+MIN_LENGTH = 1e-9  # edge length floor; csgraph treats zero-length edges as missing
+
+# `k_shortest` memoizes k_shortest_paths per "source target" (see query_paths), saved next to `cache_path`
+PathResults = namedtuple("PathResults", ["graph", "sources", "distances", "predecessors", "betweenness",
+                                         "cache_path", "k_shortest"])
+
+
+# ========== Graph ==========
+def path_graph(occ_matrix, threshold=threshold, weight=path_weight, comm_method=comm_method):
+    """Symmetric CSR graph of the contacts above `threshold`, weighted by -log coupling (see module docstring)."""
+    if weight not in PATH_WEIGHTS:
+        raise ValueError(f"Unknown path weight: {weight}")
+    adj = adjacency_matrix(occ_matrix, threshold).tocoo()
+    if weight == "occupancy":
+        coupling = adj.data
+    else:
+        comm = communicability(adj.tocsr(), comm_method)
+        scale = np.sqrt(np.diag(comm))
+        coupling = comm[adj.row, adj.col] / (scale[adj.row] * scale[adj.col])
+    lengths = np.maximum(-np.log(np.clip(coupling, 0, 1)), MIN_LENGTH)
+    return scipy.sparse.csr_matrix((lengths, (adj.row, adj.col)), shape=adj.shape)
+
+
+# ========== Shortest Paths & Betweenness ==========
+def shortest_paths(graph, sources=None):
+    """(distances, predecessors) from `sources` (all residues if None), one row per source."""
+    with get_instrumentation().stage("shortest_paths"):
+        return dijkstra(graph, directed=False, indices=sources, return_predecessors=True)
+
+
+def reconstruct_path(predecessors, source, target):
+    """Residues of the shortest path from `source` to `target`, given the `predecessors` row of `source`."""
+    if source != target and predecessors[target] < 0:
+        return []
+    path = [target]
+    while path[-1] != source:
+        path.append(predecessors[path[-1]])
+    return [int(k) for k in path[::-1]]
+
+
+def betweenness(predecessors, sources):
+    """Shortest paths between `sources` (rows of `predecessors`) and every residue passing through each residue.
+
+    Every source/target pair counts its path once (ties between equally
+    short paths are broken by Dijkstra); with all residues as sources each
+    unordered pair is counted once. Endpoints are not counted.
+    """
+    with get_instrumentation().stage("betweenness"):
+        n_res = predecessors.shape[1]
+        counts = np.zeros(n_res)
+        source_col = np.asarray(sources)[:, None]
+        rows = np.arange(len(sources))[:, None]
+        # Step every (source, target) pair one residue back along its path per iteration
+        current = predecessors.copy()
+        inner = (current >= 0) & (current != source_col)
+        while inner.any():
+            counts += np.bincount(current[inner], minlength=n_res)
+            current = np.where(inner, predecessors[rows, np.maximum(current, 0)], -1)
+            inner = (current >= 0) & (current != source_col)
+        if len(sources) == n_res:
+            counts /= 2  # each unordered pair was walked from both ends
+    return counts
+
+
+def _without(graph, nodes, edges):
+    # `graph` minus every edge touching `nodes` and the undirected `edges`
+    coo = graph.tocoo()
+    n_res = graph.shape[0]
+    keep = ~(np.isin(coo.row, nodes) | np.isin(coo.col, nodes))
+    if edges:
+        edges = np.asarray(edges)
+        removed = np.concatenate([edges[:, 0] * n_res + edges[:, 1], edges[:, 1] * n_res + edges[:, 0]])
+        keep &= ~np.isin(coo.row.astype(np.int64) * n_res + coo.col, removed)
+    return scipy.sparse.csr_matrix((coo.data[keep], (coo.row[keep], coo.col[keep])), shape=graph.shape)
+
+
+def path_length(graph, path):
+    return float(np.asarray(graph[path[:-1], path[1:]]).sum()) if len(path) > 1 else 0.0
+
+
+def k_shortest_paths(graph, source, target, k=k_paths):
+    """Up to `k` shortest loopless paths from `source` to `target` (Yen's algorithm), as (length, path) pairs."""
+    graph = scipy.sparse.csr_matrix(graph)
+    distances, predecessors = dijkstra(graph, directed=False, indices=source, return_predecessors=True)
+    if np.isinf(distances[target]):
+        return []
+    paths = [(float(distances[target]), reconstruct_path(predecessors, source, target))]
+    candidates, seen = [], {tuple(paths[0][1])}
+    with get_instrumentation().stage("k_shortest_paths"):
+        while len(paths) < k:
+            previous = paths[-1][1]
+            for s in range(len(previous) - 1):
+                spur, root = previous[s], previous[:s + 1]
+                edges = [(p[s], p[s + 1]) for _, p in paths if len(p) > s + 1 and p[:s + 1] == root]
+                subgraph = _without(graph, root[:-1], edges)
+                spur_distances, spur_predecessors = dijkstra(subgraph, directed=False, indices=spur,
+                                                             return_predecessors=True)
+                if np.isinf(spur_distances[target]):
+                    continue
+                path = root[:-1] + reconstruct_path(spur_predecessors, spur, target)
+                if tuple(path) not in seen:
+                    seen.add(tuple(path))
+                    heapq.heappush(candidates, (path_length(graph, path), path))
+            if not candidates:
+                break
+            paths.append(heapq.heappop(candidates))
+    return paths
+
+
+# ========== Cache ==========
+def path_cache_path(occ_matrix, threshold, weight, comm_method, sources, cache_dir=DEFAULT_CACHE_DIR):
+    params = {
+        "version": CACHE_VERSION,
+        "occupancy": hashlib.sha256(np.ascontiguousarray(occ_matrix, dtype=np.float64).tobytes()).hexdigest(),
+        "threshold": float(threshold),
+        "weight": weight,
+        "comm_method": comm_method if weight == "communicability" else None,
+        "sources": None if sources is None else [int(s) for s in sources],
+    }
+    key = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f"paths_{key}.npz")
+
+
+def save_paths(path, results):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, indptr=results.graph.indptr, indices=results.graph.indices, data=results.graph.data,
+                 shape=results.graph.shape, sources=results.sources, distances=results.distances,
+                 predecessors=results.predecessors, betweenness=results.betweenness)
+    os.replace(tmp_path, path)
+
+
+def load_paths(path):
+    with np.load(path) as data:
+        graph = scipy.sparse.csr_matrix((data["data"], data["indices"], data["indptr"]), shape=tuple(data["shape"]))
+        return PathResults(graph, data["sources"], data["distances"], data["predecessors"], data["betweenness"],
+                           path, load_k_shortest(path))
+
+
+def k_shortest_cache_path(path):
+    return os.path.splitext(path)[0] + "_kshortest.json"
+
+
+def load_k_shortest(path):
+    """Memoized k shortest paths of the graph cached at `path` ({} if none were saved)."""
+    k_path = k_shortest_cache_path(path)
+    if not os.path.exists(k_path):
+        return {}
+    with open(k_path) as f:
+        return json.load(f)
+
+
+def save_k_shortest(results):
+    """Write ``results.k_shortest`` next to the graph cache, atomically; a no-op for uncached results."""
+    if results.cache_path is None or not results.k_shortest:
+        return
+    k_path = k_shortest_cache_path(results.cache_path)
+    tmp_path = k_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(results.k_shortest, f)
+    os.replace(tmp_path, k_path)
+
+
+def path_analysis(occ_matrix, threshold=threshold, weight=path_weight, comm_method=comm_method, sources=None,
+                  cache_dir=DEFAULT_CACHE_DIR, label=None):
+    """Cached ``PathResults`` of one occupancy matrix: shortest paths from `sources` (all if None) and betweenness."""
+    path = path_cache_path(occ_matrix, threshold, weight, comm_method, sources, cache_dir)
+    prefix = f"[{label}] " if label else ""
+    if os.path.exists(path):
+        print(f"{prefix}Loaded cached paths: {path}")
+        return load_paths(path)
+    graph = path_graph(occ_matrix, threshold, weight, comm_method)
+    sources = np.arange(graph.shape[0]) if sources is None else np.asarray(sources, dtype=np.int64)
+    distances, predecessors = shortest_paths(graph, sources)
+    results = PathResults(graph, sources, distances, predecessors, betweenness(predecessors, sources), path, {})
+    save_paths(path, results)
+    print(f"{prefix}Paths over {graph.nnz // 2} edges from {len(sources)} sources cached to: {path}")
+    return results
+
+
+# ========== Queries ==========
+def residue_positions(residues, resseqs):
+    """Positions in `residues` (e.g. ``occupancy.residues_bound``) of the residues numbered `resseqs`."""
+    position = {}
+    for k, res in enumerate(residues):
+        position.setdefault(res.resSeq, k)
+    missing = [r for r in resseqs if r not in position]
+    if missing:
+        raise ValueError(f"Residues not in the matched set: {missing}")
+    return [position[r] for r in resseqs]
+
+
+def query_paths(results, source, target, k=1):
+    """Up to `k` shortest (length, path) pairs from `source` to `target`; k = 1 reads the cached predecessors.
+
+    For k > 1, Yen's algorithm runs once per source/target pair and its
+    paths are memoized in ``results.k_shortest``; a later query for up to
+    as many paths reads them from there (``save_k_shortest`` persists them).
+    Yen's algorithm finds paths in order, so the first k of a larger query
+    are the k shortest.
+    """
+    if k > 1:
+        key = f"{source} {target}"
+        known = results.k_shortest.get(key)
+        # A memoized query covers k if it asked for as many paths or found all there are
+        if known is None or (known["k"] < k and len(known["paths"]) == known["k"]):
+            paths = k_shortest_paths(results.graph, source, target, k)
+            known = results.k_shortest[key] = {"k": k, "paths": [[length, path] for length, path in paths]}
+        return [(length, path) for length, path in known["paths"][:k]]
+    row = np.flatnonzero(results.sources == source)
+    if len(row) == 0:
+        return k_shortest_paths(results.graph, source, target, 1)
+    distance = results.distances[row[0], target]
+    if np.isinf(distance):
+        return []
+    return [(float(distance), reconstruct_path(results.predecessors[row[0]], source, target))]
+
+
+def write_paths(path, results_by_system, residues, source_positions, target_positions, k=k_paths):
+    """Tab-separated k shortest paths of every source/target pair in each system.
+
+    Paths found by Yen's algorithm are saved with each system's path cache.
+    """
+    labels = format_residue_labels(residues)
+    n_written = 0
+    with open(path, "w") as f:
+        f.write("System\tSource\tTarget\tRank\tLength\tCoupling\tResidues\n")
+        for name, results in results_by_system.items():
+            for source in source_positions:
+                for target in target_positions:
+                    if source == target:
+                        continue
+                    for rank, (length, residue_path) in enumerate(query_paths(results, source, target, k), 1):
+                        f.write(f"{name}\t{labels[source]}\t{labels[target]}\t{rank}\t{length:.4f}\t"
+                                f"{np.exp(-length):.4f}\t{' '.join(labels[r] for r in residue_path)}\n")
+                        n_written += 1
+    for results in results_by_system.values():
+        save_k_shortest(results)
+    return n_written
+
+
+def system_paths(occupancy, threshold=threshold, weight=path_weight, comm_method=comm_method, sources=None,
+                 cache_dir=DEFAULT_CACHE_DIR):
+    """``PathResults`` of both systems of a matched occupancy; `sources` are resSeqs (None for all pairs)."""
+    positions = None if sources is None else residue_positions(occupancy.residues_bound, sources)
+    return {name: path_analysis(getattr(occupancy, f"occ_{name}"), threshold, weight, comm_method, positions,
+                                cache_dir, name)
+            for name in ("bound", "unbound")}
+
+
+def main():
+    start_time = time.time()
+    inst = enable_instrumentation() if report_path else get_instrumentation()
+
+    bound, unbound = gr_replica_systems(replicas["bound"], replicas["unbound"]) if replicas else gr_systems()
+    occupancy = matched_system_occupancies(bound, unbound, cutoff, chunk_size=chunk_size, n_workers=n_workers)
+    results = system_paths(occupancy, threshold, path_weight, comm_method, sources)
+
+    labels = format_residue_labels(occupancy.residues_bound)
+    for name, result in results.items():
+        top = np.argsort(result.betweenness)[::-1][:10]
+        print(f"\n{name} highest betweenness: " + ", ".join(f"{labels[k]} ({result.betweenness[k]:.0f})"
+                                                            for k in top))
+    if sources is not None and targets is not None:
+        n_written = write_paths(output_path, results, occupancy.residues_bound,
+                                residue_positions(occupancy.residues_bound, sources),
+                                residue_positions(occupancy.residues_bound, targets), k_paths)
+        print(f"{n_written} paths saved to: {output_path}")
+
+    print(f"\nTotal execution time: {time.time() - start_time:.2f} seconds")
+    if report_path:
+        inst.write_report(report_path)
+
+
+if __name__ == "__main__":
+    main()
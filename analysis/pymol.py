@@ -1,177 +1,229 @@
-# import mdtraj as md
-# import os
-# import itertools
-# import numpy as np
-# import time
-
-# # ========== Start Timer ==========
-# start_time = time.time()
-
-# # ========== Parameters ==========
-# cutoff = 0.4    # nm for contact
-# threshold = 0.5 # occupancy threshold for filtering
-# progress_steps = 100  # % steps to show
-
-# # ========== Paths ==========
-# script_dir = os.path.dirname(os.path.abspath(__file__))
-# src_dir = os.path.join(script_dir, "..", "src")
-
-# # ========== Load Trajectories ==========
-# print("Loading trajectories...")
-# traj_bound = md.load(os.path.join(src_dir, "md_skip_gr_ligand.xtc"),
-#                      top=os.path.join(src_dir, "gr_ligand.pdb"))
-# traj_unbound = md.load(os.path.join(src_dir, "md_skip_gr_only.xtc"),
-#                        top=os.path.join(src_dir, "gr_only.pdb"))
-
-# # ========== Chain Selection ==========
-# protein_bound = traj_bound.atom_slice(
-#     traj_bound.topology.select("protein and chainid 1"))  # Chain B
-
-# protein_unbound = traj_unbound.atom_slice(
-#     traj_unbound.topology.select("protein and chainid 0"))  # Chain A
-
-# # ========== Structural Debug Check ==========
-# print("=== Structural Debug Check ===")
-# print(f"Selected from gr_ligand (chain B): {protein_bound.n_atoms} atoms, {len(list(protein_bound.topology.residues))} residues")
-# print(f"Selected from gr_only (chain A): {protein_unbound.n_atoms} atoms, {len(list(protein_unbound.topology.residues))} residues")
-# print()
-
-# # ========== Residue Matching ==========
-# def get_residue_dict(topology):
-#     res_dict = {}
-#     for res in topology.residues:
-#         chain_id = res.chain.index
-#         res_id = res.resSeq
-#         res_dict[(chain_id, res_id)] = res
-#     return res_dict
-
-# res_dict_bound = get_residue_dict(protein_bound.topology)
-# res_dict_unbound = get_residue_dict(protein_unbound.topology)
-# matched_keys = sorted(set(res_dict_bound.keys()) & set(res_dict_unbound.keys()))
-
-# residues_bound = [res_dict_bound[k] for k in matched_keys]
-# residues_unbound = [res_dict_unbound[k] for k in matched_keys]
-# residue_pairs = list(itertools.combinations(range(len(matched_keys)), 2))
-
-# print(f"Matched residues: {len(matched_keys)}")
-# print(f"Total residue pairs: {len(residue_pairs)}")
-
-# with open("matched_residues.txt", "w") as f:
-#     for idx, key in enumerate(matched_keys):
-#         f.write(f"{idx}: Chain {key[0]}, ResSeq {key[1]}\n")
-
-# # ========== Optimized Contact Occupancy Function ==========
-# def contact_occupancy_fast(traj, residues, pairs, cutoff_nm, label):
-#     print(f"\nComputing contact occupancy ({label}) [fast]...")
-#     n_frames = traj.n_frames
-#     occupancies = {}
-
-#     progress_intervals = max(1, len(pairs) // progress_steps)
-#     for idx, (i, j) in enumerate(pairs):
-#         if idx % progress_intervals == 0:
-#             print(f"Progress: {idx * 100 // len(pairs)}%")
-
-#         res1 = residues[i]
-#         res2 = residues[j]
-
-#         atoms1 = [a.index for a in res1.atoms if a.element.symbol != "H"]
-#         atoms2 = [a.index for a in res2.atoms if a.element.symbol != "H"]
-
-#         if not atoms1 or not atoms2:
-#             continue
-
-#         atom_pairs = np.array(list(itertools.product(atoms1, atoms2)))
-#         distances = md.compute_distances(traj, atom_pairs)
-#         contact_frames = np.any(distances < cutoff_nm, axis=1)
-#         occupancy = np.sum(contact_frames) / n_frames
-
-#         if occupancy > 0:
-#             occupancies[(i, j)] = occupancy
-
-#     print("Progress: 100% (done)")
-#     return occupancies
-
-# # ========== Compute Occupancies ==========
-# occ_bound = contact_occupancy_fast(protein_bound, residues_bound, residue_pairs, cutoff, "bound")
-# occ_unbound = contact_occupancy_fast(protein_unbound, residues_unbound, residue_pairs, cutoff, "unbound")
-
-# # ========== Filter by Occupancy Threshold ==========
-# filtered_pairs = [
-#     pair for pair in residue_pairs
-#     if occ_bound.get(pair, 0) > threshold or occ_unbound.get(pair, 0) > threshold
-# ]
-# print(f"Filtered to {len(filtered_pairs)} pairs with occupancy > {threshold}")
-
-# # ========== Generate PyMOL Script (Excluding Close Residue Contacts) ==========
-# pml_file = "contacts_longrange.pml"
-# structure_path = os.path.join(src_dir, "gr_ligand.pdb")  # reference structure
-
-# with open(pml_file, "w") as f:
-#     f.write(f"load {structure_path}, structure\n")
-#     f.write("hide everything\nshow cartoon, structure\n\n")
-
-#     n_written = 0
-#     for i, j in filtered_pairs:
-#         resi1 = residues_bound[i].resSeq
-#         resi2 = residues_bound[j].resSeq
-
-#         if abs(resi1 - resi2) <= 20:
-#             continue  # Skip close-range contacts
-
-#         name = f"contact_{resi1}_{resi2}"
-#         f.write(
-#             f"distance {name}, "
-#             f"structure and resi {resi1} and name CA, "
-#             f"structure and resi {resi2} and name CA\n"
-#         )
-#         n_written += 1
-
-#     f.write("\nhide labels\n")
-#     f.write("color green, name contact_*\n")
-#     f.write("set dash_color, cyan\n")
-#     f.write("set dash_width, 2\n")
-#     f.write("zoom\n")
-
-# print(f"PyMOL script written to: {pml_file} (long-range only, {n_written} contacts)")
-
-# # ========== End Timer ==========
-# end_time = time.time()
-# print(f"\nTotal execution time: {end_time - start_time:.2f} seconds")
-
-# draw_contacts_pymol.py
-
-input_file = "significant_long_range_pairs.txt"
-output_pml = "draw_contacts.pml"
-
-with open(input_file, "r") as f:
-    lines = f.readlines()[1:]  # Skip header
-
-with open(output_pml, "w") as f_out:
-    f_out.write("hide everything\n")
-    f_out.write("show cartoon\n")
-    f_out.write("color gray70, all\n")
-    f_out.write("bg_color white\n")
-    f_out.write("set dash_width, 2.0\n")
-    f_out.write("set dash_color, red\n\n")
-
-    for line in lines:
-        cols = line.strip().split("\t")
-        if len(cols) < 5:
-            continue
-        label1 = cols[3]
-        label2 = cols[4]
-
-        # Parse residue and chain (assuming chain0 maps to chain A)
-        res1, chain1 = label1.split("_")
-        res2, chain2 = label2.split("_")
-        resn1 = ''.join(filter(str.isalpha, res1))
-        resi1 = ''.join(filter(str.isdigit, res1))
-        resn2 = ''.join(filter(str.isalpha, res2))
-        resi2 = ''.join(filter(str.isdigit, res2))
-        pymol_chain1 = "A"  # adjust if your chain is different
-        pymol_chain2 = "A"
-
-        # Draw dashed line between CAs
-        f_out.write(f"distance resi{resi1}_to_resi{resi2}, "
-                    f"/gr_only//{pymol_chain1}/{resi1}/CA, "
-                    f"/gr_only//{pymol_chain2}/{resi2}/CA\n")
+"""PyMOL scripts of residue contacts.
+
+``write_contact_cgo`` writes a Python script that draws every contact as one
+compiled CGO object: a Cα-Cα cylinder per pair, red where the occupancy rises
+on unbinding and blue where it falls, with color depth and radius scaled by
+the size of the change. PyMOL builds the whole object with a single
+``cmd.load_cgo`` call instead of evaluating a ``distance`` command per pair,
+so thousands of contacts load almost at once. Pairs are read straight from
+the matched occupancy, and chain IDs come from the structure's topology.
+Run the script in PyMOL with ``run contacts_cgo.py``.
+"""
+import mdtraj as md
+import numpy as np
+
+from analysis.filter import min_residue_separation, significant_long_range_pairs
+from analysis.occupancy import gr_systems, matched_occupancies
+from analysis.trajectory import calpha_atoms
+
+# ========== Parameters ==========
+cutoff = 0.4    # nm for contact
+threshold = 0.5 # occupancy threshold for filtering
+export_longrange = False  # also write contacts_longrange from the cached occupancies
+script_format = "cgo"  # "cgo" (one compiled object, fast to load) or "distance" (one PyMOL distance per pair)
+cgo_output = "contacts_cgo.py"
+min_radius = 0.1  # Å, cylinder radius of the smallest occupancy change
+max_radius = 0.5  # Å, cylinder radius of the largest occupancy change
+
+SCRIPT_FORMATS = ("cgo", "distance")
+CGO_CYLINDER = 9.0  # pymol.cgo.CYLINDER
+FORMED_COLOR = np.array([0.85, 0.1, 0.1])  # occupancy higher unbound
+BROKEN_COLOR = np.array([0.1, 0.3, 0.9])  # occupancy higher bound
+BASE_COLOR = np.array([0.85, 0.85, 0.85])  # color of a vanishing change
+
+
+# ========== Compiled CGO Contacts ==========
+def _pair_arrays(pairs):
+    pairs = np.asarray(pairs, dtype=float).reshape(len(pairs), -1) if len(pairs) else np.zeros((0, 2))
+    return pairs[:, 0].astype(np.int64), pairs[:, 1].astype(np.int64)
+
+
+def contact_cylinders(occupancy, pairs, structure_path, selection, min_radius=min_radius, max_radius=max_radius):
+    """CGO cylinders of matched residue `pairs` of ``occupancy``, and the residues they join.
+
+    `pairs` are (i, j, ...) rows indexing ``occupancy.residues_bound``
+    (e.g. ``significant_long_range_pairs`` output). Cylinders run between the
+    Cα atoms of `selection` in `structure_path` and are colored and sized by
+    ``occ_unbound - occ_bound``. Pairs with a residue lacking a Cα are
+    dropped. Returns a (n_pairs, 14) float array of CGO cylinder entries and
+    the (chain ID, resSeq) of every residue drawn.
+    """
+    rows, cols = _pair_arrays(pairs)
+    atom_indices, positions = calpha_atoms(structure_path, selection)
+    calphas = md.load(structure_path, atom_indices=atom_indices)
+    xyz = calphas.xyz[0].astype(np.float64) * 10  # nm to Å
+
+    ca_row = np.full(max(positions.max(), max(res.index for res in occupancy.residues_bound)) + 1, -1)
+    ca_row[positions] = np.arange(len(positions))
+    residue_rows = ca_row[[res.index for res in occupancy.residues_bound]]
+    start, end = residue_rows[rows], residue_rows[cols]
+    present = (start >= 0) & (end >= 0)
+    if not present.all():
+        print(f"Skipped {np.count_nonzero(~present)} pairs with a residue lacking a Cα")
+    rows, cols, start, end = rows[present], cols[present], start[present], end[present]
+
+    delta = occupancy.occ_unbound[rows, cols] - occupancy.occ_bound[rows, cols]
+    scale = np.abs(delta) / np.abs(delta).max() if len(delta) and np.abs(delta).max() > 0 else np.zeros(len(delta))
+    colors = np.where((delta > 0)[:, None], FORMED_COLOR, BROKEN_COLOR)
+    colors = BASE_COLOR + (colors - BASE_COLOR) * scale[:, None]
+    radius = min_radius + (max_radius - min_radius) * scale
+
+    cylinders = np.column_stack([np.full(len(delta), CGO_CYLINDER), xyz[start], xyz[end], radius, colors, colors])
+    chain_ids = [atom.residue.chain.chain_id for atom in calphas.topology.atoms]
+    drawn = sorted({(chain_ids[k], int(occupancy.residues_bound[i].resSeq))
+                    for k, i in zip(np.concatenate([start, end]), np.concatenate([rows, cols]))})
+    return cylinders, drawn
+
+
+def residue_selection(residues):
+    """PyMOL selection of (chain ID, resSeq) `residues`, one ``chain X and resi a+b+...`` clause per chain."""
+    by_chain = {}
+    for chain_id, resseq in residues:
+        by_chain.setdefault(chain_id, []).append(str(resseq))
+    clauses = [f"(chain {chain_id} and resi {'+'.join(resis)})" if chain_id else f"(resi {'+'.join(resis)})"
+               for chain_id, resis in by_chain.items()]
+    return " or ".join(clauses) or "none"
+
+
+def write_contact_cgo(path, occupancy, pairs, structure_path, selection, object_name="contacts",
+                      min_radius=min_radius, max_radius=max_radius):
+    """Write a PyMOL Python script loading `structure_path` and drawing `pairs` as one CGO object.
+
+    See ``contact_cylinders`` for `pairs` and the encoding. The residues
+    involved are selected as ``{object_name}_residues``. Returns `path`.
+    """
+    cylinders, residues = contact_cylinders(occupancy, pairs, structure_path, selection, min_radius, max_radius)
+    with open(path, "w") as f:
+        f.write("from pymol import cmd\n\n")
+        f.write(f"cmd.load(r\"{structure_path}\", \"structure\")\n")
+        f.write("cmd.hide(\"everything\")\ncmd.show(\"cartoon\", \"structure\")\n")
+        f.write("cmd.color(\"gray70\", \"structure\")\ncmd.bg_color(\"white\")\n\n")
+        # One CGO cylinder per line: CYLINDER, x1, y1, z1, x2, y2, z2, radius, rgb1, rgb2
+        f.write(f"{object_name} = [\n")
+        np.savetxt(f, cylinders, fmt="%.3f", delimiter=", ", newline=",\n")
+        f.write("]\n")
+        f.write(f"cmd.load_cgo({object_name}, \"{object_name}\")\n")
+        f.write(f"cmd.select(\"{object_name}_residues\", \"structure and ({residue_selection(residues)})\")\n")
+        f.write("cmd.deselect()\ncmd.zoom(\"structure\")\n")
+    print(f"PyMOL CGO script written to: {path} ({len(cylinders)} contacts, {len(residues)} residues)")
+    return path
+
+
+# ========== Long-Range Contacts from Cached Occupancy ==========
+def longrange_pairs(occupancy, threshold=threshold, min_resi_separation=20):
+    """(i, j) of matched pairs occupied above `threshold` in either system whose resSeqs differ by more than `min_resi_separation`."""
+    occupied = (occupancy.occ_bound > threshold) | (occupancy.occ_unbound > threshold)
+    rows, cols = np.nonzero(np.triu(occupied, 1))
+    resseq = np.array([res.resSeq for res in occupancy.residues_bound])
+    kept = np.abs(resseq[rows] - resseq[cols]) > min_resi_separation
+    print(f"Filtered to {len(rows)} pairs with occupancy > {threshold}")
+    return np.column_stack([rows[kept], cols[kept]])
+
+
+def write_longrange_script(pml_file="contacts_longrange.pml", min_resi_separation=20, occupancy=None,
+                           structure_path=None, threshold=threshold, script_format="distance",
+                           selection=None):
+    """Write a PyMOL script of the long-range pairs occupied above `threshold` in either system.
+
+    Uses the cached GR occupancy at `cutoff` unless a matched `occupancy` is
+    given. `script_format` "cgo" writes a ``write_contact_cgo`` script
+    (Cα atoms taken from `selection` of `structure_path`), "distance" one
+    PyMOL distance per pair.
+    """
+    if script_format not in SCRIPT_FORMATS:
+        raise ValueError(f"Unknown PyMOL script format: {script_format}")
+    if occupancy is None:
+        bound, unbound = gr_systems()
+        occupancy = matched_occupancies(bound, unbound, cutoff)
+        structure_path, selection = bound.top_path, bound.selection
+    if structure_path is None or selection is None:
+        reference = gr_systems()[0]  # reference structure
+        structure_path, selection = structure_path or reference.top_path, selection or reference.selection
+    pairs = longrange_pairs(occupancy, threshold, min_resi_separation)
+
+    if script_format == "cgo":
+        return write_contact_cgo(pml_file, occupancy, pairs, structure_path, selection, "longrange_contacts")
+
+    with open(pml_file, "w") as f:
+        f.write(f"load {structure_path}, structure\n")
+        f.write("hide everything\nshow cartoon, structure\n\n")
+
+        for i, j in pairs:
+            resi1 = occupancy.residues_bound[i].resSeq
+            resi2 = occupancy.residues_bound[j].resSeq
+            name = f"contact_{resi1}_{resi2}"
+            f.write(
+                f"distance {name}, "
+                f"structure and resi {resi1} and name CA, "
+                f"structure and resi {resi2} and name CA\n"
+            )
+
+        f.write("\nhide labels\n")
+        f.write("color green, name contact_*\n")
+        f.write("set dash_color, cyan\n")
+        f.write("set dash_width, 2\n")
+        f.write("zoom\n")
+
+    print(f"PyMOL script written to: {pml_file} (long-range only, {len(pairs)} contacts)")
+    return pml_file
+
+
+# ========== Significant Contacts from filter.py ==========
+def draw_contacts(input_file="significant_long_range_pairs.txt", output_pml="draw_contacts.pml"):
+    """Write a PyMOL script drawing a dashed CA-CA distance for every pair in `input_file`.
+
+    Chains are not recorded in `input_file` and are assumed to be "A";
+    ``write_contact_cgo`` reads pairs and chains from the occupancy instead.
+    """
+    with open(input_file, "r") as f:
+        lines = f.readlines()[1:]  # Skip header
+
+    with open(output_pml, "w") as f_out:
+        f_out.write("hide everything\n")
+        f_out.write("show cartoon\n")
+        f_out.write("color gray70, all\n")
+        f_out.write("bg_color white\n")
+        f_out.write("set dash_width, 2.0\n")
+        f_out.write("set dash_color, red\n\n")
+
+        for line in lines:
+            cols = line.strip().split("\t")
+            if len(cols) < 5:
+                continue
+            label1 = cols[3]
+            label2 = cols[4]
+
+            # Parse residue and chain (assuming chain0 maps to chain A)
+            res1, chain1 = label1.split("_")
+            res2, chain2 = label2.split("_")
+            resn1 = ''.join(filter(str.isalpha, res1))
+            resi1 = ''.join(filter(str.isdigit, res1))
+            resn2 = ''.join(filter(str.isalpha, res2))
+            resi2 = ''.join(filter(str.isdigit, res2))
+            pymol_chain1 = "A"  # adjust if your chain is different
+            pymol_chain2 = "A"
+
+            # Draw dashed line between CAs
+            f_out.write(f"distance resi{resi1}_to_resi{resi2}, "
+                        f"/gr_only//{pymol_chain1}/{resi1}/CA, "
+                        f"/gr_only//{pymol_chain2}/{resi2}/CA\n")
+    return output_pml
+
+
+def main():
+    if script_format not in SCRIPT_FORMATS:
+        raise ValueError(f"Unknown PyMOL script format: {script_format}")
+    if export_longrange:
+        write_longrange_script("contacts_longrange.py" if script_format == "cgo" else "contacts_longrange.pml",
+                               script_format=script_format)
+    if script_format == "distance":
+        draw_contacts()
+        return
+    bound, unbound = gr_systems()
+    occupancy = matched_occupancies(bound, unbound, cutoff)
+    pairs = significant_long_range_pairs(occupancy, threshold, min_residue_separation)
+    write_contact_cgo(cgo_output, occupancy, pairs, bound.top_path, bound.selection)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+"""Per-residue RMSF profiles of replica ensembles.
+
+Profiles come either from GROMACS ``gmx rmsf -res`` .xvg files or straight
+from the trajectories. The trajectory path is a single streaming pass: every
+chunk is superposed onto the topology structure and merged into running
+per-atom means and sums of squared deviations (Welford/Chan), so memory is
+set by the chunk size. Replicas run in parallel processes and each profile is
+cached as an ``.npz`` keyed by the trajectory fingerprint, topology hash,
+atom selection and stride.
+"""
+import hashlib
+import json
+import os
+import re
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib.pyplot as plt
+import mdtraj as md
+import numpy as np
+
+from analysis.instrument import get_instrumentation
+from analysis.occupancy import (CACHE_VERSION, DEFAULT_CACHE_DIR, file_hash, replica_systems,
+                                trajectory_fingerprint)
+from analysis.parallel import _mp_context
+from analysis.trajectory import DEFAULT_CHUNK_SIZE, iter_protein_chunks, load_protein_topology
+
+GR_HELICES = [
+    (32, 51), (92, 94), (140, 168), (170, 172), (175, 205),
+    (207, 215), (220, 222), (224, 256), (262, 291), (304, 334),
+    (345, 360), (362, 368), (372, 374), (378, 402), (407, 422)
+]
+
+RmsfProfile = namedtuple("RmsfProfile", ["resids", "rmsf", "n_frames"])
+
+_XVG_SKIP = re.compile(rb"^[ \t]*[#@&].*$", re.M)
+
+
+# ========== .xvg Files ==========
+def read_xvg(path):
+    """Numeric columns of a GROMACS .xvg file as an (n_rows, n_columns) array; comment and legend lines are skipped."""
+    with open(path, "rb") as f:
+        data = _XVG_SKIP.sub(b"", f.read())
+    values = np.array(data.split(), dtype=np.float64)
+    if len(values) == 0:
+        raise ValueError(f"No data in {path}")
+    n_cols = len(data.lstrip().split(b"\n", 1)[0].split())
+    return values.reshape(-1, n_cols)
+
+
+def load_rmsf_data(filenames, base_dir=None):
+    """Load RMSF data from a list of .xvg files. Assumes all files share the same x-axis."""
+    tables = [read_xvg(os.path.join(base_dir, fname) if base_dir else fname) for fname in filenames]
+    return tables[0][:, 0], np.array([table[:, 1] for table in tables])
+
+
+# ========== Streaming RMSF ==========
+def merge_moments(moments, xyz):
+    """Fold a chunk of coordinates into running (n, mean, M2) moments (Chan et al.); `moments` may be None."""
+    k = len(xyz)
+    chunk_mean = xyz.mean(axis=0)
+    chunk_m2 = ((xyz - chunk_mean) ** 2).sum(axis=0)
+    if moments is None:
+        return k, chunk_mean, chunk_m2
+    n, mean, m2 = moments
+    n_new = n + k
+    delta = chunk_mean - mean
+    return n_new, mean + delta * (k / n_new), m2 + chunk_m2 + delta ** 2 * (n * k / n_new)
+
+
+def accumulate_rmsf(chunks, reference, label=None):
+    """Per-atom RMSF (nm) of superposed `chunks` in one pass; returns (rmsf, n_frames).
+
+    Every frame is least-squares fitted onto the first frame of `reference`,
+    which holds the same atoms as the chunks.
+    """
+    inst = get_instrumentation()
+    moments = None
+    chunks = iter(chunks)
+    while True:
+        with inst.stage("read"):
+            chunk = next(chunks, None)
+        if chunk is None:
+            break
+        with inst.stage("superpose"):
+            chunk.superpose(reference)
+        with inst.stage("moments"):
+            moments = merge_moments(moments, chunk.xyz.astype(np.float64))
+        inst.count("frames", chunk.n_frames)
+        if label is not None:
+            inst.progress(label, f"Frames processed: {moments[0]}")
+    if moments is None:
+        return None, 0
+    n, _, m2 = moments
+    return np.sqrt(m2.sum(axis=-1) / n), n
+
+
+def residue_average(atom_values, topology):
+    """Mean of per-atom values over the atoms of each residue of `topology`; returns (resSeq, means)."""
+    atom_residue = np.array([atom.residue.index for atom in topology.atoms])
+    sums = np.bincount(atom_residue, weights=atom_values, minlength=topology.n_residues)
+    sizes = np.bincount(atom_residue, minlength=topology.n_residues)
+    return np.array([res.resSeq for res in topology.residues]), sums / sizes
+
+
+def _rmsf_atoms(system, atom_selection):
+    selection = f"({system.selection}) and ({atom_selection})" if atom_selection else system.selection
+    return load_protein_topology(system.top_path, selection)
+
+
+def compute_rmsf(system, atom_selection=None, stride=1, chunk_size=DEFAULT_CHUNK_SIZE, label=None):
+    """Streaming per-residue ``RmsfProfile`` of one system.
+
+    `atom_selection` narrows the system's selection (e.g. ``"name CA"``);
+    residue values average the RMSF of their selected atoms, as
+    ``gmx rmsf -res`` does.
+    """
+    atom_indices, topology = _rmsf_atoms(system, atom_selection)
+    reference = md.load(system.top_path, atom_indices=atom_indices)
+    chunks = iter_protein_chunks(system.xtc_path, system.top_path, atom_indices, chunk_size, stride)
+    atom_rmsf, n_frames = accumulate_rmsf(chunks, reference, label)
+    if n_frames == 0:
+        raise ValueError(f"No frames read from {system.xtc_path}")
+    resids, rmsf = residue_average(atom_rmsf, topology)
+    return RmsfProfile(resids, rmsf, n_frames)
+
+
+# ========== Cache ==========
+def rmsf_cache_path(system, atom_selection=None, stride=1, cache_dir=DEFAULT_CACHE_DIR):
+    params = {
+        "version": CACHE_VERSION,
+        "trajectory": trajectory_fingerprint(system.xtc_path),
+        "topology": file_hash(system.top_path),
+        "selection": system.selection,
+        "atom_selection": atom_selection,
+        "stride": int(stride),
+    }
+    key = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f"rmsf_{system.name}_{key}.npz")
+
+
+def save_rmsf(path, profile, **metadata):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, resids=profile.resids, rmsf=profile.rmsf, n_frames=profile.n_frames,
+                 metadata=json.dumps(metadata))
+    os.replace(tmp_path, path)
+
+
+def load_rmsf(path):
+    with np.load(path) as data:
+        return RmsfProfile(data["resids"], data["rmsf"], int(data["n_frames"]))
+
+
+def system_rmsf(systems, atom_selection=None, stride=1, chunk_size=DEFAULT_CHUNK_SIZE,
+                cache_dir=DEFAULT_CACHE_DIR, n_workers=1):
+    """``RmsfProfile`` of every system (e.g. the replicas of one ensemble), from the cache when possible.
+
+    Uncached systems are computed in up to `n_workers` processes, one per system.
+    """
+    inst = get_instrumentation()
+    paths = [rmsf_cache_path(system, atom_selection, stride, cache_dir) for system in systems]
+    missing = [system for system, path in zip(systems, paths) if not os.path.exists(path)]
+
+    computed = {}
+    with inst.stage("rmsf_compute"):
+        if missing and n_workers > 1 and len(missing) > 1:
+            print(f"\nComputing RMSF of {len(missing)} trajectories in parallel...")
+            with ProcessPoolExecutor(max_workers=min(n_workers, len(missing)), mp_context=_mp_context()) as pool:
+                futures = {system.name: pool.submit(compute_rmsf, system, atom_selection, stride, chunk_size)
+                           for system in missing}
+                computed = {name: future.result() for name, future in futures.items()}
+        else:
+            for system in missing:
+                print(f"\nComputing RMSF ({system.name})...")
+                computed[system.name] = compute_rmsf(system, atom_selection, stride, chunk_size, system.name)
+
+    profiles = []
+    for system, path in zip(systems, paths):
+        if system.name in computed:
+            profile = computed[system.name]
+            save_rmsf(path, profile, xtc_path=system.xtc_path, top_path=system.top_path,
+                      selection=system.selection, atom_selection=atom_selection, stride=stride)
+            print(f"[{system.name}] RMSF over {profile.n_frames} frames cached to: {path}")
+        else:
+            profile = load_rmsf(path)
+            print(f"[{system.name}] Loaded cached RMSF: {path}")
+        profiles.append(profile)
+    return profiles
+
+
+def trajectory_rmsf_data(xtc_files, top_file, selection, base_dir=None, name="rmsf", atom_selection=None,
+                         stride=1, chunk_size=DEFAULT_CHUNK_SIZE, cache_dir=DEFAULT_CACHE_DIR, n_workers=1):
+    """Like ``load_rmsf_data``, but computed from replica trajectories: returns (resSeq, (n_replicas, n_res) RMSF)."""
+    join = (lambda p: os.path.join(base_dir, p)) if base_dir else (lambda p: p)
+    systems = replica_systems(name, [join(p) for p in xtc_files], join(top_file), selection)
+    profiles = system_rmsf(systems, atom_selection, stride, chunk_size, cache_dir, n_workers)
+    for profile in profiles[1:]:
+        if not np.array_equal(profile.resids, profiles[0].resids):
+            raise ValueError("Replica RMSF profiles cover different residues")
+    return profiles[0].resids, np.array([profile.rmsf for profile in profiles])
+
+
+# ========== Plotting ==========
+def plot_rmsf(x_vals, all_rmsf, output_path, helices=GR_HELICES, title="Mean RMSF with Helices Annotated at Top"):
+    """Plot the replica mean RMSF with a ±1 SD band and optional helix spans, saved to `output_path`."""
+    rmsf_mean = np.mean(all_rmsf, axis=0)
+    rmsf_std = np.std(all_rmsf, axis=0)
+
+    plt.figure(figsize=(12, 6))
+    plt.plot(x_vals, rmsf_mean, color="blue", label="Mean RMSF")
+    plt.fill_between(x_vals, rmsf_mean - rmsf_std, rmsf_mean + rmsf_std,
+                     color="gray", alpha=0.3, label="±1 SD")
+
+    if helices:
+        for (start, end) in helices:
+            plt.axvspan(start, end, color="peachpuff", alpha=0.3)
+        midpoints = [(s + e) / 2 for s, e in helices]
+        plt.xticks(midpoints, [f"{s}–{e}" for s, e in helices], rotation=90)
+        y_top = (rmsf_mean + rmsf_std).max() * 1.1
+        for i, mid in enumerate(midpoints, start=1):
+            plt.text(mid, y_top, f"H{i}", ha="center", va="bottom", fontsize=8)
+        plt.scatter([], [], color="peachpuff", alpha=0.3, label="Helices")
+
+    plt.xlabel("Residue Range", labelpad=20)
+    plt.ylabel("RMSF (nm)")
+    plt.title(title, pad=35)
+    plt.legend()
+    plt.grid(True)
+    plt.tight_layout()
+    plt.savefig(output_path, dpi=300)
+    plt.close()
+    return rmsf_mean, rmsf_std
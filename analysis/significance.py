@@ -0,0 +1,171 @@
+"""Block-resampling significance of contact occupancy differences.
+
+Frames within a trajectory are correlated, so each trajectory is split into
+contiguous blocks of frames and the block occupancies, taken from the cached
+contact fingerprints, are resampled instead of single frames. Both tests
+are vectorized over all pairs: every resample is a column of a weight
+matrix, and the resampled occupancies of a batch of pairs are one matrix
+product with it.
+
+- ``"bootstrap"``: blocks are resampled with replacement within each system;
+  the p-value is the fraction of bootstrap differences at least as far
+  from the observed difference as the observed difference is from 0.
+- ``"permutation"``: blocks of both systems are pooled and randomly
+  reassigned to the two systems.
+
+P-values are corrected for multiple testing with Benjamini-Hochberg over
+the pairs that are in contact in at least one system.
+"""
+from collections import namedtuple
+
+import numpy as np
+from statsmodels.stats.multitest import multipletests
+
+from analysis.fingerprints import block_occupancy, system_fingerprints
+from analysis.instrument import get_instrumentation
+from analysis.occupancy import DEFAULT_CACHE_DIR, System
+from analysis.trajectory import DEFAULT_CHUNK_SIZE
+
+SIGNIFICANCE_TESTS = ("bootstrap", "permutation")
+
+ContactSignificance = namedtuple("ContactSignificance", ["pairs", "delta", "pvalues", "qvalues", "reject"])
+
+
+def block_frames_for(n_frames, n_blocks):
+    """Frames per block (a multiple of 8) that split `n_frames` into about `n_blocks` blocks."""
+    return max(8, -(-n_frames // (8 * n_blocks)) * 8)
+
+
+def block_sizes(n_frames, block_frames):
+    n_blocks = -(-n_frames // block_frames)
+    return np.minimum(block_frames, n_frames - np.arange(n_blocks) * block_frames)
+
+
+def matched_block_occupancy(fp, residue_indices, block_frames):
+    """Block occupancies of the fingerprinted pairs whose residues are both in `residue_indices`.
+
+    `residue_indices[k]` is the system's residue index of matched residue k.
+    Returns the ``i * n_matched + j`` codes (i < j) of the kept pairs in
+    matched numbering, their (n_pairs, n_blocks) block occupancies and the
+    block sizes in frames.
+    """
+    n_matched = len(residue_indices)
+    matched = np.full(fp.metadata["n_res"], -1)
+    matched[residue_indices] = np.arange(n_matched)
+    i, j = matched[fp.pairs[:, 0]], matched[fp.pairs[:, 1]]
+    kept = (i >= 0) & (j >= 0)
+    codes = np.minimum(i, j)[kept] * n_matched + np.maximum(i, j)[kept]
+    blocks = block_occupancy(fp, block_frames)[kept]
+    order = np.argsort(codes)
+    return codes[order], blocks[order], block_sizes(fp.n_frames, block_frames)
+
+
+def _align(codes, blocks, all_codes):
+    aligned = np.zeros((len(all_codes), blocks.shape[1]))
+    aligned[np.searchsorted(all_codes, codes)] = blocks
+    return aligned
+
+
+def _bootstrap_weights(n_blocks, n_resamples, rng):
+    # Column k holds how often each block is drawn in resample k
+    return rng.multinomial(n_blocks, np.full(n_blocks, 1 / n_blocks), size=n_resamples).T.astype(float)
+
+
+def block_resampling_pvalues(blocks_a, sizes_a, blocks_b, sizes_b, method="bootstrap",
+                             n_resamples=2000, seed=0, batch_rows=2048):
+    """Two-sided p-values of the occupancy difference b - a of every row (pair).
+
+    `blocks_a`/`blocks_b` are (n_pairs, n_blocks) block occupancies and
+    `sizes_a`/`sizes_b` the frames per block; occupancies are frame-weighted
+    block means. Returns (delta, pvalues).
+    """
+    if method not in SIGNIFICANCE_TESTS:
+        raise ValueError(f"Unknown significance test: {method}")
+    rng = np.random.default_rng(seed)
+    sizes_a, sizes_b = np.asarray(sizes_a, dtype=float), np.asarray(sizes_b, dtype=float)
+    frames_a, frames_b = blocks_a * sizes_a, blocks_b * sizes_b
+    delta = frames_b.sum(axis=1) / sizes_b.sum() - frames_a.sum(axis=1) / sizes_a.sum()
+
+    if method == "bootstrap":
+        weights_a = _bootstrap_weights(len(sizes_a), n_resamples, rng)
+        weights_b = _bootstrap_weights(len(sizes_b), n_resamples, rng)
+        total_a, total_b = sizes_a @ weights_a, sizes_b @ weights_b
+    else:
+        # Column k marks the pooled blocks assigned to system b in permutation k
+        pooled_sizes = np.concatenate([sizes_b, sizes_a])
+        n_pooled = len(pooled_sizes)
+        order = np.argsort(rng.random((n_resamples, n_pooled)), axis=1)
+        assign_b = np.zeros((n_pooled, n_resamples))
+        assign_b[order[:, :len(sizes_b)].T, np.arange(n_resamples)] = 1.0
+        total_b = pooled_sizes @ assign_b
+        total_a = pooled_sizes.sum() - total_b
+
+    extreme = np.zeros(len(delta), dtype=np.int64)
+    tolerance = 1e-12
+    for start in range(0, len(delta), batch_rows):
+        rows = slice(start, start + batch_rows)
+        if method == "bootstrap":
+            resampled = (frames_b[rows] @ weights_b) / total_b - (frames_a[rows] @ weights_a) / total_a
+            distance = np.abs(resampled - delta[rows, None])
+        else:
+            pooled = np.hstack([frames_b[rows], frames_a[rows]])
+            in_b = pooled @ assign_b
+            distance = np.abs(in_b / total_b - (pooled.sum(axis=1)[:, None] - in_b) / total_a)
+        extreme[rows] = np.count_nonzero(distance >= np.abs(delta[rows, None]) - tolerance, axis=1)
+    return delta, (extreme + 1) / (n_resamples + 1)
+
+
+def _replica_blocks(systems, residues, cutoff_nm, stride, chunk_size, cache_dir, n_blocks):
+    # Blocks of all replicas of one condition, each replica split on its own
+    indices = [res.index for res in residues]
+    replica_blocks = []
+    for system in systems:
+        fp = system_fingerprints(system, cutoff_nm, stride, chunk_size, cache_dir)
+        replica_blocks.append(matched_block_occupancy(fp, indices, block_frames_for(fp.n_frames, n_blocks)))
+    return replica_blocks
+
+
+def _pooled_blocks(replica_blocks, codes):
+    return (np.hstack([_align(c, blocks, codes) for c, blocks, _ in replica_blocks]),
+            np.concatenate([sizes for _, _, sizes in replica_blocks]))
+
+
+def contact_difference_significance(bound, unbound, occupancy, cutoff_nm, stride=1,
+                                    chunk_size=DEFAULT_CHUNK_SIZE, cache_dir=DEFAULT_CACHE_DIR,
+                                    method="bootstrap", n_blocks=20, n_resamples=2000, alpha=0.05,
+                                    seed=0):
+    """Significance of the unbound - bound occupancy change of every matched pair in contact in either system.
+
+    `bound` and `unbound` are systems or lists of replica systems; the
+    blocks of all replicas of a condition are resampled together.
+    `occupancy` is their ``MatchedOccupancy``. Returns a
+    ``ContactSignificance`` with the (n_pairs, 2) matched residue indices,
+    the occupancy differences, raw p-values, BH q-values and whether each
+    pair is significant at FDR `alpha`.
+    """
+    bound = [bound] if isinstance(bound, System) else list(bound)
+    unbound = [unbound] if isinstance(unbound, System) else list(unbound)
+    blocks_bound = _replica_blocks(bound, occupancy.residues_bound, cutoff_nm, stride, chunk_size,
+                                   cache_dir, n_blocks)
+    blocks_unbound = _replica_blocks(unbound, occupancy.residues_unbound, cutoff_nm, stride, chunk_size,
+                                     cache_dir, n_blocks)
+    with get_instrumentation().stage("significance"):
+        n_matched = len(occupancy.matched_keys)
+        codes = np.unique(np.concatenate([c for c, _, _ in blocks_bound + blocks_unbound]))
+        delta, pvalues = block_resampling_pvalues(*_pooled_blocks(blocks_bound, codes),
+                                                  *_pooled_blocks(blocks_unbound, codes),
+                                                  method, n_resamples, seed)
+        if len(pvalues):
+            reject, qvalues = multipletests(pvalues, alpha=alpha, method="fdr_bh")[:2]
+        else:
+            reject, qvalues = np.zeros(0, dtype=bool), np.zeros(0)
+        pairs = np.column_stack(np.divmod(codes, n_matched))
+    print(f"{method} test: {np.count_nonzero(reject)} of {len(codes)} contacting pairs "
+          f"significant at FDR {alpha}")
+    return ContactSignificance(pairs, delta, pvalues, qvalues, reject)
+
+
+def significance_dict(significance):
+    """``{(i, j): (pvalue, qvalue, reject)}`` for the pairs of a ``ContactSignificance``."""
+    return {(int(i), int(j)): (p, q, bool(r)) for (i, j), p, q, r in
+            zip(significance.pairs, significance.pvalues, significance.qvalues, significance.reject)}
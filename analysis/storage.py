@@ -0,0 +1,92 @@
+"""Binary matrix outputs.
+
+Matrices are written as ``.npy`` so they can be memory-mapped with
+``np.load(path, mmap_mode="r")`` and sliced without reading the whole file.
+Residue labels and run parameters go into a ``.json`` sidecar with the same
+base name. Sparse matrices are written as scipy ``.npz`` with the same
+sidecar.
+"""
+import json
+
+import numpy as np
+import scipy.sparse
+
+from analysis.instrument import get_instrumentation
+
+MATRIX_FORMATS = ("npy", "csv")
+
+
+def _base_path(path):
+    for ext in (".npy", ".npz", ".json", ".csv"):
+        if path.endswith(ext):
+            return path[:-len(ext)]
+    return path
+
+
+def _to_json(value):
+    return value.tolist() if hasattr(value, "tolist") else str(value)
+
+
+def _write_metadata(base, matrix, labels, params):
+    metadata = {"shape": list(matrix.shape), "dtype": str(matrix.dtype), "labels": labels, "params": params}
+    with open(base + ".json", "w") as f:
+        json.dump(metadata, f, default=_to_json)
+
+
+def save_matrix(path, matrix, labels=None, dtype=None, formats=("npy",), **params):
+    """Write `matrix` in each of `formats` ("npy" with a .json sidecar, and/or "csv").
+
+    `dtype` (e.g. ``np.float32``) converts the .npy output. Returns the written paths.
+    """
+    base = _base_path(path)
+    matrix = np.asarray(matrix)
+    written = []
+    with get_instrumentation().stage("write"):
+        for fmt in formats:
+            if fmt == "npy":
+                array = matrix.astype(dtype) if dtype is not None else matrix
+                np.save(base + ".npy", array)
+                _write_metadata(base, array, labels, params)
+                written.append(base + ".npy")
+            elif fmt == "csv":
+                np.savetxt(base + ".csv", matrix, delimiter=",", fmt="%.6f")
+                written.append(base + ".csv")
+            else:
+                raise ValueError(f"Unknown matrix format: {fmt}")
+    return written
+
+
+def load_matrix(path, mmap_mode="r"):
+    """Load a matrix written by ``save_matrix``; returns (array, metadata).
+
+    With the default ``mmap_mode="r"`` only the slices that are indexed are read from disk.
+    """
+    base = _base_path(path)
+    array = np.load(base + ".npy", mmap_mode=mmap_mode)
+    try:
+        with open(base + ".json") as f:
+            metadata = json.load(f)
+    except FileNotFoundError:
+        metadata = {}
+    return array, metadata
+
+
+def save_sparse_matrix(path, matrix, labels=None, **params):
+    """Write a scipy sparse matrix as ``.npz`` with a .json sidecar; returns the .npz path."""
+    base = _base_path(path)
+    with get_instrumentation().stage("write"):
+        scipy.sparse.save_npz(base + ".npz", scipy.sparse.csr_matrix(matrix))
+        _write_metadata(base, matrix, labels, params)
+    return base + ".npz"
+
+
+def load_sparse_matrix(path):
+    """Load a matrix written by ``save_sparse_matrix``; returns (CSR matrix, metadata)."""
+    base = _base_path(path)
+    matrix = scipy.sparse.load_npz(base + ".npz").tocsr()
+    try:
+        with open(base + ".json") as f:
+            metadata = json.load(f)
+    except FileNotFoundError:
+        metadata = {}
+    return matrix, metadata
@@ -0,0 +1,109 @@
+"""Precomputed residue index of a structure file and atom selection.
+
+Once occupancies are cached, parsing the PDB with mdtraj and walking its
+residue objects is most of a script's startup time. The index keeps what
+the pipeline needs from the selected part of the topology as NumPy arrays:
+atom indices, residue numbers, names and chains, and the CSR layout of the
+heavy atoms of each residue. It is saved as ``{structure}.index_{key}.npz``
+next to the structure, keyed by the file hash and selection, so later runs
+never parse the PDB. Bound and unbound residues are matched from these
+arrays in one vectorized intersection.
+"""
+import hashlib
+import json
+import os
+from collections import namedtuple
+
+import mdtraj as md
+import numpy as np
+
+from analysis.contacts import heavy_atom_index
+
+INDEX_VERSION = 1
+
+TopologyIndex = namedtuple("TopologyIndex", ["atom_indices", "resseq", "resname", "chain",
+                                             "heavy_offsets", "heavy_atoms"])
+# Stand-ins for mdtraj residues with the attributes the pipeline reads
+Chain = namedtuple("Chain", ["index"])
+IndexedResidue = namedtuple("IndexedResidue", ["index", "name", "resSeq", "chain"])
+
+
+def file_hash(path, block_size=1 << 20):
+    """SHA-256 of the whole file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# ========== Build & Cache ==========
+def topology_index_path(top_path, selection):
+    params = {"version": INDEX_VERSION, "topology": file_hash(top_path), "selection": selection}
+    key = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+    return f"{os.path.splitext(top_path)[0]}.index_{key}.npz"
+
+
+def build_topology_index(top_path, selection):
+    """Parse `top_path` and index the residues of `selection` (positions refer to the sliced topology)."""
+    topology = md.load_topology(top_path)
+    atom_indices = topology.select(selection)
+    residues = list(topology.subset(atom_indices).residues)
+    heavy_offsets, heavy_atoms = heavy_atom_index(residues)
+    return TopologyIndex(atom_indices.astype(np.int64),
+                         np.array([res.resSeq for res in residues], dtype=np.int64),
+                         np.array([res.name for res in residues], dtype=str),
+                         np.array([res.chain.index for res in residues], dtype=np.int64),
+                         heavy_offsets, heavy_atoms)
+
+
+def save_topology_index(path, index):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **index._asdict())
+    os.replace(tmp_path, path)
+
+
+def load_topology_index(path):
+    with np.load(path) as data:
+        return TopologyIndex(*(data[field] for field in TopologyIndex._fields))
+
+
+def topology_index(top_path, selection):
+    """``TopologyIndex`` of `selection` in `top_path`, built and saved on first use."""
+    path = topology_index_path(top_path, selection)
+    if os.path.exists(path):
+        return load_topology_index(path)
+    index = build_topology_index(top_path, selection)
+    save_topology_index(path, index)
+    print(f"Topology index saved to: {path}")
+    return index
+
+
+# ========== Residues ==========
+def n_residues(index):
+    return len(index.resseq)
+
+
+def index_residues(index, positions=None):
+    """``IndexedResidue`` records of the residues at `positions` (all if None)."""
+    positions = range(n_residues(index)) if positions is None else positions
+    return [IndexedResidue(int(k), str(index.resname[k]), int(index.resseq[k]), Chain(int(index.chain[k])))
+            for k in positions]
+
+
+def _residue_keys(index):
+    # (chain, resSeq) packed into one sortable integer
+    return index.chain * (1 << 32) + (index.resseq + (1 << 31))
+
+
+def match_residue_index(index_bound, index_unbound):
+    """Like ``contacts.match_residues``, but from two ``TopologyIndex`` arrays.
+
+    Returns the matched (chain, resSeq) keys in sorted order and the
+    ``IndexedResidue`` records of both systems in that order.
+    """
+    _, pos_bound, pos_unbound = np.intersect1d(_residue_keys(index_bound), _residue_keys(index_unbound),
+                                               assume_unique=False, return_indices=True)
+    matched_keys = list(zip(index_bound.chain[pos_bound].tolist(), index_bound.resseq[pos_bound].tolist()))
+    return matched_keys, index_residues(index_bound, pos_bound), index_residues(index_unbound, pos_unbound)
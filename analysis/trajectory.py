@@ -0,0 +1,78 @@
+"""Trajectory loading for the contact analysis.
+
+Trajectories are streamed in fixed-size frame chunks with ``md.iterload`` and
+sliced to the selected atoms at read time, so peak memory is set by the chunk
+size and not by the trajectory length.
+"""
+import mdtraj as md
+import numpy as np
+
+DEFAULT_CHUNK_SIZE = 500  # frames per chunk
+
+
+def load_protein_topology(top_path, selection):
+    """Return the atom indices of `selection` in `top_path` and the topology sliced to them."""
+    topology = md.load_topology(top_path)
+    atom_indices = topology.select(selection)
+    return atom_indices, topology.subset(atom_indices)
+
+
+def calpha_atoms(top_path, selection):
+    """Full-topology indices of one Cα per residue of `selection` that has one, and those residues' positions in it."""
+    atom_indices, topology = load_protein_topology(top_path, selection)
+    local = topology.select("name CA")
+    positions = np.array([topology.atom(k).residue.index for k in local], dtype=np.int64)
+    first = np.concatenate([[True], positions[1:] != positions[:-1]])
+    return atom_indices[local[first]], positions[first]
+
+
+def iter_protein_chunks(xtc_path, top_path, atom_indices, chunk_size=DEFAULT_CHUNK_SIZE, stride=1,
+                        start=0):
+    """Yield chunks of at most `chunk_size` frames of `xtc_path`, sliced to `atom_indices`.
+
+    The first `start` frames are skipped.
+    """
+    if start == 0:
+        return md.iterload(xtc_path, top=top_path, chunk=chunk_size, stride=stride,
+                           atom_indices=atom_indices)
+    # md.iterload(skip=...) keeps returning bogus frames at the end of a seeked,
+    # strided XTC, so read an explicit number of frames instead
+    return iter_frame_block(xtc_path, md.load_topology(top_path), atom_indices, start, None,
+                            chunk_size, stride)
+
+
+def count_frames(xtc_path):
+    with md.open(xtc_path) as f:
+        return len(f)
+
+
+def frame_blocks(n_frames, n_blocks, stride=1, start=0):
+    """Split the strided frames from raw frame `start` on into `n_blocks` contiguous (start, n_frames) blocks.
+
+    Block starts are raw frame indices and block sizes count frames after striding.
+    """
+    n_out = -(-max(0, n_frames - start) // stride)
+    bounds = np.linspace(0, n_out, min(n_blocks, n_out) + 1).astype(int)
+    return [(start + lo * stride, hi - lo) for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+
+
+def iter_frame_block(xtc_path, topology, atom_indices, start, n_frames=None,
+                     chunk_size=DEFAULT_CHUNK_SIZE, stride=1):
+    """Yield chunks of `n_frames` strided frames (all remaining if None) beginning at raw frame `start`.
+
+    `topology` is the full, unsliced topology of `xtc_path`. The number of
+    frames is always bounded because strided reads past the end of a seeked
+    XTC do not stop.
+    """
+    if n_frames is None:
+        n_frames = -(-max(0, count_frames(xtc_path) - start) // stride)
+    with md.open(xtc_path) as f:
+        f.seek(start)
+        remaining = n_frames
+        while remaining > 0:
+            chunk = f.read_as_traj(topology, n_frames=min(chunk_size, remaining), stride=stride,
+                                   atom_indices=atom_indices)
+            if chunk.n_frames == 0:
+                break
+            yield chunk
+            remaining -= chunk.n_frames
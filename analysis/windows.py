@@ -0,0 +1,255 @@
+"""Time-resolved contact occupancy and communicability over sliding windows.
+
+Windows of `width` frames start every `step` frames. Per-frame contacts are
+read from the cached bit-packed fingerprints (see ``analysis.fingerprints``),
+so no trajectory pass is needed once those exist. Each window's contact
+counts are updated from the previous window's: frames that leave are
+subtracted and frames that enter are added, which touches only
+2 x `step` frame columns per window.
+
+Consecutive windows share most of their frames, so the thresholded
+adjacency A changes by a small, sparse E between them. Communicability
+exp(A) is computed exactly, by a symmetric eigendecomposition
+A = V diag(l) V^T, only at reference windows. In between, it is updated to
+first order with the Fréchet derivative of the matrix exponential:
+
+    exp(A + E) ~ exp(A) + V (D o (V^T E V)) V^T,   D_ij = (e^l_i - e^l_j) / (l_i - l_j)
+
+V^T E V only involves the rows of V for the residues whose edges changed,
+a low-rank correction. A new reference is taken once ||E|| exceeds
+`refresh_tolerance` relative to ||A||, which bounds the second-order error.
+Windows whose adjacency did not change reuse the previous values.
+
+Both series are returned as compact (n_windows, n_pairs) float32 arrays over
+the pairs that are ever in contact.
+"""
+import os
+import time
+from collections import namedtuple
+
+import numpy as np
+import scipy.linalg
+import scipy.sparse
+import scipy.sparse.linalg
+
+from analysis.contacts import format_residue_labels
+from analysis.fingerprints import system_fingerprints
+from analysis.instrument import enable_instrumentation, get_instrumentation
+from analysis.occupancy import DEFAULT_CACHE_DIR, System, gr_replica_systems, gr_systems, \
+    matched_system_occupancies
+from analysis.storage import save_matrix
+from analysis.trajectory import DEFAULT_CHUNK_SIZE
+
+# ========== Parameters ==========
+cutoff = 0.4  # nm
+threshold = 0.5  # occupancy threshold for a communicability edge
+window_width = 100  # frames per window
+window_step = 10  # frames between window starts
+comm_update = "frechet"  # "frechet" (first-order updates between exact refreshes), "exact" or None (occupancy only)
+refresh_tolerance = 0.05  # ||E|| / ||A|| at which "frechet" recomputes exactly
+stride = 1
+chunk_size = 500  # frames held in memory at once
+replicas = None  # e.g. {"bound": ["md_skip_gr_ligand_1.xtc", ...], "unbound": [...]} in src/
+output_dir = "."
+report_path = None  # e.g. "run_report.json" for per-stage timings and counters
+
+COMM_UPDATES = ("frechet", "exact")
+
+WindowSeries = namedtuple("WindowSeries", ["starts", "width", "pairs", "occupancy", "communicability",
+                                           "n_refreshes"])
+
+
+# ========== Sliding Occupancy ==========
+def window_starts(n_frames, width, step):
+    """First frame of every window of `width` frames, `step` frames apart, that fits in `n_frames`."""
+    if width < 1 or step < 1:
+        raise ValueError("Window width and step must be positive")
+    return np.arange(0, max(0, n_frames - width) + 1, step) if n_frames >= width else np.zeros(0, dtype=int)
+
+
+def frame_bits(fp, start, stop):
+    """(n_pairs, stop - start) contact bits of frames `start` to `stop` of fingerprints `fp`."""
+    packed = np.asarray(fp.bits[:, start // 8:-(-stop // 8)])
+    offset = start % 8
+    return np.unpackbits(packed, axis=1)[:, offset:offset + stop - start].astype(bool)
+
+
+def sliding_counts(fp, width, step):
+    """Yield (start, contact counts per fingerprint pair) of every window, updated from the previous one."""
+    counts = None
+    for start in window_starts(fp.n_frames, width, step):
+        if counts is None or step >= width:
+            counts = frame_bits(fp, start, start + width).sum(axis=1, dtype=np.int64)
+        else:
+            counts -= frame_bits(fp, start - step, start).sum(axis=1, dtype=np.int64)
+            counts += frame_bits(fp, start + width - step, start + width).sum(axis=1, dtype=np.int64)
+        yield start, counts
+
+
+# ========== Incremental Communicability ==========
+def _exp_divided_differences(eigvals):
+    # (e^l_i - e^l_j) / (l_i - l_j), written as e^l_j expm1(d) / d so close eigenvalues stay accurate
+    diff = eigvals[:, None] - eigvals[None, :]
+    ratio = np.divide(np.expm1(diff), diff, out=np.ones_like(diff), where=np.abs(diff) > 1e-12)
+    return np.exp(eigvals)[None, :] * ratio
+
+
+class WindowCommunicability:
+    """Communicability at fixed residue `pairs` for a sequence of slowly changing adjacencies.
+
+    `method` "exact" decomposes every adjacency; "frechet" decomposes only
+    reference adjacencies and applies first-order updates in between (see
+    the module docstring).
+    """
+
+    def __init__(self, n_res, pairs, method="frechet", refresh_tolerance=refresh_tolerance):
+        if method not in COMM_UPDATES:
+            raise ValueError(f"Unknown communicability update: {method}")
+        self.n_res = n_res
+        self.method = method
+        self.refresh_tolerance = refresh_tolerance
+        self.residues, pair_rows = np.unique(np.asarray(pairs), return_inverse=True)
+        self.pair_rows = pair_rows.reshape(-1, 2)
+        self.n_refreshes = 0
+        self._previous = None
+        self._values = None
+
+    def _refresh(self, adj):
+        with get_instrumentation().stage("window_eigh"):
+            self.eigvals, self.eigvecs = scipy.linalg.eigh(adj.toarray())
+        self.reference = adj
+        self.reference_norm = max(scipy.sparse.linalg.norm(adj), 1e-12)
+        self.divided = _exp_divided_differences(self.eigvals)
+        vecs = self.eigvecs[self.residues]
+        self.reference_values = self._pair_values(vecs * np.exp(self.eigvals), vecs)
+        self.n_refreshes += 1
+        return self.reference_values
+
+    def _pair_values(self, left, right):
+        # Entries (i, j) of left @ right.T at the tracked pairs
+        return np.einsum("pk,pk->p", left[self.pair_rows[:, 0]], right[self.pair_rows[:, 1]])
+
+    def update(self, adj):
+        """Communicability of symmetric CSR `adj` at the tracked pairs."""
+        if self._previous is not None and (adj != self._previous).nnz == 0:
+            return self._values
+        if self.method == "exact" or self._previous is None:
+            values = self._refresh(adj)
+        else:
+            change = (adj - self.reference).tocoo()
+            if scipy.sparse.linalg.norm(change) > self.refresh_tolerance * self.reference_norm:
+                values = self._refresh(adj)
+            else:
+                with get_instrumentation().stage("window_update"):
+                    # V^T E V from the rows of V whose residues gained, lost or reweighted edges
+                    touched = np.unique(change.row)
+                    projected = self.eigvecs[touched].T @ (change.tocsr()[touched] @ self.eigvecs)
+                    vecs = self.eigvecs[self.residues]
+                    values = self.reference_values + self._pair_values(vecs @ (self.divided * projected), vecs)
+        self._previous, self._values = adj, values
+        return values
+
+
+def window_adjacency(pairs, occupancy, n_res, threshold=threshold):
+    """Symmetric CSR adjacency of the `pairs` whose window `occupancy` is above `threshold`."""
+    kept = occupancy > threshold
+    rows, cols, weights = pairs[kept, 0], pairs[kept, 1], occupancy[kept]
+    return scipy.sparse.coo_matrix((np.concatenate([weights, weights]),
+                                    (np.concatenate([rows, cols]), np.concatenate([cols, rows]))),
+                                   shape=(n_res, n_res)).tocsr()
+
+
+def sliding_windows(fp, width=window_width, step=window_step, threshold=threshold, comm_update=comm_update,
+                    refresh_tolerance=refresh_tolerance, residue_map=None, n_res=None, label=None):
+    """``WindowSeries`` of fingerprints `fp`.
+
+    `residue_map` maps the fingerprint's residue indices to output residue
+    indices (-1 drops a residue), e.g. onto the matched residues of both
+    systems; `n_res` is then the number of output residues. Communicability
+    is skipped if `comm_update` is None.
+    """
+    inst = get_instrumentation()
+    pairs = fp.pairs.astype(np.int64)
+    if residue_map is not None:
+        mapped = np.asarray(residue_map)[pairs]
+        kept = (mapped >= 0).all(axis=1)
+        pairs, rows = np.sort(mapped[kept], axis=1), np.flatnonzero(kept)
+    else:
+        rows = np.arange(len(pairs))
+        n_res = fp.metadata["n_res"]
+    starts = window_starts(fp.n_frames, width, step)
+    occupancy = np.zeros((len(starts), len(pairs)), dtype=np.float32)
+    comm = np.zeros((len(starts), len(pairs)), dtype=np.float32) if comm_update else None
+    tracker = WindowCommunicability(n_res, pairs, comm_update, refresh_tolerance) if comm_update else None
+
+    with inst.stage("windows"):
+        for w, (start, counts) in enumerate(sliding_counts(fp, width, step)):
+            window_occupancy = counts[rows] / width
+            occupancy[w] = window_occupancy
+            if tracker is not None:
+                comm[w] = tracker.update(window_adjacency(pairs, window_occupancy, n_res, threshold))
+            inst.count("windows")
+            if label is not None and (w + 1) % 100 == 0:
+                inst.progress(label, f"Windows processed: {w + 1}/{len(starts)}")
+    return WindowSeries(starts, width, pairs, occupancy, comm, tracker.n_refreshes if tracker else 0)
+
+
+# ========== Output ==========
+def pair_labels(pairs, residue_labels):
+    return [f"{residue_labels[i]}-{residue_labels[j]}" for i, j in pairs]
+
+
+def save_window_series(base, series, residue_labels, **params):
+    """Write the occupancy (and communicability) series as ``{base}_occupancy.npy`` / ``{base}_communicability.npy``."""
+    labels = pair_labels(series.pairs, residue_labels)
+    params = dict(params, window_starts=series.starts, width=series.width)
+    paths = save_matrix(f"{base}_occupancy", series.occupancy, labels, **params)
+    if series.communicability is not None:
+        paths += save_matrix(f"{base}_communicability", series.communicability, labels,
+                             n_refreshes=series.n_refreshes, **params)
+    return paths
+
+
+def system_windows(systems, residues, n_res, cutoff_nm=cutoff, width=window_width, step=window_step,
+                   threshold=threshold, comm_update=comm_update, refresh_tolerance=refresh_tolerance, stride=1,
+                   chunk_size=DEFAULT_CHUNK_SIZE, cache_dir=DEFAULT_CACHE_DIR):
+    """``{system.name: WindowSeries}`` of one ``System`` or each of its replicas, over matched `residues`.
+
+    Windows never span two replicas.
+    """
+    systems = [systems] if isinstance(systems, System) else list(systems)
+    results = {}
+    for system in systems:
+        fp = system_fingerprints(system, cutoff_nm, stride, chunk_size, cache_dir)
+        residue_map = np.full(fp.metadata["n_res"], -1)
+        residue_map[[res.index for res in residues]] = np.arange(len(residues))
+        series = sliding_windows(fp, width, step, threshold, comm_update, refresh_tolerance, residue_map, n_res,
+                                 system.name)
+        print(f"[{system.name}] {len(series.starts)} windows x {len(series.pairs)} pairs"
+              + (f", {series.n_refreshes} exact communicability refreshes" if comm_update else ""))
+        results[system.name] = series
+    return results
+
+
+def main():
+    start_time = time.time()
+    inst = enable_instrumentation() if report_path else get_instrumentation()
+
+    bound, unbound = gr_replica_systems(replicas["bound"], replicas["unbound"]) if replicas else gr_systems()
+    occupancy = matched_system_occupancies(bound, unbound, cutoff, stride, chunk_size)
+    labels = format_residue_labels(occupancy.residues_bound)
+    for systems, residues in ((bound, occupancy.residues_bound), (unbound, occupancy.residues_unbound)):
+        results = system_windows(systems, residues, len(residues), cutoff, window_width, window_step, threshold,
+                                 comm_update, refresh_tolerance, stride, chunk_size)
+        for name, series in results.items():
+            paths = save_window_series(os.path.join(output_dir, f"windows_{name}"), series, labels,
+                                       cutoff=cutoff, threshold=threshold, step=window_step)
+            print(f"{name} window series saved to: {', '.join(paths)}")
+
+    print(f"\nTotal execution time: {time.time() - start_time:.2f} seconds")
+    if report_path:
+        inst.write_report(report_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,35 +1,26 @@
+# Run from the repository root: python -m graphing.script1
 import numpy as np
 import matplotlib.pyplot as plt
 import os
 
-def load_rmsf_data(filenames, base_dir=None):
-    """Load RMSF data from a list of .xvg files. Assumes all files share the same x-axis."""
-    all_y = []
-    x_ref = None
-    for i, fname in enumerate(filenames):
-        x = []
-        y = []
-        path = os.path.join(base_dir, fname) if base_dir else fname
-        with open(path) as file:
-            for line in file:
-                if line.startswith(("#", "@")):
-                    continue
-                parts = line.strip().split()
-                if len(parts) >= 2:
-                    x.append(float(parts[0]))
-                    y.append(float(parts[1]))
-        if i == 0:
-            x_ref = x
-        all_y.append(y)
-    return x_ref, np.array(all_y)
+from analysis.rmsf import load_rmsf_data, trajectory_rmsf_data
 
 # Define input
 files = ["rmsf_gr_1.xvg", "rmsf_gr_2.xvg", "rmsf_gr_3.xvg"]
+from_trajectories = False  # compute RMSF from the replica trajectories below instead of the .xvg files
+trajectories = ["md_skip_gr_ligand_1.xtc", "md_skip_gr_ligand_2.xtc", "md_skip_gr_ligand_3.xtc"]
+topology = "gr_ligand.pdb"
+selection = "protein and chainid 1"
+n_workers = os.cpu_count() or 1  # replicas computed in parallel
 script_dir = os.path.dirname(os.path.abspath(__file__))
 src_dir = os.path.join(script_dir, "..", "src")  # adjust as needed
 
 # Load data
-x_vals, all_rmsf = load_rmsf_data(files, base_dir=src_dir)
+if from_trajectories:
+    x_vals, all_rmsf = trajectory_rmsf_data(trajectories, topology, selection, base_dir=src_dir,
+                                            name="bound", n_workers=n_workers)
+else:
+    x_vals, all_rmsf = load_rmsf_data(files, base_dir=src_dir)
 rmsf_mean = np.mean(all_rmsf, axis=0)
 rmsf_std = np.std(all_rmsf, axis=0)
 
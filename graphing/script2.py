@@ -1,9 +1,12 @@
+# Run from the repository root: python -m graphing.script2
 import numpy as np
 import matplotlib.pyplot as plt
 
 # Load data
 import os
 
+from analysis.rmsf import load_rmsf_data, trajectory_rmsf_data
+
 # Get directory where the script is located
 script_dir = os.path.dirname(os.path.abspath(__file__))
 src_dir = os.path.join(script_dir, "..", "src")
@@ -13,22 +16,17 @@ files = [
     "rmsf_gr_only_2.xvg",
     "rmsf_gr_only_3.xvg"
 ]
+from_trajectories = False  # compute RMSF from the replica trajectories below instead of the .xvg files
+trajectories = ["md_skip_gr_only_1.xtc", "md_skip_gr_only_2.xtc", "md_skip_gr_only_3.xtc"]
+topology = "gr_only.pdb"
+selection = "protein and chainid 0"
+n_workers = os.cpu_count() or 1  # replicas computed in parallel
 
-all_rmsf = []
-
-for fname in files:
-    x = []
-    y = []
-    file_path = os.path.join(src_dir, fname)
-    with open(file_path) as file:
-        for line in file:
-            if line.startswith(("#", "@")):
-                continue
-            parts = line.strip().split()
-            if len(parts) >= 2:
-                x.append(float(parts[0]))
-                y.append(float(parts[1]))
-    all_rmsf.append(y)
+if from_trajectories:
+    x, all_rmsf = trajectory_rmsf_data(trajectories, topology, selection, base_dir=src_dir,
+                                       name="unbound", n_workers=n_workers)
+else:
+    x, all_rmsf = load_rmsf_data(files, base_dir=src_dir)
 
 rmsf_mean = np.mean(all_rmsf, axis=0)
 rmsf_std = np.std(all_rmsf, axis=0)